@@ -1,8 +1,10 @@
 from cbuild.core import logger, paths, chroot, profile
 
-from . import sign as asign
+from . import sign as asign, index as aindex, version as aversion
 
 import os
+import json
+import hashlib
 import pathlib
 import subprocess
 
@@ -14,6 +16,10 @@ def set_network(use_net):
     _use_net = use_net
 
 
+def get_network():
+    return _use_net
+
+
 def collect_repos(mrepo, intree, arch, use_altrepo, use_stage, use_net):
     ret = []
     # sometimes we need no repos
@@ -214,6 +220,18 @@ def is_installed(pkgn, pkg=None):
         sysp = paths.bldroot()
         aarch = None
 
+    ndx = aindex.load_installed(sysp)
+    if ndx:
+        from cbuild.apk import util as autil
+
+        dn, dv, dop = autil.split_pkg_name(pkgn)
+        if not dn:
+            return len(ndx.whatprovides(pkgn)) > 0
+        for ipkg, iver in ndx.whatprovides(dn):
+            if iver and autil.pkg_match(f"{dn}-{iver}", pkgn):
+                return True
+        return False
+
     return (
         call(
             "info",
@@ -238,6 +256,13 @@ def get_provider(thing, pkg):
         sysp = paths.bldroot()
         aarch = None
 
+    ndx = aindex.load_installed(sysp)
+    if ndx:
+        provs = sorted(set(ipkg.name for ipkg, iver in ndx.whatprovides(thing)))
+        if len(provs) == 0:
+            return None
+        return "\n".join(provs)
+
     out = (
         call(
             "search",
@@ -259,14 +284,10 @@ def get_provider(thing, pkg):
 
 
 def check_version(*args):
-    # buggy apk behavior
-    if len(args) == 1 and not args[0][0].isdigit():
-        return False
-    v = subprocess.run(
-        [paths.apk(), "version", "--quiet", "--check", *args],
-        capture_output=True,
-    )
-    return v.returncode == 0
+    for v in args:
+        if not aversion.validate(v):
+            return False
+    return True
 
 
 def compare_version(v1, v2, strict=True):
@@ -275,26 +296,31 @@ def compare_version(v1, v2, strict=True):
         # is used this should never fire unless something is super wrong
         raise RuntimeError("invalid version")
 
-    v = subprocess.run(
-        [paths.apk(), "version", "--quiet", "--test", v1, v2],
-        capture_output=True,
-        check=True,
-    ).stdout.strip()
+    return aversion.compare(v1, v2)
 
-    if v == b"=":
-        return 0
-    elif v == b"<":
-        return -1
-    else:
-        return 1
+
+# a mapping of package file names to their size and mtime
+def _scan_repo(repopath):
+    ret = {}
+    with os.scandir(repopath) as it:
+        for de in it:
+            if de.name.startswith(".") or not de.name.endswith(".apk"):
+                continue
+            if not de.is_file():
+                continue
+            st = de.stat()
+            ret[de.name] = (st.st_size, st.st_mtime_ns)
+    return ret
 
 
-def summarize_repo(repopath, olist, quiet=False):
+def summarize_repo(repopath, olist, quiet=False, scan=None):
     rtimes = {}
     obsolete = []
 
-    for f in repopath.glob("*.apk"):
-        fn = f.name
+    if scan is None:
+        scan = _scan_repo(repopath)
+
+    for fn in scan:
         pf = fn[:-4]
         rd = pf.rfind("-")
         if rd > 0:
@@ -304,33 +330,33 @@ def summarize_repo(repopath, olist, quiet=False):
                 logger.get().warn(f"Malformed file name found, skipping: {fn}")
             continue
         pn = pf[0:rd]
-        mt = f.stat().st_mtime
+        mt = scan[fn][1]
         if pn not in rtimes:
-            rtimes[pn] = (mt, f.name)
+            rtimes[pn] = (mt, fn)
         else:
             omt, ofn = rtimes[pn]
             # this package is newer, so prefer it
             if mt > omt:
                 fromf = ofn
                 fromv = ofn[rd + 1 : -4]
-                tof = f.name
+                tof = fn
                 tov = pf[rd + 1 :]
-                rtimes[pn] = (mt, f.name)
+                rtimes[pn] = (mt, fn)
                 obsolete.append(ofn)
             elif mt < omt:
-                fromf = f.name
+                fromf = fn
                 fromv = pf[rd + 1 :]
                 tof = ofn
                 tov = ofn[rd + 1 : -4]
-                obsolete.append(f.name)
+                obsolete.append(fn)
             else:
                 # same timestamp? should pretty much never happen
                 # take the newer version anyway
                 if compare_version(pf[rd + 1 :], ofn[rd + 1 : -4]) > 0:
-                    rtimes[pn] = (mt, f.name)
+                    rtimes[pn] = (mt, fn)
                     obsolete.append(ofn)
                 else:
-                    obsolete.append(f.name)
+                    obsolete.append(fn)
 
             if compare_version(tov, fromv, False) < 0 and not quiet:
                 logger.get().warn(
@@ -367,6 +393,111 @@ def prune(repopath, arch=None, dry=False):
     logger.get().out("repo cleanup complete")
 
 
+# the state of the repository the index was last built from, kept in the
+# cache path; this is the indexed files along with their size and mtime,
+# and what else the index depends on
+def _manifest_path(repopath):
+    rhash = hashlib.sha256(str(repopath.resolve()).encode()).hexdigest()
+    return paths.cbuild_cache() / "index_manifest" / f"{rhash}.json"
+
+
+def _write_manifest(repopath, files, keypath, epoch):
+    mpath = _manifest_path(repopath)
+    try:
+        ist = (repopath / "APKINDEX.tar.gz").stat()
+        mpath.parent.mkdir(parents=True, exist_ok=True)
+        tpath = mpath.with_name(f".{mpath.name}.{os.getpid()}")
+        with open(tpath, "w") as f:
+            json.dump(
+                {
+                    "index": [ist.st_size, ist.st_mtime_ns],
+                    "key": str(keypath) if keypath else None,
+                    "epoch": epoch,
+                    "files": files,
+                },
+                f,
+            )
+        os.replace(tpath, mpath)
+    except OSError:
+        # not fatal, just means a full reindex next time
+        pass
+
+
+# the manifest of the current index, or None if it does not describe it
+def _read_manifest(repopath, keypath):
+    try:
+        with open(_manifest_path(repopath)) as f:
+            man = json.load(f)
+        ist = (repopath / "APKINDEX.tar.gz").stat()
+    except (OSError, ValueError):
+        return None
+    if man.get("index") != [ist.st_size, ist.st_mtime_ns]:
+        return None
+    if man.get("key") != (str(keypath) if keypath else None):
+        return None
+    if not isinstance(man.get("files"), dict):
+        return None
+    return man
+
+
+def _split_fname(fn):
+    pf = fn[:-4]
+    rd = pf.rfind("-")
+    if rd > 0:
+        rd = pf.rfind("-", 0, rd)
+    return pf[0:rd], pf[rd + 1 :]
+
+
+# update the index in place: the entries of unchanged packages are taken
+# from the current index, and only the added packages are read by apk
+def _update_index(repopath, files, oldfiles, keypath, epoch):
+    added = sorted(fn for fn in files if oldfiles.get(fn) != files[fn])
+    dropped = set(
+        _split_fname(fn) for fn in oldfiles if files.get(fn) != oldfiles[fn]
+    )
+    env = {"PATH": os.environ["PATH"], "SOURCE_DATE_EPOCH": str(epoch)}
+    tpath = repopath / f".APKINDEX.{os.getpid()}.tar.gz"
+
+    try:
+        with open(repopath / "APKINDEX.tar.gz", "rb") as f:
+            old = f.read()
+        new = None
+        if len(added) > 0:
+            if (
+                call(
+                    "mkndx",
+                    ["--quiet", "--output", tpath.name, *added],
+                    None,
+                    cwd=repopath,
+                    env=env,
+                    allow_untrusted=True,
+                ).returncode
+                != 0
+            ):
+                return False
+            new = tpath.read_bytes()
+        data = aindex.merge(old, new, dropped)
+        if not data:
+            return False
+        tpath.write_bytes(data)
+        if keypath and (
+            call(
+                "adbsign",
+                ["--quiet", "--sign-key", keypath, tpath.name],
+                None,
+                cwd=repopath,
+                env=env,
+            ).returncode
+            != 0
+        ):
+            return False
+        tpath.rename(repopath / "APKINDEX.tar.gz")
+    finally:
+        tpath.unlink(missing_ok=True)
+
+    return True
+
+
 def build_index(repopath, epoch, allow_untrusted=False):
     repopath = pathlib.Path(repopath)
 
@@ -382,7 +513,23 @@ def build_index(repopath, epoch, allow_untrusted=False):
     if keypath:
         aargs += ["--sign-key", keypath]
 
-    summarize_repo(repopath, aargs)
+    scan = _scan_repo(repopath)
+    flist = []
+    summarize_repo(repopath, flist, scan=scan)
+    files = {fn: list(scan[fn]) for fn in flist}
+
+    # the index is only extended or shrunk when possible, as with a large
+    # repository most of the work would be redoing the unchanged entries;
+    # those do not depend on the epoch, only the index as a whole does
+    man = _read_manifest(repopath, keypath)
+    if man and man["files"] == files and man.get("epoch") == epoch:
+        return True
+    if man and _update_index(repopath, files, man["files"], keypath, epoch):
+        aindex.invalidate(repopath / "APKINDEX.tar.gz")
+        _write_manifest(repopath, files, keypath, epoch)
+        return True
+
+    aargs += flist
 
     signr = call(
         "mkndx",
@@ -392,10 +539,16 @@ def build_index(repopath, epoch, allow_untrusted=False):
         env={"PATH": os.environ["PATH"], "SOURCE_DATE_EPOCH": str(epoch)},
         allow_untrusted=not keypath,
     )
+    # make sure nothing uses a stale in-process copy
+    aindex.invalidate(repopath / "APKINDEX.tar.gz")
+
     if signr.returncode != 0:
+        _manifest_path(repopath).unlink(missing_ok=True)
         logger.get().out_red("Indexing failed!")
         return False
 
+    _write_manifest(repopath, files, keypath, epoch)
+
     return True
 
 
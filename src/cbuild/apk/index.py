@@ -0,0 +1,527 @@
+# Native readers for apk repository indexes and the installed database
+#
+# This is used to answer simple queries (versions of a name, providers
+# of a name) without spawning apk for every single one. The indexes are
+# loaded once per run and reloaded whenever the file changes on disk.
+# Anything that cannot be handled here (remote repositories, unknown
+# formats) is signaled by returning None, and callers use apk instead.
+
+import io
+import zlib
+import pathlib
+import struct
+import tarfile
+import functools
+
+# adb value types
+_ADB_TYPE_INT = 0x1
+_ADB_TYPE_INT_32 = 0x2
+_ADB_TYPE_INT_64 = 0x3
+_ADB_TYPE_BLOB_8 = 0x8
+_ADB_TYPE_BLOB_16 = 0x9
+_ADB_TYPE_BLOB_32 = 0xA
+_ADB_TYPE_ARRAY = 0xD
+_ADB_TYPE_OBJECT = 0xE
+
+# adb block types
+_ADB_BLOCK_ADB = 0
+_ADB_BLOCK_EXT = 3
+
+# index object fields
+_ADBI_NDX_PACKAGES = 0x2
+
+# package info fields
+_ADBI_PI_NAME = 0x1
+_ADBI_PI_VERSION = 0x2
+_ADBI_PI_ORIGIN = 0x7
+_ADBI_PI_DEPENDS = 0xF
+_ADBI_PI_PROVIDES = 0x10
+_ADBI_PI_INSTALL_IF = 0x12
+
+# dependency fields
+_ADBI_DEP_NAME = 0x1
+_ADBI_DEP_VERSION = 0x2
+_ADBI_DEP_MATCH = 0x3
+
+# dependency match flags, as in apk_version.h
+_MATCH_EQUAL = 1
+_MATCH_LESS = 2
+_MATCH_GREATER = 4
+_MATCH_FUZZY = 8
+_MATCH_CONFLICT = 16
+
+_ndx_cache = {}
+
+
+class Package:
+    def __init__(self, name, version, origin, provides, depends, iif):
+        self.name = name
+        self.version = version
+        self.origin = origin if origin else name
+        # list of (name, version or None)
+        self.provides = provides
+        # lists of dependency strings
+        self.depends = depends
+        self.install_if = iif
+
+
+class Index:
+    def __init__(self, pkgs):
+        self.packages = pkgs
+        self.names = {}
+        self.providers = {}
+
+        for pkg in pkgs:
+            if pkg.name not in self.names:
+                self.names[pkg.name] = []
+            self.names[pkg.name].append(pkg)
+            for pn, pv in pkg.provides:
+                if pn not in self.providers:
+                    self.providers[pn] = []
+                self.providers[pn].append((pkg, pv))
+
+    # all versions of the given name, sorted, lowest first
+    def versions(self, name):
+        pkgs = self.names.get(name)
+        if not pkgs:
+            return []
+        return sort_versions(p.version for p in pkgs)
+
+    # all packages that provide the given name, with the version
+    # it is provided at (which is the package version for names)
+    def whatprovides(self, name):
+        ret = []
+        for pkg in self.names.get(name, []):
+            ret.append((pkg, pkg.version))
+        for pkg, pv in self.providers.get(name, []):
+            ret.append((pkg, pv))
+        return ret
+
+
+def sort_versions(vers):
+    from cbuild.apk import cli
+
+    vers = list(set(vers))
+    if len(vers) > 1:
+        vers.sort(
+            key=functools.cmp_to_key(
+                lambda a, b: cli.compare_version(a, b, False)
+            )
+        )
+    return vers
+
+
+def _dep_str(name, ver, match):
+    if match & _MATCH_CONFLICT:
+        pfx = "!"
+    else:
+        pfx = ""
+    if not ver:
+        return pfx + name
+    if match & _MATCH_FUZZY:
+        op = "~"
+    elif match & _MATCH_LESS and match & _MATCH_EQUAL:
+        op = "<="
+    elif match & _MATCH_GREATER and match & _MATCH_EQUAL:
+        op = ">="
+    elif match & _MATCH_LESS:
+        op = "<"
+    elif match & _MATCH_GREATER:
+        op = ">"
+    else:
+        op = "="
+    return f"{pfx}{name}{op}{ver}"
+
+
+class _Adb:
+    def __init__(self, buf):
+        self.buf = buf
+
+    def _u32(self, off):
+        return struct.unpack_from("<I", self.buf, off)[0]
+
+    def value(self, v):
+        vt = v >> 28
+        vv = v & 0x0FFFFFFF
+        if vt == 0:
+            return None
+        elif vt == _ADB_TYPE_INT:
+            return vv
+        elif vt == _ADB_TYPE_INT_32:
+            return self._u32(vv)
+        elif vt == _ADB_TYPE_INT_64:
+            return struct.unpack_from("<Q", self.buf, vv)[0]
+        elif vt == _ADB_TYPE_BLOB_8:
+            ln = self.buf[vv]
+            return bytes(self.buf[vv + 1 : vv + 1 + ln])
+        elif vt == _ADB_TYPE_BLOB_16:
+            ln = struct.unpack_from("<H", self.buf, vv)[0]
+            return bytes(self.buf[vv + 2 : vv + 2 + ln])
+        elif vt == _ADB_TYPE_BLOB_32:
+            ln = self._u32(vv)
+            return bytes(self.buf[vv + 4 : vv + 4 + ln])
+        elif vt == _ADB_TYPE_ARRAY or vt == _ADB_TYPE_OBJECT:
+            # objects and arrays are a count followed by slots,
+            # where the first slot is the count itself
+            num = self._u32(vv)
+            return [self._u32(vv + i * 4) for i in range(num)]
+        raise ValueError(f"unknown adb value type {vt:#x}")
+
+    def field(self, obj, idx):
+        if idx >= len(obj):
+            return None
+        return self.value(obj[idx])
+
+    def string(self, obj, idx):
+        v = self.field(obj, idx)
+        if v is None:
+            return None
+        return v.decode()
+
+
+def _adb_deps(adb, pobj, idx, with_ver):
+    ret = []
+    darr = adb.field(pobj, idx)
+    if not darr:
+        return ret
+    for dv in darr[1:]:
+        dobj = adb.value(dv)
+        if not dobj:
+            continue
+        dn = adb.string(dobj, _ADBI_DEP_NAME)
+        dver = adb.string(dobj, _ADBI_DEP_VERSION)
+        dm = adb.field(dobj, _ADBI_DEP_MATCH)
+        if dm is None:
+            dm = _MATCH_EQUAL if dver else 0
+        if with_ver:
+            ret.append((dn, dver))
+        else:
+            ret.append(_dep_str(dn, dver, dm))
+    return ret
+
+
+# the file header and the adb block of an index, None if not in the format
+def _adb_block(data):
+    # possibly compressed, only deflate is supported (no zstd in stdlib)
+    if data[0:4] == b"ADBd":
+        data = zlib.decompressobj(-15).decompress(data[4:])
+    elif data[0:4] == b"ADBc":
+        if data[4] != 1:
+            return None
+        data = zlib.decompressobj(-15).decompress(data[6:])
+
+    # the file header is the magic plus the schema
+    if data[0:4] != b"ADB.":
+        return None
+
+    off = 8
+    while off + 4 <= len(data):
+        tsz = struct.unpack_from("<I", data, off)[0]
+        btype = tsz >> 30
+        if btype == _ADB_BLOCK_EXT:
+            btype = tsz & 0x3FFFFFFF
+            rsize = struct.unpack_from("<Q", data, off + 8)[0]
+            hsize = 16
+        else:
+            rsize = tsz & 0x3FFFFFFF
+            hsize = 4
+        if rsize < hsize:
+            return None
+        if btype == _ADB_BLOCK_ADB:
+            return data[0:8], memoryview(data)[off + hsize : off + rsize]
+        # blocks are 8-byte aligned
+        off += (rsize + 7) & ~7
+
+    return None
+
+
+def _adb_root(buf):
+    adb = _Adb(buf)
+    # adb header is compat_ver, ver, reserved, followed by the root value
+    return adb, adb.value(struct.unpack_from("<I", buf, 4)[0])
+
+
+def _parse_adb(data):
+    blk = _adb_block(data)
+    if not blk:
+        return None
+
+    adb, root = _adb_root(blk[1])
+    if not root:
+        return []
+
+    pkgs = []
+    parr = adb.field(root, _ADBI_NDX_PACKAGES)
+    if not parr:
+        return pkgs
+
+    for pv in parr[1:]:
+        pobj = adb.value(pv)
+        if not pobj:
+            continue
+        pkgs.append(
+            Package(
+                adb.string(pobj, _ADBI_PI_NAME),
+                adb.string(pobj, _ADBI_PI_VERSION),
+                adb.string(pobj, _ADBI_PI_ORIGIN),
+                _adb_deps(adb, pobj, _ADBI_PI_PROVIDES, True),
+                _adb_deps(adb, pobj, _ADBI_PI_DEPENDS, False),
+                _adb_deps(adb, pobj, _ADBI_PI_INSTALL_IF, False),
+            )
+        )
+
+    return pkgs
+
+
+# writes adb data, made of values copied over from other adb data
+class _AdbWriter:
+    def __init__(self, hdr):
+        # compat version, version, reserved and the root value
+        self.buf = bytearray(hdr)
+
+    def _put(self, data, align):
+        self.buf += bytes(-len(self.buf) % align)
+        off = len(self.buf)
+        self.buf += data
+        return off
+
+    def slots(self, vtype, vals):
+        num = len(vals) + 1
+        data = struct.pack(f"<{num}I", num, *vals)
+        return (vtype << 28) | self._put(data, 4)
+
+    def copy(self, adb, v):
+        vt = v >> 28
+        vv = v & 0x0FFFFFFF
+        if vt == 0 or vt == _ADB_TYPE_INT:
+            return v
+        elif vt == _ADB_TYPE_INT_32:
+            data, align = adb.buf[vv : vv + 4], 4
+        elif vt == _ADB_TYPE_INT_64:
+            data, align = adb.buf[vv : vv + 8], 8
+        elif vt == _ADB_TYPE_BLOB_8:
+            data, align = adb.buf[vv : vv + 1 + adb.buf[vv]], 1
+        elif vt == _ADB_TYPE_BLOB_16:
+            ln = struct.unpack_from("<H", adb.buf, vv)[0]
+            data, align = adb.buf[vv : vv + 2 + ln], 2
+        elif vt == _ADB_TYPE_BLOB_32:
+            data, align = adb.buf[vv : vv + 4 + adb._u32(vv)], 4
+        elif vt == _ADB_TYPE_ARRAY or vt == _ADB_TYPE_OBJECT:
+            vals = adb.value(v)[1:]
+            return self.slots(vt, [self.copy(adb, sv) for sv in vals])
+        else:
+            raise ValueError(f"unknown adb value type {vt:#x}")
+        return (vt << 28) | self._put(data, align)
+
+
+# an index with the packages of the old one, except for the dropped
+# (name, version) pairs, plus all packages of the new one, sorted the way
+# apk sorts them; the result is compressed like the old index but not
+# signed, and it is None if either index is not in the adb format
+def merge(old, new, drop):
+    oblk = _adb_block(old)
+    nblk = _adb_block(new) if new else None
+    if not oblk or (new and not nblk):
+        return None
+
+    oadb, oroot = _adb_root(oblk[1])
+    srcs = [(oadb, oroot, drop)]
+    if nblk:
+        srcs.append((*_adb_root(nblk[1]), ()))
+
+    ents = []
+    for adb, root, skip in srcs:
+        parr = adb.field(root, _ADBI_NDX_PACKAGES) if root else None
+        for pv in (parr or [0])[1:]:
+            pobj = adb.value(pv)
+            if not pobj:
+                continue
+            pn = adb.string(pobj, _ADBI_PI_NAME)
+            pver = adb.string(pobj, _ADBI_PI_VERSION)
+            if (pn, pver) not in skip:
+                ents.append((pn, pver, adb, pv))
+
+    from cbuild.apk import cli
+
+    def _cmp(a, b):
+        if a[0] != b[0]:
+            return -1 if a[0].encode() < b[0].encode() else 1
+        return cli.compare_version(a[1], b[1], False)
+
+    ents.sort(key=functools.cmp_to_key(_cmp))
+
+    wr = _AdbWriter(oblk[1][0:4].tobytes() + bytes(4))
+    pkgs = wr.slots(_ADB_TYPE_ARRAY, [wr.copy(e[2], e[3]) for e in ents])
+    # anything else in the root (e.g. the description) is kept
+    rvals = list(oroot[1:]) if oroot else []
+    rvals += [0] * (_ADBI_NDX_PACKAGES - len(rvals))
+    rvals[_ADBI_NDX_PACKAGES - 1] = 0
+    rvals = [wr.copy(oadb, v) for v in rvals]
+    rvals[_ADBI_NDX_PACKAGES - 1] = pkgs
+    struct.pack_into("<I", wr.buf, 4, wr.slots(_ADB_TYPE_OBJECT, rvals))
+
+    hdr = struct.pack("<I", (_ADB_BLOCK_ADB << 30) | (len(wr.buf) + 4))
+    data = oblk[0] + hdr + wr.buf + bytes(-(len(wr.buf) + 4) % 8)
+
+    if old[0:4] == b"ADBd":
+        pfx = old[0:4]
+    elif old[0:4] == b"ADBc":
+        pfx = old[0:6]
+    else:
+        return bytes(data)
+    cobj = zlib.compressobj(wbits=-15)
+    return pfx + cobj.compress(data) + cobj.flush()
+
+
+# the v2 format, used by the installed database and old style indexes
+def _parse_text(text):
+    pkgs = []
+
+    def _split_prov(v):
+        eq = v.find("=")
+        if eq < 0:
+            return (v, None)
+        return (v[0:eq], v[eq + 1 :])
+
+    cur = {}
+
+    def _flush():
+        if "P" not in cur or "V" not in cur:
+            return
+        pkgs.append(
+            Package(
+                cur["P"],
+                cur["V"],
+                cur.get("o"),
+                [_split_prov(v) for v in cur.get("p", "").split()],
+                cur.get("D", "").split(),
+                cur.get("i", "").split(),
+            )
+        )
+
+    for ln in text.splitlines():
+        if len(ln) == 0:
+            _flush()
+            cur = {}
+            continue
+        if len(ln) < 2 or ln[1] != ":":
+            continue
+        cur[ln[0]] = ln[2:]
+
+    _flush()
+
+    return pkgs
+
+
+def _parse_v2(data):
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r:gz") as tf:
+        for mem in tf:
+            if mem.name == "APKINDEX":
+                return _parse_text(tf.extractfile(mem).read().decode())
+    return None
+
+
+def _load(path, parsef):
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+
+    skey = (st.st_ino, st.st_size, st.st_mtime_ns)
+    ent = _ndx_cache.get(path)
+    if ent and ent[0] == skey:
+        return ent[1]
+
+    try:
+        with open(path, "rb") as f:
+            pkgs = parsef(f.read())
+    except Exception:
+        pkgs = None
+
+    ndx = Index(pkgs) if pkgs is not None else None
+    _ndx_cache[path] = (skey, ndx)
+
+    return ndx
+
+
+def _parse_index(data):
+    if data[0:3] == b"ADB":
+        return _parse_adb(data)
+    elif data[0:2] == b"\x1f\x8b":
+        return _parse_v2(data)
+    return None
+
+
+def load_repo(repopath, arch):
+    return _load(repopath / arch / "APKINDEX.tar.gz", _parse_index)
+
+
+def load_installed(root):
+    return _load(
+        root / "usr/lib/apk/db/installed", lambda d: _parse_text(d.decode())
+    )
+
+
+# remote indexes are only fetched once per run
+def load_remote(url, arch):
+    import urllib.request
+
+    url = f"{url}/{arch}/APKINDEX.tar.gz"
+    if url in _ndx_cache:
+        return _ndx_cache[url][1]
+
+    try:
+        with urllib.request.urlopen(url, timeout=30) as f:
+            pkgs = _parse_index(f.read())
+    except Exception:
+        pkgs = None
+
+    ndx = Index(pkgs) if pkgs is not None else None
+    _ndx_cache[url] = (None, ndx)
+
+    return ndx
+
+
+def invalidate(path):
+    _ndx_cache.pop(path, None)
+
+
+# given repository arguments as produced by cli.collect_repos, get a list
+# of (repo, index) in priority order; None if any of them is not usable
+def get_repos(crepos, arch=None):
+    from cbuild.core import chroot
+
+    if not arch:
+        arch = chroot.host_cpu()
+
+    ret = []
+    nextrepo = False
+    for arg in crepos:
+        if arg == "--repository":
+            nextrepo = True
+            continue
+        if not nextrepo:
+            continue
+        nextrepo = False
+        # remote or in-chroot path
+        if "://" in arg or not arg.startswith("/"):
+            return None
+        ndx = load_repo(pathlib.Path(arg), arch)
+        if not ndx:
+            return None
+        ret.append((arg, ndx))
+
+    return ret
+
+
+# like apk search -e -a, i.e. a mapping of name to all available versions
+def search_versions(ndxs, names):
+    ret = {}
+    for pn in names:
+        vers = []
+        for repo, ndx in ndxs:
+            for pkg in ndx.names.get(pn, []):
+                vers.append(pkg.version)
+        if len(vers) > 0:
+            ret[pn] = sort_versions(vers)
+    return ret
@@ -115,6 +115,17 @@ def get_namever(pkgp):
     return pkgp[0:fdash], pkgp[fdash + 1 :]
 
 
+# a dependency string split into name, operator and version
+def split_dep(dep):
+    for i, c in enumerate(dep):
+        if c in "<>=~":
+            j = i + 1
+            if dep[j : j + 1] == "=":
+                j += 1
+            return dep[0:i], dep[i:j], dep[j:]
+    return dep, "", None
+
+
 def pkg_match(ver, pattern):
     sepidx = -1
 
@@ -0,0 +1,170 @@
+# A native implementation of apk version validation and comparison
+#
+# This follows the rules of apk-tools 3, i.e. a version is a number of
+# dot-separated digit groups (the first one being mandatory), optionally
+# followed by a single letter, any number of suffixes (each possibly with
+# a number), a commit hash after a tilde, and a revision
+
+import functools
+
+# token types, in the order they may appear
+_T_INITIAL_DIGIT = 0
+_T_DIGIT = 1
+_T_LETTER = 2
+_T_SUFFIX = 3
+_T_SUFFIX_NO = 4
+_T_COMMIT_HASH = 5
+_T_REVISION_NO = 6
+_T_END = 7
+_T_INVALID = 8
+
+# pre-release suffixes sort before the release, the rest after it
+_suffixes = {
+    "alpha": -4,
+    "beta": -3,
+    "pre": -2,
+    "rc": -1,
+    "cvs": 1,
+    "svn": 2,
+    "git": 3,
+    "hg": 4,
+    "p": 5,
+}
+
+
+def _span(s, i, chars):
+    j = i
+    while j < len(s) and s[j] in chars:
+        j += 1
+    return j
+
+
+_digits = "0123456789"
+_lower = "abcdefghijklmnopqrstuvwxyz"
+_hex = "0123456789abcdef"
+
+
+@functools.lru_cache(maxsize=16384)
+def _tokenize(ver):
+    toks = []
+
+    # the first component must be a number
+    i = _span(ver, 0, _digits)
+    if i == 0:
+        return ((_T_INVALID, ""),)
+    toks.append((_T_INITIAL_DIGIT, ver[0:i]))
+    tok = _T_INITIAL_DIGIT
+
+    while True:
+        if i >= len(ver):
+            toks.append((_T_END, ""))
+            break
+        c = ver[i]
+        if c in _lower:
+            if tok > _T_DIGIT:
+                break
+            tok = _T_LETTER
+            toks.append((tok, c))
+            i += 1
+            continue
+        elif c == ".":
+            if tok > _T_DIGIT:
+                break
+            tok = _T_DIGIT
+            i += 1
+        elif c in _digits:
+            if tok != _T_SUFFIX:
+                break
+            tok = _T_SUFFIX_NO
+        elif c == "_":
+            if tok > _T_SUFFIX_NO:
+                break
+            j = _span(ver, i + 1, _lower)
+            if ver[i + 1 : j] not in _suffixes:
+                break
+            tok = _T_SUFFIX
+            toks.append((tok, ver[i + 1 : j]))
+            i = j
+            continue
+        elif c == "~":
+            if tok >= _T_COMMIT_HASH:
+                break
+            j = _span(ver, i + 1, _hex)
+            if j == i + 1:
+                break
+            tok = _T_COMMIT_HASH
+            toks.append((tok, ver[i + 1 : j]))
+            i = j
+            continue
+        elif c == "-":
+            if tok >= _T_REVISION_NO or ver[i + 1 : i + 2] != "r":
+                break
+            tok = _T_REVISION_NO
+            i += 2
+        else:
+            break
+        # digits for the token
+        j = _span(ver, i, _digits)
+        if j == i:
+            break
+        toks.append((tok, ver[i:j]))
+        i = j
+
+    if toks[-1][0] != _T_END:
+        toks.append((_T_INVALID, ""))
+
+    return tuple(toks)
+
+
+def _token_cmp(tok, av, bv):
+    if tok == _T_DIGIT and (av[0] == "0" or bv[0] == "0"):
+        # leading zeroes mean the component is compared as a string
+        pass
+    elif tok in (_T_INITIAL_DIGIT, _T_DIGIT, _T_SUFFIX_NO, _T_REVISION_NO):
+        av = int(av)
+        bv = int(bv)
+    elif tok == _T_SUFFIX:
+        av = _suffixes[av]
+        bv = _suffixes[bv]
+    if av < bv:
+        return -1
+    elif av > bv:
+        return 1
+    return 0
+
+
+def validate(ver):
+    return _tokenize(ver)[-1][0] == _T_END
+
+
+@functools.lru_cache(maxsize=65536)
+def compare(v1, v2):
+    at = _tokenize(v1)
+    bt = _tokenize(v2)
+
+    i = 0
+    while True:
+        atok, aval = at[i]
+        btok, bval = bt[i]
+        if atok != btok or atok >= _T_END:
+            break
+        ret = _token_cmp(atok, aval, bval)
+        if ret != 0:
+            return ret
+        i += 1
+
+    # both ended or became invalid at the same point
+    if atok == btok:
+        return 0
+
+    # the leading components are equal, the longer version is greater
+    # unless it continues with a suffix indicating a pre-release
+    if atok == _T_SUFFIX and _suffixes[aval] < 0:
+        return -1
+    if btok == _T_SUFFIX and _suffixes[bval] < 0:
+        return 1
+    if atok > btok:
+        return -1
+    elif btok > atok:
+        return 1
+    return 0
@@ -1,10 +1,39 @@
 from cbuild.step import fetch, extract, prepare, patch, configure
 from cbuild.step import build as buildm, check, install, prepkg, pkg as pkgsm
 from cbuild.core import chroot, logger, dependencies, profile
-from cbuild.core import template, pkg as pkgm, errors
+from cbuild.core import template, pkg as pkgm, errors, outcache, trace
+from cbuild.core import srccache, history
 from cbuild.util import flock
 from cbuild.apk import cli as apk
 
+import time
+
+# builds in progress, those of missing dependencies after their parent
+_active = []
+
+
+def _cleanup(pkg, keep_temp):
+    if not keep_temp:
+        chroot.remove_autodeps(pkg.stage == 0, pkg.profile())
+        pkgm.remove_pkg_wrksrc(pkg)
+        pkgm.remove_pkg(pkg)
+        pkgm.remove_pkg_statedir(pkg)
+
+
+def _end_phase(pkg):
+    if pkg._phase_start:
+        name, start = pkg._phase_start
+        dur = time.monotonic() - start
+        pkg._phase_times[name] = pkg._phase_times.get(name, 0) + dur
+        pkg._phase_start = None
+
+
+def _set_phase(pkg, phase):
+    pkg.current_phase = phase
+    trace.phase(pkg, phase)
+    _end_phase(pkg)
+    pkg._phase_start = (phase, time.monotonic())
+
 
 def build(
     step,
@@ -17,6 +46,65 @@ def build(
     no_update=False,
     update_check=False,
     accept_checksums=False,
+    after_fetch=None,
+):
+    args = (
+        step,
+        pkg,
+        depmap,
+        chost,
+        dirty,
+        keep_temp,
+        check_fail,
+        no_update,
+        update_check,
+        accept_checksums,
+        after_fetch,
+    )
+
+    # the peak memory use and phase times are counted for each build
+    # separately, builds of missing dependencies happen within the phases
+    # of their parent and must not count towards it
+    parent = _active[-1] if _active else None
+    pphase = None
+    if parent and parent._phase_start:
+        pphase = parent._phase_start[0]
+        _end_phase(parent)
+    maxrss = chroot.get_maxrss()
+    chroot.set_maxrss(0)
+    _active.append(pkg)
+    try:
+        if not trace.enabled():
+            return _build(*args)
+
+        tmark = trace.mark()
+        try:
+            with trace.span(pkg.pkgname, "build", step=step):
+                try:
+                    _build(*args)
+                finally:
+                    trace.phase(pkg, None)
+        finally:
+            trace.save(pkg, tmark)
+    finally:
+        _active.pop()
+        chroot.set_maxrss(maxrss)
+        if pphase:
+            parent._phase_start = (pphase, time.monotonic())
+
+
+def _build(
+    step,
+    pkg,
+    depmap,
+    chost=False,
+    dirty=False,
+    keep_temp=False,
+    check_fail=False,
+    no_update=False,
+    update_check=False,
+    accept_checksums=False,
+    after_fetch=None,
 ):
     if chost:
         depn = "host-" + pkg.pkgname
@@ -31,7 +119,9 @@ def build(
     depmap[depn] = True
 
     pkg.install_done = False
-    pkg.current_phase = "setup"
+    pkg._phase_times = {}
+    pkg._phase_start = None
+    _set_phase(pkg, "setup")
     pkg.update_check = update_check
     pkg.accept_checksums = accept_checksums
 
@@ -78,9 +168,11 @@ def build(
     pkg.cwd.mkdir(exist_ok=True, parents=True)
 
     if not hasattr(pkg, "do_fetch"):
-        pkg.current_phase = "fetch"
+        _set_phase(pkg, "fetch")
         fetch.invoke(pkg)
-        pkg.current_phase = "setup"
+        _set_phase(pkg, "setup")
+        if after_fetch:
+            after_fetch()
 
         if step == "fetch":
             return
@@ -104,40 +196,68 @@ def build(
         ):
             chroot.update(pkg)
 
+    # with everything that goes into the build known, the packages may
+    # already be available from a previous build with the same inputs
+    ihash = None
+    if outcache.enabled() and step == "pkg" and pkg.stage > 0 and not dirty:
+        ihash = outcache.get_hash(pkg, check_fail)
+
+    if ihash:
+        with flock.lock(flock.stagelock(pkg), pkg):
+            repos = outcache.restore(pkg, ihash)
+            for repo in repos or []:
+                logger.get().out(f"Staging cached packages to {repo}...")
+                if not apk.build_index(repo, pkg.source_date_epoch):
+                    raise errors.CbuildException("indexing repositories failed")
+        if repos is not None:
+            _cleanup(pkg, keep_temp)
+            del depmap[depn]
+            return
+
     if hasattr(pkg, "do_fetch"):
-        pkg.current_phase = "fetch"
+        _set_phase(pkg, "fetch")
         fetch.invoke(pkg)
+        if after_fetch:
+            after_fetch()
 
         if step == "fetch":
             return
 
-    pkg.current_phase = "extract"
+    # a clean source tree may be restored from an earlier build
+    skey = None
+    if srccache.enabled() and pkg.stage > 0 and not dirty:
+        skey = srccache.get_key(pkg)
+        srccache.restore(pkg, skey)
+
+    _set_phase(pkg, "extract")
     extract.invoke(pkg)
     if step == "extract":
         return
 
-    pkg.current_phase = "prepare"
+    _set_phase(pkg, "prepare")
     prepare.invoke(pkg)
     if step == "prepare":
         return
 
-    pkg.current_phase = "patch"
+    _set_phase(pkg, "patch")
     patch.invoke(pkg)
+    if skey:
+        srccache.store(pkg, skey)
     if step == "patch":
         return
 
     pkg.cwd = oldcwd
     pkg.chroot_cwd = oldchd
 
-    pkg.current_phase = "configure"
+    _set_phase(pkg, "configure")
     configure.invoke(pkg, step)
     if step == "configure":
         return
-    pkg.current_phase = "build"
+    _set_phase(pkg, "build")
     buildm.invoke(pkg, step)
     if step == "build":
         return
-    pkg.current_phase = "check"
+    _set_phase(pkg, "check")
     check.invoke(pkg, step, check_fail)
     if step == "check":
         return
@@ -152,12 +272,12 @@ def build(
         pkgm.remove_pkg(pkg)
 
     # invoke install for main package
-    pkg.current_phase = "install"
+    _set_phase(pkg, "install")
     install.invoke(pkg, step)
     if step == "install":
         return
 
-    pkg.current_phase = "pkg"
+    _set_phase(pkg, "pkg")
     template.call_pkg_hooks(pkg, "init_pkg")
 
     for sp in pkg.subpkg_list:
@@ -166,6 +286,7 @@ def build(
     prepkg.invoke(pkg)
 
     pkg._stage = {}
+    pkg._stage_files = []
 
     # package gen + staging is a part of the same lock
     with flock.lock(flock.stagelock(pkg), pkg):
@@ -179,12 +300,17 @@ def build(
             logger.get().out(f"Staging new packages to {repo}...")
             if not apk.build_index(repo, pkg.source_date_epoch):
                 raise errors.CbuildException("indexing repositories failed")
-
-    # cleanup
-    if not keep_temp:
-        chroot.remove_autodeps(pkg.stage == 0, pkg.profile())
-        pkgm.remove_pkg_wrksrc(pkg)
-        pkgm.remove_pkg(pkg)
-        pkgm.remove_pkg_statedir(pkg)
+        if ihash:
+            outcache.store(ihash, pkg._stage_files)
+
+    _end_phase(pkg)
+    history.record(
+        pkg,
+        pkg._phase_times,
+        chroot.get_maxrss(),
+        sum(f.stat().st_size for f in pkg._stage_files),
+    )
+
+    _cleanup(pkg, keep_temp)
 
     del depmap[depn]
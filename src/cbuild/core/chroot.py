@@ -1,18 +1,28 @@
 import subprocess
+import contextlib
+import threading
+import atexit
+import select
+import signal
+import shlex
 import os
 import re
 import time
 import shutil
 import pathlib
+import json
 import binascii
 from tempfile import mkstemp, mkdtemp
 
-from cbuild.core import logger, paths, errors
-from cbuild.apk import cli as apki, sign as signi
-from cbuild.util import flock
+from cbuild.core import logger, paths, errors, trace
+from cbuild.apk import cli as apki, sign as signi, index as aindex
+from cbuild.util import flock, digest, cachestore
 
 _chroot_checked = False
 _chroot_ready = False
+_use_agent = False
+_agent_scope = 0
+_maxrss = 0
 
 
 def host_cpu():
@@ -24,6 +34,95 @@ def set_host(tgt):
     _host = tgt
 
 
+def set_agent(use_agent):
+    global _use_agent
+    _use_agent = use_agent
+    if not use_agent:
+        _stop_agent()
+
+
+# peak memory use (in kilobytes) of the processes run so far, as reported
+# when they are reaped; this includes everything they waited for in turn
+def get_maxrss():
+    return _maxrss
+
+
+def set_maxrss(v):
+    global _maxrss
+    _maxrss = v
+
+
+# reap the process ourselves rather than through subprocess, so that its
+# resource usage is known; returns None if it is still running
+def _reap(proc, block=True):
+    global _maxrss
+
+    if proc.returncode is not None:
+        return proc.returncode
+    pid, sts, ru = os.wait4(proc.pid, 0 if block else os.WNOHANG)
+    if pid != proc.pid:
+        return None
+    _maxrss = max(_maxrss, ru.ru_maxrss)
+    proc.returncode = os.waitstatus_to_exitcode(sts)
+    return proc.returncode
+
+
+def _wait(proc, timeout=None):
+    if timeout is None:
+        return _reap(proc)
+    tend = time.monotonic() + timeout
+    while _reap(proc, False) is None:
+        if time.monotonic() >= tend:
+            raise subprocess.TimeoutExpired(proc.args, timeout)
+        time.sleep(0.05)
+    return proc.returncode
+
+
+# like Popen.communicate, which would reap the process on its own
+def _communicate(proc, input):
+    ret = {}
+
+    def _read(name, f):
+        with f:
+            ret[name] = f.read()
+
+    thrs = []
+    for name in ["stdout", "stderr"]:
+        f = getattr(proc, name)
+        if f:
+            thrs.append(threading.Thread(target=_read, args=(name, f)))
+            thrs[-1].start()
+    if proc.stdin:
+        try:
+            with proc.stdin:
+                proc.stdin.write(input)
+        except BrokenPipeError:
+            pass
+    for thr in thrs:
+        thr.join()
+    return ret.get("stdout"), ret.get("stderr")
+
+
+# like subprocess.run, for the subset of it that we use
+def _run(args, input=None, capture_output=False, check=False, **kwargs):
+    if input is not None:
+        kwargs["stdin"] = subprocess.PIPE
+    if capture_output:
+        kwargs["stdout"] = subprocess.PIPE
+        kwargs["stderr"] = subprocess.PIPE
+    with subprocess.Popen(args, **kwargs) as proc:
+        try:
+            out, err = _communicate(proc, input)
+        except BaseException:
+            os.kill(proc.pid, signal.SIGKILL)
+            raise
+        finally:
+            _reap(proc)
+    if check and proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, args, out, err)
+    return subprocess.CompletedProcess(args, proc.returncode, out, err)
+
+
 def chroot_check(force=False):
     global _chroot_checked, _chroot_ready
 
@@ -283,7 +382,44 @@ def get_fakeroot(bootstrap):
     return "/.cbuild_fakeroot.sh"
 
 
-def _setup_dummy(rootp, archn):
+# exact versions of the templates the virtual provider stands for
+def _get_dummy_vers(archn):
+    from cbuild.core import metadata, template
+
+    def _get_ver(pkgn):
+        # metadata is cached across runs, so try that first
+        tinfo = metadata.get_basic(f"main/{pkgn}", archn)
+        if tinfo:
+            return f"{tinfo.pkgver}-r{tinfo.pkgrel}"
+        tobj = template.read_pkg(
+            f"main/{pkgn}",
+            archn,
+            True,
+            False,
+            (1, 1),
+            False,
+            False,
+            None,
+            ignore_missing=True,
+        )
+        return f"{tobj.pkgver}-r{tobj.pkgrel}"
+
+    ret = {}
+    for pkgn in [
+        "fortify-headers",
+        "libatomic-chimera",
+        "base-files",
+        "musl",
+        "llvm",
+    ]:
+        ret[pkgn] = _get_ver(pkgn)
+
+    metadata.save()
+
+    return ret
+
+
+def _setup_dummy(rootp, archn, vers):
     tmpd = mkdtemp()
     tmpd = pathlib.Path(tmpd)
 
@@ -302,27 +438,11 @@ def _setup_dummy(rootp, archn):
     # cause problems with some makedepends (e.g. static libraries for musl,
     # libunwind and so on depend on exact versions of their devel packages)
 
-    from cbuild.core import template
-
-    def _get_ver(pkgn):
-        tobj = template.read_pkg(
-            f"main/{pkgn}",
-            archn,
-            True,
-            False,
-            (1, 1),
-            False,
-            False,
-            None,
-            ignore_missing=True,
-        )
-        return f"{tobj.pkgver}-r{tobj.pkgrel}"
-
-    fortify_ver = _get_ver("fortify-headers")
-    atomic_ver = _get_ver("libatomic-chimera")
-    files_ver = _get_ver("base-files")
-    musl_ver = _get_ver("musl")
-    llvm_ver = _get_ver("llvm")
+    fortify_ver = vers["fortify-headers"]
+    atomic_ver = vers["libatomic-chimera"]
+    files_ver = vers["base-files"]
+    musl_ver = vers["musl"]
+    llvm_ver = vers["llvm"]
 
     provides = [
         f"base-files={files_ver}",
@@ -409,7 +529,25 @@ def _setup_dummy(rootp, archn):
         shutil.rmtree(tmpd)
 
 
+# bump when the prepared sysroot changes
+_sysroots = cachestore.Store("sysroots", 1)
+
+# per arch in this run
+_dummy_vers = {}
+
+
+def _sysroot_key(rootp, prof, vers):
+    hv = _sysroots.hasher(host_cpu(), prof.arch, prof.triplet)
+    for pkgn in sorted(vers):
+        hv.update(f"{pkgn}={vers[pkgn]}\0".encode())
+    # the keys have been set up already
+    digest.tree(hv, rootp / "etc/apk/keys")
+    return hv.hexdigest()
+
+
 def _prepare_arch(prof, dirty):
+    from cbuild.core import snapshot
+
     rootp = paths.bldroot() / prof.sysroot.relative_to("/")
     # drop the whole thing
     if rootp.exists() and not dirty:
@@ -419,8 +557,24 @@ def _prepare_arch(prof, dirty):
     logger.get().out(f"setting up sysroot for {prof.arch}...")
     initdb(rootp)
     setup_keys(rootp)
-    if not dirty:
-        _setup_dummy(rootp, prof.arch)
+    if dirty:
+        return
+
+    if prof.arch not in _dummy_vers:
+        _dummy_vers[prof.arch] = _get_dummy_vers(prof.arch)
+    vers = _dummy_vers[prof.arch]
+
+    # a clean sysroot with the virtual provider is the same every time
+    # for the same versions, so set it up once and copy it afterwards
+    cpath = _sysroots.get_dir(_sysroot_key(rootp, prof, vers))
+    if cpath.is_dir():
+        shutil.rmtree(rootp)
+        snapshot.clone_tree(cpath, rootp)
+        return
+
+    _setup_dummy(rootp, prof.arch, vers)
+
+    _sysroots.add(cpath, lambda tpath: snapshot.clone_tree(rootp, tpath))
 
 
 def prepare_arch(arch, dirty):
@@ -488,20 +642,131 @@ def remove_autodeps(bootstrapping, prof=None):
         raise errors.CbuildException("failed to remove autodeps")
 
 
+# number of updates performed and skipped in this run
+_update_stats = [0, 0]
+
+# remote repositories are considered current for as long as apk would
+# consider its cached index current
+_update_max_age = 4 * 60 * 60
+
+
+# the repositories each root uses, in order, along with the state of
+# their indexes (None for remote ones)
+def _update_state(pkg):
+    prof = pkg.profile()
+
+    rootps = [(paths.bldroot(), host_cpu())]
+    if prof.cross:
+        rootps.append(
+            (paths.bldroot() / prof.sysroot.relative_to("/"), prof.arch)
+        )
+
+    ret = {}
+    for rootp, arch in rootps:
+        repos = []
+        for r in apki.collect_repos(
+            pkg, False, arch, True, True, apki.get_network()
+        ):
+            if r == "--repository":
+                continue
+            if "://" in r:
+                repos.append((r, None))
+                continue
+            try:
+                st = (pathlib.Path(r) / arch / "APKINDEX.tar.gz").stat()
+            except FileNotFoundError:
+                continue
+            repos.append((r, [st.st_ino, st.st_size, st.st_mtime_ns]))
+        ret[str(rootp)] = {"arch": arch, "repos": repos}
+
+    return ret
+
+
+# an update is only needed when some index changed since the last one to
+# offer a newer version of something installed; the stage repository is
+# reindexed after every build, mostly with packages that are not installed
+def _update_current(pkg):
+    try:
+        with open(paths.bldroot() / ".cbuild_update_state") as f:
+            ost = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    remote = False
+    state = _update_state(pkg)
+    if state.keys() != ost["roots"].keys():
+        return False
+
+    for rootp, rst in state.items():
+        repos = dict(rst["repos"])
+        orepos = dict(ost["roots"][rootp]["repos"])
+        # the priority of the repositories that were there before
+        if [r for r in repos if r in orepos] != [
+            r for r in orepos if r in repos
+        ]:
+            return False
+        # repositories that are new or changed since the last update, the
+        # ones that went away offer nothing new
+        changed = []
+        for r, st in repos.items():
+            if st is None:
+                # remote, cannot be checked without fetching it
+                if r not in orepos:
+                    return False
+                remote = True
+            elif st != orepos.get(r):
+                changed.append(r)
+        if len(changed) == 0:
+            continue
+        inst = aindex.load_installed(pathlib.Path(rootp))
+        if not inst:
+            return False
+        for r in changed:
+            ndx = aindex.load_repo(pathlib.Path(r), rst["arch"])
+            if not ndx:
+                return False
+            for ipkg in inst.packages:
+                vers = ndx.versions(ipkg.name)
+                if len(vers) == 0:
+                    continue
+                if apki.compare_version(vers[-1], ipkg.version, False) > 0:
+                    return False
+
+    return not remote or (time.time() - ost["time"]) < _update_max_age
+
+
+def _update_done(pkg):
+    spath = paths.bldroot() / ".cbuild_update_state"
+    with open(spath, "w") as f:
+        json.dump({"time": time.time(), "roots": _update_state(pkg)}, f)
+
+
+def update_stats():
+    return tuple(_update_stats)
+
+
 def update(pkg):
     if not chroot_check():
         return
 
-    logger.get().out(
-        "cbuild: updating software in %s container..." % str(paths.bldroot())
-    )
-
     paths.prepare()
     repo_init()
 
     # reinit passwd/group
     _prepare_etc()
 
+    # nothing changed since the last update, so it would be a no-op
+    if not isinstance(pkg, str) and _update_current(pkg):
+        logger.get().out("cbuild: repositories unchanged, skipping update")
+        _update_stats[1] += 1
+        return
+
+    _update_stats[0] += 1
+
+    logger.get().out(
+        "cbuild: updating software in %s container..." % str(paths.bldroot())
+    )
+
     with flock.lock(flock.apklock(host_cpu())):
         apki.call_chroot("update", ["-q"], pkg, check=True, use_stage=True)
         apki.call_chroot(
@@ -516,6 +781,7 @@ def update(pkg):
 
     # not cross, so we don't care
     if not prof.cross:
+        _update_done(pkg)
         return
 
     rootp = paths.bldroot() / prof.sysroot.relative_to("/")
@@ -530,8 +796,320 @@ def update(pkg):
         ):
             raise errors.CbuildException("failed to update cross pkg database")
 
+    _update_done(pkg)
+
+
+# a sandbox that stays around and runs commands for us, so that we do not
+# have to set up a new one for every single command; it is started with
+# a given set of mounts and replaced whenever those change, and it only
+# lives within an agent scope (a template function with its own output
+# redirection), outside of which every command gets a fresh sandbox
+#
+# the agent is a shell loop reading command numbers from a fifo, each
+# command is a script in the control directory that sets up the working
+# directory, environment and redirections and then execs the command;
+# the agent itself has no standard streams, the command writes into fifos
+# which we copy into whatever our own output is at the time of the call
+# (or into files when the output is captured)
+#
+# once the command is done, anything it left running is killed and the
+# temporary directories are emptied, like they would be with a new sandbox
+_agent_script = """
+exec 3< /run/cbuild-agent/ctl
+while read -r n <&3; do
+    sh "/run/cbuild-agent/$n.sh" 3<&- < /dev/null
+    rc=$?
+    kill -KILL -1 2> /dev/null
+    rm -rf /tmp/* /tmp/.[!.]* /var/tmp/* /var/tmp/.[!.]* 2> /dev/null
+    echo "$n $rc" > /run/cbuild-agent/done
+done
+"""
+
+_agent = None
+_agent_lock = threading.Lock()
+
+
+class _AgentFailed(Exception):
+    pass
+
+
+class _Agent:
+    def __init__(self, key, bcmd, kpers, lldargs):
+        self.key = key
+        self.pid = os.getpid()
+        self.serial = 0
+        self.busy = False
+        self.ctldir = pathlib.Path(mkdtemp(prefix="cbuild-agent-"))
+        (self.ctldir / "agent.sh").write_text(_agent_script)
+        os.mkfifo(self.ctldir / "ctl")
+        os.mkfifo(self.ctldir / "done")
+        # opened read-write so that neither end ever blocks on open
+        self.ctlfd = os.open(self.ctldir / "ctl", os.O_RDWR)
+        self.donef = os.fdopen(os.open(self.ctldir / "done", os.O_RDWR), "rb")
+
+        bcmd = bcmd + ["--bind", self.ctldir, "/run/cbuild-agent"]
+        fdlist = []
+        if lldargs:
+            rfd, wfd = os.pipe()
+            os.write(wfd, "\n".join(lldargs).encode())
+            os.close(wfd)
+            fdlist.append(rfd)
+            bcmd += ["--ro-bind-data", str(rfd), "/tmp/cbuild-lld-args"]
+        bcmd += [kpers, "--", "sh", "/run/cbuild-agent/agent.sh"]
+
+        try:
+            self.proc = subprocess.Popen(
+                bcmd,
+                env={"PATH": "/usr/bin"},
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                pass_fds=tuple(fdlist),
+            )
+        except Exception:
+            self.stop()
+            raise
+        finally:
+            for fd in fdlist:
+                os.close(fd)
+
+    def alive(self):
+        return self.proc and _reap(self.proc, False) is None
+
+    # a fifo for the command to write into, along with our own write end
+    # so that it does not report end of file before the command opens it
+    def _fifo(self, path, tgt, fifos):
+        os.mkfifo(path)
+        rfd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        fifos[rfd] = (os.open(path, os.O_WRONLY | os.O_NONBLOCK), tgt)
+
+    # copy whatever is in the fifo, returns False at end of file
+    def _pump(self, rfd, fifos):
+        try:
+            data = os.read(rfd, 65536)
+        except BlockingIOError:
+            return True
+        if not data:
+            return False
+        tgt = fifos[rfd][1]
+        while data:
+            data = data[os.write(tgt, data) :]
+        return True
+
+    def run(self, argv, envs, wrkdir, fakeroot, capture, stdout, stderr, inp):
+        self.serial += 1
+        n = self.serial
+        cpath = self.ctldir / str(n)
+
+        fifos = {}
+        self.busy = True
+        try:
+            ret = self._run(
+                n,
+                cpath,
+                fifos,
+                argv,
+                envs,
+                wrkdir,
+                fakeroot,
+                capture,
+                stdout,
+                stderr,
+                inp,
+            )
+            self.busy = False
+            return ret
+        finally:
+            for rfd, (wfd, tgt) in fifos.items():
+                os.close(rfd)
+                if wfd is not None:
+                    os.close(wfd)
+            for sfx in [".o", ".e"]:
+                cpath.with_suffix(sfx).unlink(missing_ok=True)
+
+    def _run(
+        self,
+        n,
+        cpath,
+        fifos,
+        argv,
+        envs,
+        wrkdir,
+        fakeroot,
+        capture,
+        stdout,
+        stderr,
+        inp,
+    ):
+
+        # marks that the agent got to the command
+        script = [f": > /run/cbuild-agent/{n}.run"]
+        if wrkdir:
+            script.append(f"cd {shlex.quote(str(wrkdir))} || exit 1")
+        cmd = ["exec", "/usr/bin/env", "-i"]
+        cmd += [shlex.quote(f"{k}={v}") for k, v in envs.items()]
+        if fakeroot:
+            cmd += ["FAKEROOTDONTTRYCHOWN=1", "sh", get_fakeroot(False)]
+        cmd += [shlex.quote(str(v)) for v in argv]
+        if inp is not None:
+            cpath.with_suffix(".in").write_bytes(inp)
+            cmd.append(f"< /run/cbuild-agent/{n}.in")
+        if capture or stdout == subprocess.PIPE:
+            cmd.append(f"> /run/cbuild-agent/{n}.out")
+        else:
+            self._fifo(cpath.with_suffix(".o"), 1, fifos)
+            cmd.append(f"> /run/cbuild-agent/{n}.o")
+        if capture or stderr == subprocess.PIPE:
+            cmd.append(f"2> /run/cbuild-agent/{n}.err")
+        elif stderr == subprocess.STDOUT:
+            cmd.append("2>&1")
+        else:
+            self._fifo(cpath.with_suffix(".e"), 2, fifos)
+            cmd.append(f"2> /run/cbuild-agent/{n}.e")
+        script.append(" ".join(cmd))
+        cpath.with_suffix(".sh").write_text("\n".join(script) + "\n")
+
+        os.write(self.ctlfd, f"{n}\n".encode())
+
+        # wait for the command to finish, keeping an eye on the agent
+        while True:
+            rl, wl, xl = select.select([self.donef, *fifos], [], [], 1.0)
+            for rfd in rl:
+                if rfd is not self.donef:
+                    self._pump(rfd, fifos)
+            if self.donef in rl:
+                break
+            if not rl and not self.alive():
+                if cpath.with_suffix(".run").exists():
+                    raise errors.CbuildException("sandbox agent has died")
+                # never got to run anything, so it can be done without it
+                raise _AgentFailed()
+
+        rn, rc = self.donef.readline().decode().split()
+        if int(rn) != n:
+            raise errors.CbuildException("sandbox agent is out of sync")
+
+        # everything the command started is gone by now, take the rest
+        for rfd, (wfd, tgt) in fifos.items():
+            os.close(wfd)
+            fifos[rfd] = (None, tgt)
+        pending = list(fifos)
+        while pending and self.alive():
+            rl, wl, xl = select.select(pending, [], [], 1.0)
+            for rfd in rl:
+                if not self._pump(rfd, fifos):
+                    pending.remove(rfd)
+
+        def _read_out(sfx, captured):
+            sp = cpath.with_suffix(sfx)
+            if not captured:
+                return None
+            elif not sp.exists():
+                return b""
+            ret = sp.read_bytes()
+            sp.unlink()
+            return ret
+
+        out = _read_out(".out", capture or stdout == subprocess.PIPE)
+        err = _read_out(".err", capture or stderr == subprocess.PIPE)
+        for sfx in [".sh", ".in", ".run"]:
+            cpath.with_suffix(sfx).unlink(missing_ok=True)
+
+        return int(rc), out, err
+
+    def stop(self):
+        # without a writer an idle agent runs out of commands and exits on
+        # its own, letting the sandbox reap everything so its usage is known
+        os.close(self.ctlfd)
+        if not self.busy and getattr(self, "proc", None):
+            try:
+                _wait(self.proc, 5)
+            except subprocess.TimeoutExpired:
+                pass
+        if getattr(self, "proc", None) and self.alive():
+            # not through the popen object, which would reap it on its own
+            os.kill(self.proc.pid, signal.SIGTERM)
+            try:
+                _wait(self.proc, 5)
+            except subprocess.TimeoutExpired:
+                os.kill(self.proc.pid, signal.SIGKILL)
+                _reap(self.proc)
+        self.donef.close()
+        shutil.rmtree(self.ctldir, ignore_errors=True)
+
+
+def _stop_agent():
+    global _agent
+
+    with _agent_lock:
+        if _agent and _agent.pid == os.getpid():
+            _agent.stop()
+        _agent = None
+
+
+atexit.register(_stop_agent)
+
+
+# commands run within this may share a persistent sandbox, which is
+# stopped when the outermost scope is left
+@contextlib.contextmanager
+def agent_scope():
+    global _agent_scope
+
+    _agent_scope += 1
+    try:
+        yield
+    finally:
+        _agent_scope -= 1
+        if _agent_scope == 0:
+            _stop_agent()
+
 
-def enter(
+def _agent_key(bcmd, kpers, lldargs):
+    key = [str(v) for v in bcmd] + [kpers] + (lldargs if lldargs else [])
+    # recreated directories need a fresh set of mounts
+    for v in bcmd:
+        if isinstance(v, pathlib.Path):
+            try:
+                key.append(str(v.stat().st_ino))
+            except FileNotFoundError:
+                key.append("")
+    return tuple(key)
+
+
+def _enter_agent(
+    bcmd, kpers, lldargs, argv, envs, wrkdir, fakeroot, cap, so, se, inp
+):
+    global _agent
+
+    key = _agent_key(bcmd, kpers, lldargs)
+
+    with _agent_lock:
+        # inherited through a fork, leave it to the parent
+        if _agent and _agent.pid != os.getpid():
+            _agent = None
+        if _agent and (_agent.key != key or not _agent.alive()):
+            _agent.stop()
+            _agent = None
+        if not _agent:
+            _agent = _Agent(key, bcmd, kpers, lldargs)
+        try:
+            return _agent.run(argv, envs, wrkdir, fakeroot, cap, so, se, inp)
+        except BaseException:
+            # we cannot tell what state the agent is in
+            _agent.stop()
+            _agent = None
+            raise
+
+
+def enter(cmd, *args, **kwargs):
+    if not trace.enabled():
+        return _enter(cmd, *args, **kwargs)
+    with trace.span(cmd, "enter", argv=[cmd, *map(str, args)]):
+        return _enter(cmd, *args, **kwargs)
+
+
+def _enter(
     cmd,
     *args,
     capture_output=False,
@@ -635,7 +1213,7 @@ def enter(
         dest_bind = "--bind"
 
     if bootstrapping:
-        return subprocess.run(
+        return _run(
             [cmd, *args],
             env=envs,
             capture_output=capture_output,
@@ -701,6 +1279,42 @@ def enter(
     if not unshare_all:
         bcmd += ["--share-net"]
 
+    # run within the persistent sandbox if we can
+    if (
+        _use_agent
+        and _agent_scope > 0
+        and new_session
+        and not signkey
+        and not wrapper
+        and stdout in (None, subprocess.PIPE)
+        and stderr in (None, subprocess.PIPE, subprocess.STDOUT)
+    ):
+        try:
+            rc, rout, rerr = _enter_agent(
+                bcmd,
+                kpers,
+                lldargs,
+                [cmd, *args],
+                envs,
+                wrkdir,
+                fakeroot,
+                capture_output,
+                stdout,
+                stderr,
+                input,
+            )
+        except _AgentFailed:
+            # could not be started in this environment
+            logger.get().warn("sandbox agent failed, not using it")
+            set_agent(False)
+            rc = None
+        if rc is not None:
+            if check and rc != 0:
+                raise subprocess.CalledProcessError(
+                    rc, [cmd, *args], rout, rerr
+                )
+            return subprocess.CompletedProcess([cmd, *args], rc, rout, rerr)
+
     if wrkdir:
         bcmd.append("--chdir")
         bcmd.append(wrkdir)
@@ -748,7 +1362,7 @@ def enter(
     bcmd += args
 
     try:
-        return subprocess.run(
+        return _run(
             bcmd,
             env=envs,
             capture_output=capture_output,
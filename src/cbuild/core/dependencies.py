@@ -1,5 +1,5 @@
-from cbuild.core import logger, template, paths, chroot
-from cbuild.apk import util as autil, cli as apki
+from cbuild.core import logger, template, paths, chroot, snapshot, metadata
+from cbuild.apk import util as autil, cli as apki, index as aindex
 from cbuild.util import flock
 
 # avoid re-parsing same templates every time; the pkgver will
@@ -13,24 +13,36 @@ def _srcpkg_ver(pkgn, pkgb):
     if pkgn in _tcache:
         return _tcache[pkgn]
 
-    modv, tmplv = template.read_mod(
-        pkgn,
-        pkgb.profile().arch,
-        True,
-        False,
-        (1, 1),
-        False,
-        False,
-        None,
-        resolve=pkgb,
-        ignore_missing=True,
-        autopkg=True,
-    )
-    if not modv or not hasattr(modv, "pkgver") or not hasattr(modv, "pkgrel"):
+    tmpln = template.resolve_pkgname(pkgn, pkgb, True, True)
+    if not tmpln:
         return None
 
-    pver = getattr(modv, "pkgver")
-    prel = getattr(modv, "pkgrel")
+    # most templates do not need to be evaluated for this
+    sinfo = metadata.get_static(tmpln)
+    if sinfo:
+        pver = sinfo.pkgver
+        prel = sinfo.pkgrel
+    else:
+        modv, tmplv = template.read_mod(
+            tmpln,
+            pkgb.profile().arch,
+            True,
+            False,
+            (1, 1),
+            False,
+            False,
+            None,
+            ignore_missing=True,
+        )
+        if (
+            not modv
+            or not hasattr(modv, "pkgver")
+            or not hasattr(modv, "pkgrel")
+        ):
+            return None
+
+        pver = getattr(modv, "pkgver")
+        prel = getattr(modv, "pkgrel")
     if pver is None or prel is None:
         return None
 
@@ -217,6 +229,13 @@ def _get_vers(pkgs, pkg, sysp, arch):
 
     ret = {}
     with flock.lock(flock.apklock(arch if arch else chroot.host_cpu())):
+        # try without apk first, this works for local repositories
+        crepos = apki.collect_repos(
+            pkg, False, arch, True, True, apki.get_network()
+        )
+        ndxs = aindex.get_repos(crepos, arch)
+        if ndxs is not None:
+            return aindex.search_versions(ndxs, plist), crepos
         out, crepos = apki.call(
             "search",
             ["--from", "none", "-e", "-a"] + plist,
@@ -268,6 +287,17 @@ def _is_available(pkgn, pkgop, pkgv, pkg, vers, crepos, sysp, arch):
 
     # now check repos individually in priority order
     with flock.lock(flock.apklock(arch)):
+        ndxs = aindex.get_repos(crepos, arch)
+        if ndxs is not None:
+            for cr, ndx in ndxs:
+                pvers = ndx.versions(pkgn)
+                if len(pvers) == 0:
+                    continue
+                # highest priority repo takes all, with its best version
+                if autil.pkg_match(f"{pkgn}-{pvers[-1]}", ppat):
+                    return pvers[-1]
+                return None
+            return None
         for cr in crepos:
             if cr == "--repository":
                 continue
@@ -533,6 +563,16 @@ def install(pkg, origpkg, step, depmap, hostdep, update_check):
         except template.SkipPackage:
             pass
 
+    # the same set of dependencies may have been installed before
+    skey = None
+    if snapshot.enabled() and pkg.stage > 0:
+        if len(virt_deps) + len(host_binpkg_deps) + len(binpkg_deps) > 0:
+            skey = snapshot.get_key(
+                pkg, host_binpkg_deps, binpkg_deps, virt_deps
+            )
+            if snapshot.restore(pkg, skey):
+                return missing
+
     if len(virt_deps) > 0:
         _install_virt(pkg, virt_deps, len(binpkg_deps) > 0)
 
@@ -546,4 +586,7 @@ def install(pkg, origpkg, step, depmap, hostdep, update_check):
         with flock.lock(flock.apklock(tarch)):
             _install_from_repo(pkg, binpkg_deps, True)
 
+    if skey:
+        snapshot.store(pkg, skey)
+
     return missing
@@ -0,0 +1,229 @@
+# Git metadata of template directories
+#
+# Reproducible builds need the last commit touching a template directory
+# and its timestamp, and whether the directory has local changes. Asking
+# git about every template separately means a history walk each time, so
+# this resolves it for all template directories at once with a single log
+# of the history, which is cached per HEAD in the cache path (and updated
+# incrementally when HEAD moves forward). That gives the same commits as a
+# log of each directory only as long as the history is linear, so the log
+# is only walked up to the first merge, and directories not touched since
+# then are asked about separately. Local changes are likewise taken from a
+# single status of the whole tree, once per run.
+
+from cbuild.core import paths, errors
+from cbuild.util import flock
+
+import subprocess
+import pathlib
+import shutil
+import json
+import os
+
+# bump when the cache format changes
+_format = 2
+
+# None when not resolved yet, False when not in a git repository
+_top = None
+_prefix = None
+_dirs = None
+_complete = None
+_dirty = None
+
+
+def _git(*args, check=True):
+    ret = subprocess.run(["git", *args], capture_output=True, cwd=toplevel())
+    if ret.returncode != 0:
+        if not check:
+            return None
+        raise errors.CbuildException(f"git {args[0]} failed")
+    return ret.stdout.decode()
+
+
+# the git repository toplevel, or None if not in a repository
+def toplevel():
+    global _top
+    if _top is None:
+        _top = False
+        if shutil.which("git"):
+            ret = subprocess.run(
+                ["git", "rev-parse", "--show-toplevel"],
+                capture_output=True,
+                cwd=paths.distdir(),
+            )
+            if ret.returncode == 0:
+                _top = pathlib.Path(ret.stdout.decode().strip())
+    return _top or None
+
+
+# the path of the cports tree within the repository, or an empty string
+def _get_prefix():
+    global _prefix
+    if _prefix is None:
+        relp = paths.distdir().resolve().relative_to(toplevel().resolve())
+        _prefix = "" if str(relp) == "." else f"{relp}/"
+    return _prefix
+
+
+# yields the commit, its timestamp (or None) and the list of files touched
+# by it, for every commit of git log with the given args
+def log(*args, timestamps=True):
+    fmt = "%x00%H %ct" if timestamps else "%x00%H"
+    out = _git("log", "--no-renames", "--name-only", f"--format={fmt}", *args)
+    for chunk in out.split("\0")[1:]:
+        lines = chunk.split("\n")
+        hdr = lines[0].split()
+        fnames = [f for f in lines[1:] if len(f) > 0]
+        yield hdr[0], int(hdr[1]) if timestamps else None, fnames
+
+
+# the template directory a file (relative to the toplevel) belongs to, if any
+def _tdir(fname):
+    prefix = _get_prefix()
+    if not fname.startswith(prefix):
+        return None
+    pcomps = fname[len(prefix) :].split("/")
+    if len(pcomps) > 2:
+        return "/".join(pcomps[0:2])
+    return None
+
+
+def _get_cache():
+    return paths.cbuild_cache() / "gitmeta.json"
+
+
+def _load():
+    global _dirs, _complete
+
+    head = _git("rev-parse", "HEAD", check=False)
+    if not head:
+        # no commits
+        _dirs = {}
+        _complete = True
+        return
+    head = head.strip()
+
+    cpath = _get_cache()
+    cpath.parent.mkdir(parents=True, exist_ok=True)
+
+    with flock.lock(cpath.with_suffix(".lock")):
+        try:
+            with open(cpath) as f:
+                cache = json.load(f)
+            if cache["format"] != _format or cache["prefix"] != _get_prefix():
+                cache = None
+        except (OSError, ValueError, KeyError):
+            cache = None
+
+        if cache and cache["head"] == head:
+            _dirs = cache["dirs"]
+            _complete = cache["complete"]
+            return
+
+        # only the new commits are needed when moving forward
+        if cache and (
+            _git(
+                "merge-base", "--is-ancestor", cache["head"], head, check=False
+            )
+            is not None
+        ):
+            dirs = cache["dirs"]
+            complete = cache["complete"]
+            rng = f"{cache['head']}..{head}"
+        else:
+            dirs = {}
+            complete = True
+            rng = head
+
+        # past a merge, the last commit touching a directory depends on how
+        # git simplifies the history for it
+        merge = _git("rev-list", "--merges", "-n1", rng).strip()
+
+        newdirs = {}
+        for commit, ts, fnames in log(rng):
+            if commit == merge:
+                break
+            for tdir in map(_tdir, fnames):
+                if tdir and tdir not in newdirs:
+                    newdirs[tdir] = [commit, ts]
+        if merge:
+            dirs = newdirs
+            complete = False
+        else:
+            dirs.update(newdirs)
+
+        tpath = cpath.with_name(f".{cpath.name}.{os.getpid()}")
+        with open(tpath, "w") as f:
+            json.dump(
+                {
+                    "format": _format,
+                    "head": head,
+                    "prefix": _get_prefix(),
+                    "complete": complete,
+                    "dirs": dirs,
+                },
+                f,
+            )
+        tpath.rename(cpath)
+
+    _dirs = dirs
+    _complete = complete
+
+
+def _load_dirty():
+    global _dirty
+
+    _dirty = set()
+    out = _git(
+        "status",
+        "--porcelain",
+        "-z",
+        "--untracked-files=all",
+        "--",
+        _get_prefix() or ".",
+    )
+    ents = out.split("\0")
+    i = 0
+    while i < len(ents):
+        ent = ents[i]
+        i += 1
+        if len(ent) < 4:
+            continue
+        fnames = [ent[3:]]
+        # renames and copies are followed by the original path
+        if ent[0] in "RC":
+            fnames.append(ents[i])
+            i += 1
+        for tdir in map(_tdir, fnames):
+            if tdir:
+                _dirty.add(tdir)
+
+
+# the last commit touching the template directory and its timestamp (or
+# empty string and None when untracked) and whether it has local changes,
+# or None when not in a git repository
+def get(tpath):
+    top = toplevel()
+    if not top:
+        return None
+
+    try:
+        relp = str(
+            pathlib.Path(tpath).resolve().relative_to(paths.distdir().resolve())
+        )
+    except ValueError:
+        return None
+
+    if _dirs is None:
+        _load()
+    if _dirty is None:
+        _load_dirty()
+
+    if relp not in _dirs and not _complete:
+        out = _git("log", "-n1", "--format=%H %ct", "--", _get_prefix() + relp)
+        if out.strip():
+            commit, ts = out.split()
+            _dirs[relp] = [commit, int(ts)]
+
+    commit, ts = _dirs.get(relp, ["", None])
+    return commit, ts, relp in _dirty
@@ -0,0 +1,139 @@
+# A database of past builds
+#
+# Every successful package build is recorded with the time spent in each
+# build phase, the peak memory use of the processes it ran and the size of
+# the packages it produced. Bulk builds use the recorded durations to make
+# estimates, and to start the templates with the longest chain of builds
+# waiting on them first.
+
+from cbuild.core import paths
+
+import contextlib
+import sqlite3
+import heapq
+import json
+import time
+
+# how many of the most recent builds an estimate is averaged from
+_navg = 3
+
+_schema = """
+create table if not exists builds (
+    pkgname text not null,
+    arch text not null,
+    version text not null,
+    finished integer not null,
+    duration real not null,
+    phases text not null,
+    maxrss integer not null,
+    outsize integer not null
+)
+"""
+
+
+def _connect():
+    dbp = paths.cbuild_cache() / "history.db"
+    dbp.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(dbp, timeout=60)
+    conn.execute(_schema)
+    return conn
+
+
+# phases is a mapping of phase names to seconds, maxrss is in kilobytes
+def record(pkg, phases, maxrss, outsize):
+    try:
+        with contextlib.closing(_connect()) as conn, conn:
+            conn.execute(
+                "insert into builds values (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    pkg.pkgname,
+                    pkg.profile().arch,
+                    f"{pkg.pkgver}-r{pkg.pkgrel}",
+                    int(time.time()),
+                    sum(phases.values()),
+                    json.dumps(phases),
+                    maxrss,
+                    outsize,
+                ),
+            )
+    except sqlite3.Error as e:
+        pkg.log_warn(f"failed to record build history: {e}")
+
+
+# expected build duration in seconds for every template with a history
+def get_estimates(arch):
+    ret = {}
+    cnt = {}
+    try:
+        with contextlib.closing(_connect()) as conn:
+            rows = conn.execute(
+                "select pkgname, duration from builds where arch = ? "
+                "order by finished desc",
+                (arch,),
+            ).fetchall()
+    except sqlite3.Error:
+        return ret
+    for pkgname, dur in rows:
+        n = cnt.get(pkgname, 0)
+        if n >= _navg:
+            continue
+        cnt[pkgname] = n + 1
+        ret[pkgname] = ret.get(pkgname, 0) + dur
+    for pkgname in ret:
+        ret[pkgname] /= cnt[pkgname]
+    return ret
+
+
+# given the templates to build with their estimates, and the build deps of
+# every node in the graph, compute the longest chain of builds starting
+# at every node (including itself) and the next node in that chain
+def get_chains(ests, deps):
+    rdeps = {}
+    for pn in deps:
+        for d in deps[pn]:
+            rdeps.setdefault(d, []).append(pn)
+
+    chains = {}
+    nexts = {}
+
+    def _chain(pn):
+        if pn in chains:
+            return chains[pn]
+        # mark as visiting, so that cycles terminate
+        chains[pn] = 0
+        best = 0
+        for rd in sorted(rdeps.get(pn, [])):
+            cv = _chain(rd)
+            if cv > best:
+                best = cv
+                nexts[pn] = rd
+        chains[pn] = ests.get(pn, 0) + best
+        return chains[pn]
+
+    for pn in set(deps) | set(rdeps) | set(ests):
+        _chain(pn)
+
+    return chains, nexts
+
+
+# the nodes in the chain starting at the given node
+def get_path(start, nexts):
+    ret = [start]
+    while ret[-1] in nexts:
+        ret.append(nexts[ret[-1]])
+    return ret
+
+
+# order the nodes of a topological sorter so that out of the nodes that
+# can be built at any point, the one with the longest chain goes first
+def order(depg, chains):
+    ret = []
+    ready = []
+    depg.prepare()
+    while depg.is_active():
+        for pn in depg.get_ready():
+            heapq.heappush(ready, (-chains.get(pn, 0), pn))
+        pn = heapq.heappop(ready)[1]
+        ret.append(pn)
+        depg.done(pn)
+    return ret
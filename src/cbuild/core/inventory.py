@@ -0,0 +1,136 @@
+# A single pass inventory of a package destdir
+#
+# Most hooks after installation need to look at every file in the package.
+# Instead of each of them walking the tree again, it is scanned once and
+# the results (stat info, ELF info, start of the file) are kept here. The
+# hooks that modify the tree report what they changed, so that only those
+# entries are looked at again.
+
+from cbuild.core import scanelf
+
+import os
+import stat
+import pathlib
+
+
+class Entry:
+    def __init__(self, inv, relp, st):
+        self.relpath = relp
+        self.path = inv.root / relp
+        self.stat = st
+        self._elf = False
+        self._head = None
+
+    @property
+    def name(self):
+        return self.relpath.name
+
+    def is_dir(self):
+        return stat.S_ISDIR(self.stat.st_mode)
+
+    def is_file(self):
+        return stat.S_ISREG(self.stat.st_mode)
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self.stat.st_mode)
+
+    # the first few bytes, enough to identify archives and shebangs
+    def head(self):
+        if self._head is None:
+            if not self.is_file():
+                self._head = b""
+            else:
+                with open(self.path, "rb") as f:
+                    self._head = f.read(9)
+        return self._head
+
+    # same as scanelf's _scan_one, for non-empty regular files
+    def elf(self):
+        if self._elf is False:
+            if not self.is_file() or self.stat.st_size == 0:
+                self._elf = None
+            else:
+                self._elf = scanelf._scan_one(self.path)
+        return self._elf
+
+
+class Inventory:
+    def __init__(self, root):
+        self.root = root
+        self._entries = None
+
+    # in the same order as root.rglob("*") would produce
+    def _walk(self, relp, ents):
+        subdirs = []
+        with os.scandir(self.root / relp) as it:
+            for de in it:
+                crel = relp / de.name
+                ent = Entry(self, crel, de.stat(follow_symlinks=False))
+                ents[str(crel)] = ent
+                if ent.is_dir():
+                    subdirs.append(crel)
+        for d in subdirs:
+            self._walk(d, ents)
+
+    def _get(self):
+        if self._entries is None:
+            self._entries = {}
+            if self.root.is_dir():
+                self._walk(pathlib.Path(), self._entries)
+        return self._entries
+
+    # a snapshot, so the tree may be changed while iterating
+    def entries(self):
+        return list(self._get().values())
+
+    # everything under the given relative path, excluding itself
+    def under(self, relp):
+        pfx = f"{relp}/" if str(relp) != "." else ""
+        return [v for k, v in self._get().items() if k.startswith(pfx)]
+
+    def get(self, relp):
+        return self._get().get(str(relp))
+
+    def _remove(self, relp):
+        ents = self._get()
+        ent = ents.pop(str(relp), None)
+        # only directories need the whole inventory looked at
+        if ent and not ent.is_dir():
+            return
+        for ent in self.under(relp):
+            del ents[str(ent.relpath)]
+
+    # the given path has changed in some way (it may have been created,
+    # modified or removed); with recursive, its contents are rescanned
+    def invalidate(self, relp, recursive=False):
+        if self._entries is None:
+            return
+        relp = pathlib.Path(relp)
+        if relp.is_absolute():
+            relp = relp.relative_to(self.root)
+        try:
+            st = (self.root / relp).lstat()
+        except FileNotFoundError:
+            self._remove(relp)
+            return
+        known = str(relp) in self._entries
+        if recursive:
+            self._remove(relp)
+        ent = Entry(self, relp, st)
+        self._entries[str(relp)] = ent
+        # new parent directories
+        if len(relp.parts) > 1 and str(relp.parent) not in self._entries:
+            self.invalidate(relp.parent)
+        # new or rescanned directories
+        if ent.is_dir() and (recursive or not known):
+            self._walk(relp, self._entries)
+
+    # forget everything, the next query will scan again
+    def reset(self):
+        self._entries = None
+
+
+def get(pkg):
+    if not pkg.inventory or pkg.inventory.root != pkg.destdir:
+        pkg.inventory = Inventory(pkg.destdir)
+    return pkg.inventory
@@ -0,0 +1,113 @@
+# Journal of bulk builds
+#
+# Every bulk build writes an append-only journal into the cache path, with
+# the input templates, the resolved dependency graph and the final state
+# of every template as it becomes known, along with a fingerprint of the
+# template directory at that point. An interrupted bulk build can then be
+# resumed from it: templates that were already finished (and have not been
+# changed since) are neither parsed nor looked up in the repositories
+# again, and their previous status is reported as is. As long as none of
+# the templates in the dependency graph changed, the graph is taken as it
+# was instead of resolving the dependencies again.
+
+from cbuild.core import paths
+from cbuild.util import digest
+
+import hashlib
+import json
+import time
+import os
+
+# states that are not worth retrying when nothing has changed
+_finished = ["ok", "done", "broken"]
+
+
+def get_path(arch):
+    return paths.cbuild_cache() / "bulk_journal" / f"{arch}.jsonl"
+
+
+def fingerprint(pn):
+    if not os.path.isdir(pn):
+        return None
+    hv = hashlib.sha256()
+    digest.tree(hv, pn)
+    return hv.hexdigest()
+
+
+class Journal:
+    def __init__(self, arch, statusf, resume=False):
+        self.path = get_path(arch)
+        self.statusf = statusf
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.f = open(self.path, "a" if resume else "w")
+
+    def _add(self, ent):
+        ent["time"] = int(time.time())
+        self.f.write(json.dumps(ent) + "\n")
+        self.f.flush()
+
+    def start(self, pkgs):
+        self._add({"type": "start", "pkgs": pkgs})
+
+    def graph(self, deps, flist):
+        tmpls = set(deps)
+        for dl in deps.values():
+            tmpls.update(dl)
+        fps = {pn: fingerprint(pn) for pn in sorted(tmpls)}
+        self._add({"type": "graph", "deps": deps, "flist": flist, "fps": fps})
+
+    # takes status lines, like the status file
+    def write(self, line):
+        self.statusf.write(line)
+        sl = line.split()
+        if len(sl) != 2:
+            return
+        pn, state = sl
+        self._add(
+            {"type": "state", "pkg": pn, "state": state, "fp": fingerprint(pn)}
+        )
+
+    def close(self):
+        self.f.close()
+        self.statusf.close()
+
+
+# the input templates of the last bulk build, the states of those that do
+# not need to be looked at again and the dependency graph with the list of
+# templates to build if it still holds, or None if there is no journal
+def load(arch):
+    pkgs = None
+    states = {}
+    graph = None
+    try:
+        with open(get_path(arch)) as f:
+            for ln in f:
+                try:
+                    ent = json.loads(ln)
+                except ValueError:
+                    # interrupted in the middle of a write
+                    continue
+                match ent["type"]:
+                    case "start":
+                        pkgs = ent["pkgs"]
+                    case "graph":
+                        graph = ent
+                    case "state":
+                        states[ent["pkg"]] = (ent["state"], ent["fp"])
+    except FileNotFoundError:
+        return None
+
+    if pkgs is None:
+        return None
+
+    finished = {}
+    for pn, (state, fp) in states.items():
+        if state in _finished and fingerprint(pn) == fp:
+            finished[pn] = state
+
+    if graph and all(fingerprint(pn) == fp for pn, fp in graph["fps"].items()):
+        graph = (graph["deps"], graph["flist"])
+    else:
+        graph = None
+
+    return pkgs, finished, graph
@@ -0,0 +1,438 @@
+# A persistent cache of template metadata
+#
+# Commands operating on the whole tree (graph commands, pruning, unbuilt
+# checks) need to evaluate every template, but only care about a handful
+# of fields. Those are stored in the cbuild cache, keyed by the contents
+# of the template directory, and the whole cache is invalidated whenever
+# anything in cbuild that may affect the result changes.
+#
+# Some of them only need the basic fields (name, version, subpackages),
+# which most templates assign as plain literals. Those are taken from the
+# syntax tree of the template without evaluating it, falling back to full
+# evaluation whenever any of them is computed.
+
+from cbuild.core import paths, template, errors
+from cbuild.util import digest
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import hashlib
+import ast
+import json
+import os
+
+# bump when the stored fields change
+_format = 2
+
+_caches = {}
+_statics = {}
+
+# fields taken from the syntax tree; sources are not among them, as their
+# site macros are only expanded when the template is evaluated
+_static_fields = [
+    "pkgname",
+    "pkgver",
+    "pkgrel",
+    "hostmakedepends",
+    "makedepends",
+    "checkdepends",
+    "depends",
+]
+
+
+class TemplateInfo:
+    def __init__(self, name, data):
+        self.template = name
+        self.pkgname = data["pkgname"]
+        self.pkgver = data["pkgver"]
+        self.pkgrel = data["pkgrel"]
+        self.repository = data["repository"]
+        self.source_repositories = data["source_repositories"]
+        self.maintainer = data["maintainer"]
+        self.broken = data["broken"]
+        self.all_subpackages = data["all_subpackages"]
+        self.source = data["source"]
+        self.sha256 = data["sha256"]
+        self.options = data["options"]
+        self.hostdepends = data["hostdepends"]
+        self.targetdepends = data["targetdepends"]
+        self.rundepends = data["rundepends"]
+
+    def get_build_deps(self):
+        return template.resolve_build_deps(
+            self.pkgname,
+            self.source_repositories,
+            self.hostdepends,
+            self.targetdepends,
+            self.rundepends,
+        )
+
+
+# a template read without evaluating it; fields other than the basic ones
+# may be None when computed
+class StaticInfo:
+    def __init__(self, name, fields, subpkgs):
+        self.template = name
+        self.repository = name.split("/")[0]
+        self.all_subpackages = subpkgs
+        for fld in _static_fields:
+            setattr(self, fld, fields.get(fld))
+
+
+# stands for any value that cannot be determined statically
+_computed = object()
+
+# methods that modify lists in place
+_mutators = ["append", "extend", "insert", "remove", "pop", "clear", "sort"]
+
+
+class _Computed(Exception):
+    pass
+
+
+def _eval(node, env):
+    match node:
+        case ast.Constant():
+            return node.value
+        case ast.List() | ast.Tuple():
+            return [_eval(v, env) for v in node.elts]
+        case ast.Dict() if None not in node.keys:
+            return {
+                _eval(k, env): _eval(v, env)
+                for k, v in zip(node.keys, node.values)
+            }
+        case ast.Name() if env.get(node.id, _computed) is not _computed:
+            return env[node.id]
+        case ast.JoinedStr():
+            ret = ""
+            for v in node.values:
+                match v:
+                    case ast.Constant():
+                        ret += v.value
+                    case ast.FormattedValue(conversion=-1, format_spec=None):
+                        ret += str(_eval(v.value, env))
+                    case _:
+                        raise _Computed()
+            return ret
+        case ast.BinOp(op=ast.Add()):
+            lhs = _eval(node.left, env)
+            rhs = _eval(node.right, env)
+            if type(lhs) is not type(rhs) or type(lhs) not in [str, list]:
+                raise _Computed()
+            return lhs + rhs
+    raise _Computed()
+
+
+def _try_eval(node, env):
+    try:
+        return _eval(node, env)
+    except _Computed:
+        return _computed
+
+
+def _is_subpkg_deco(deco):
+    match deco:
+        case ast.Call(func=ast.Name(id="subpackage")):
+            return True
+    return False
+
+
+def _read_static(pkgn):
+    try:
+        with open(paths.distdir() / pkgn / "template.py", "rb") as f:
+            tree = ast.parse(f.read())
+    except (OSError, SyntaxError, ValueError):
+        return None
+
+    env = {}
+    subpkgs = []
+    ndecos = 0
+
+    for st in tree.body:
+        match st:
+            case ast.Assign(targets=[ast.Name(id=name)]):
+                env[name] = _try_eval(st.value, env)
+            case ast.AugAssign(target=ast.Name(id=name), op=ast.Add()):
+                lhs = env.get(name, _computed)
+                rhs = _try_eval(st.value, env)
+                if (
+                    lhs is _computed
+                    or rhs is _computed
+                    or type(lhs) is not type(rhs)
+                    or type(lhs) not in [str, list]
+                ):
+                    env[name] = _computed
+                else:
+                    env[name] = lhs + rhs
+            case ast.FunctionDef():
+                for deco in st.decorator_list:
+                    if not _is_subpkg_deco(deco):
+                        continue
+                    ndecos += 1
+                    if len(deco.args) == 0:
+                        subpkgs = None
+                    elif subpkgs is not None:
+                        spn = _try_eval(deco.args[0], env)
+                        if not isinstance(spn, str):
+                            subpkgs = None
+                        else:
+                            subpkgs.append(spn)
+            case ast.Import() | ast.ImportFrom() | ast.Pass() | ast.Expr():
+                pass
+            case _:
+                # anything assigned conditionally or in a loop is computed
+                for node in ast.walk(st):
+                    match node:
+                        case ast.Name(ctx=ast.Store()):
+                            env[node.id] = _computed
+
+    # anything modified in place anywhere is computed too, and so are
+    # the subpackages when declared in any other way than at top level
+    nrefs = 0
+    for node in ast.walk(tree):
+        match node:
+            case ast.Name(id="subpackage"):
+                nrefs += 1
+            case ast.Global():
+                for name in node.names:
+                    env[name] = _computed
+            case ast.Attribute(value=ast.Name(id=name)) if (
+                node.attr in _mutators
+            ):
+                env[name] = _computed
+            case ast.Subscript(value=ast.Name(id=name)) if not isinstance(
+                node.ctx, ast.Load
+            ):
+                env[name] = _computed
+    if nrefs != ndecos:
+        subpkgs = None
+
+    fields = {}
+    for fld in _static_fields:
+        val = env.get(fld, None)
+        if val is not _computed:
+            fields[fld] = val
+
+    # the basic fields must be there
+    if subpkgs is None:
+        return None
+    if not isinstance(fields.get("pkgname"), str):
+        return None
+    if not isinstance(fields.get("pkgver"), str):
+        return None
+    if type(fields.get("pkgrel")) is not int:
+        return None
+
+    return StaticInfo(pkgn, fields, subpkgs)
+
+
+# the template read statically, or None if any basic field is computed
+def get_static(pkgn):
+    pkgn = _resolve_name(pkgn)
+    if pkgn not in _statics:
+        _statics[pkgn] = _read_static(pkgn)
+    return _statics[pkgn]
+
+
+def _get_data(tmpl):
+    from cbuild.core import dependencies
+
+    hds, tds, rds = dependencies.setup_depends(tmpl, True)
+
+    return {
+        "pkgname": tmpl.pkgname,
+        "pkgver": tmpl.pkgver,
+        "pkgrel": tmpl.pkgrel,
+        "repository": tmpl.repository,
+        "source_repositories": list(tmpl.source_repositories),
+        "maintainer": tmpl.maintainer,
+        "broken": tmpl.broken,
+        "all_subpackages": list(tmpl.all_subpackages),
+        "source": list(tmpl.source),
+        "sha256": list(tmpl.sha256),
+        "options": dict(tmpl.options),
+        "hostdepends": list(hds),
+        "targetdepends": list(tds),
+        "rundepends": [list(v) for v in rds],
+    }
+
+
+def read_data(pkgn, arch):
+    try:
+        tmpl = template.read_pkg(
+            pkgn,
+            arch,
+            True,
+            False,
+            (1, 1),
+            False,
+            False,
+            None,
+            target="lint",
+        )
+    except errors.PackageException:
+        return None
+
+    return _get_data(tmpl)
+
+
+def _get_salt(arch):
+    hv = hashlib.sha256()
+    hv.update(f"{_format}:{arch}:{' '.join(template.get_cats())}".encode())
+    # anything in core and build styles may change the evaluation
+    for sub in ["core", "build_style"]:
+        for f in sorted((paths.cbuild() / sub).glob("*.py")):
+            hv.update(f.name.encode() + b"\0")
+            digest.file(hv, f)
+    # the parent links decide source repositories
+    for cat in sorted(paths.distdir().iterdir()):
+        pl = cat / ".parent"
+        if pl.is_symlink():
+            hv.update(f"{cat.name}:{os.readlink(pl)}".encode())
+    return hv.hexdigest()
+
+
+class _Cache:
+    def __init__(self, arch):
+        self.path = paths.cbuild_cache() / "metadata" / f"{arch}.json"
+        self.salt = _get_salt(arch)
+        self.entries = {}
+        self.hashes = {}
+        self.dirty = False
+
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if data.get("salt") == self.salt:
+            self.entries = data.get("templates", {})
+
+    def save(self):
+        if not self.dirty:
+            return
+        # prune templates that are gone
+        for pn in list(self.entries):
+            if not (paths.distdir() / pn / "template.py").is_file():
+                del self.entries[pn]
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tpath = self.path.with_name(f".{self.path.name}.{os.getpid()}")
+        with open(tpath, "w") as f:
+            json.dump({"salt": self.salt, "templates": self.entries}, f)
+        os.replace(tpath, self.path)
+        self.dirty = False
+
+
+def _get_cache(arch):
+    if arch not in _caches:
+        _caches[arch] = _Cache(arch)
+    return _caches[arch]
+
+
+def _resolve_name(pkgn):
+    tpath = paths.distdir() / pkgn / "template.py"
+    if not tpath.is_file():
+        raise errors.CbuildException(f"missing template for '{pkgn}'")
+    tmplp = (paths.distdir() / pkgn).resolve()
+    return str(tmplp.relative_to(paths.distdir()))
+
+
+def _get_hash(cache, pkgn):
+    thash = cache.hashes.get(pkgn)
+    if not thash:
+        # the whole directory, as templates may refer to other files
+        hv = hashlib.sha256()
+        digest.tree(hv, paths.distdir() / pkgn)
+        thash = hv.hexdigest()
+        cache.hashes[pkgn] = thash
+    return thash
+
+
+# templates cannot be evaluated in threads, as reading them swaps out
+# builtins; the workers are forked so that they inherit all the global
+# state (paths, profiles, hooks) and they must return picklable results
+def map_templates(func, items, jobs):
+    ctx = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=ctx) as ex:
+        yield from zip(items, ex.map(func, items, chunksize=8))
+
+
+def _read_worker(arg):
+    pkgn, arch = arg
+    try:
+        return read_data(pkgn, arch)
+    except Exception:
+        # let it be reported when it is read again serially
+        return False
+
+
+# with basic, only prefetch what get_basic cannot get statically
+def prefetch(pkgns, arch, jobs, basic=False):
+    cache = _get_cache(arch)
+
+    todo = []
+    for pkgn in pkgns:
+        try:
+            pkgn = _resolve_name(pkgn)
+        except errors.CbuildException:
+            continue
+        ent = cache.entries.get(pkgn)
+        if ent and ent["hash"] == _get_hash(cache, pkgn):
+            continue
+        if basic and get_static(pkgn):
+            continue
+        todo.append((pkgn, arch))
+
+    # not worth it
+    if jobs <= 1 or len(todo) <= 1:
+        return
+
+    for (pkgn, arch), data in map_templates(_read_worker, todo, jobs):
+        if data is False:
+            continue
+        cache.entries[pkgn] = {"hash": _get_hash(cache, pkgn), "data": data}
+        cache.dirty = True
+
+
+def get(pkgn, arch):
+    cache = _get_cache(arch)
+    pkgn = _resolve_name(pkgn)
+
+    thash = _get_hash(cache, pkgn)
+    ent = cache.entries.get(pkgn)
+
+    if not ent or ent["hash"] != thash:
+        ent = {"hash": thash, "data": read_data(pkgn, arch)}
+        cache.entries[pkgn] = ent
+        cache.dirty = True
+
+    # templates that fail to parse are remembered as such
+    if not ent["data"]:
+        return None
+
+    return TemplateInfo(pkgn, ent["data"])
+
+
+# the basic fields of a template, read statically where possible; this
+# does not check whether the template is valid otherwise
+def get_basic(pkgn, arch):
+    cache = _get_cache(arch)
+    pkgn = _resolve_name(pkgn)
+
+    ent = cache.entries.get(pkgn)
+    if ent and ent["hash"] == _get_hash(cache, pkgn):
+        if not ent["data"]:
+            return None
+        return TemplateInfo(pkgn, ent["data"])
+
+    sinfo = get_static(pkgn)
+    if sinfo:
+        return sinfo
+
+    return get(pkgn, arch)
+
+
+def save():
+    for arch in _caches:
+        _caches[arch].save()
@@ -0,0 +1,133 @@
+# A content-addressed cache of build outputs
+#
+# Every build gets a hash of everything that goes into it: the template
+# directory, the full set of packages in the build root (and the cross
+# sysroot), the effective tool flags, cbuild itself, and a few global
+# settings. The packages produced by the build are stored under that hash,
+# and a later build with the same inputs restores them into the stage
+# repository instead of building again. The cache can be shared between
+# machines, as long as they use the same signing key.
+
+from cbuild.core import paths
+from cbuild.apk import index as aindex, util as autil, sign as asign
+from cbuild.util import digest, cachestore
+
+import shutil
+import json
+
+# bump when the hashed inputs change
+_store = cachestore.Store("outputs", 2)
+
+
+def set_enabled(enabled):
+    _store.enabled = enabled
+
+
+def enabled():
+    return _store.enabled
+
+
+def _hash_installed(hv, root):
+    ndx = aindex.load_installed(root)
+    if not ndx:
+        return False
+    for pkg in sorted(ndx.packages, key=lambda p: p.name):
+        hv.update(f"{pkg.name}={pkg.version}\0".encode())
+    return True
+
+
+# the input hash of the given template, or None if it cannot be computed
+def get_hash(pkg, check_fail):
+    prof = pkg.profile()
+    hv = _store.hasher(pkg.pkgname, prof.arch)
+
+    # the template itself, with patches and files
+    digest.tree(hv, pkg.template_path)
+    # and everything in cbuild (hooks, build styles, utilities...)
+    digest.tree(hv, paths.cbuild())
+
+    # what the build ran against
+    if not _hash_installed(hv, paths.bldroot()):
+        return None
+    if prof.cross:
+        hv.update(b"cross\0")
+        if not _hash_installed(
+            hv, paths.bldroot() / prof.sysroot.relative_to("/")
+        ):
+            return None
+
+    # effective flags for both target and host
+    for k in sorted(pkg.tool_flags):
+        hv.update(f"{k}={pkg.get_tool_flags(k)}\0".encode())
+    with pkg.profile("host"):
+        for k in sorted(pkg.tool_flags):
+            hv.update(f"BUILD_{k}={pkg.get_tool_flags(k)}\0".encode())
+
+    # global settings that affect the packages
+    kp = asign.get_keypath()
+    hv.update(f"dbg={pkg.build_dbg}\0".encode())
+    hv.update(f"comp={autil.get_compression()}\0".encode())
+    hv.update(f"key={kp.name if kp else ''}\0".encode())
+
+    # outputs of builds that did not pass their tests are kept apart
+    checked = (
+        not prof.cross
+        and (pkg.options["check"] or pkg._force_check)
+        and pkg.run_check
+    )
+    hv.update(f"check={checked}:{checked and check_fail}\0".encode())
+
+    return hv.hexdigest()
+
+
+def _get_path(ihash):
+    return _store.get_dir(ihash[0:2], ihash)
+
+
+# restore the packages for the given hash into the stage repository,
+# returning the list of repositories that were touched (or None on miss)
+def restore(pkg, ihash):
+    cpath = _get_path(ihash)
+    try:
+        with open(cpath / "manifest.json") as f:
+            files = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    stagebase = paths.stage_repository()
+    repos = {}
+
+    for relp in files:
+        if not (cpath / relp).is_file():
+            return None
+
+    for relp in files:
+        dest = stagebase / relp
+        pkg.log(f"restoring {dest.name} from output cache...")
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        dest.unlink(missing_ok=True)
+        shutil.copy2(cpath / relp, dest)
+        repos[dest.parent] = True
+
+    return list(repos)
+
+
+# store the given staged packages under the hash
+def store(ihash, files):
+    cpath = _get_path(ihash)
+    if cpath.is_dir():
+        return
+
+    stagebase = paths.stage_repository()
+
+    def _fill(tpath):
+        rels = []
+        for fp in files:
+            relp = fp.relative_to(stagebase)
+            (tpath / relp).parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(fp, tpath / relp)
+            rels.append(str(relp))
+        with open(tpath / "manifest.json", "w") as f:
+            json.dump(rels, f)
+
+    _store.add(cpath, _fill)
@@ -0,0 +1,98 @@
+# Fetching the sources of upcoming templates in the background
+#
+# In bulk builds, templates are otherwise fetched right before they are
+# built, with the builder idle while waiting for the network. With this,
+# a forked process fetches (and verifies) the sources of the next few
+# templates while the current one builds. It takes the same sources lock
+# as a regular fetch, so it never races with the build itself; to not
+# make the build wait for it, it is only started once the current one
+# has fetched its own sources. Any failure is left for the actual build
+# to report.
+
+from cbuild.core import paths, template
+from cbuild.util import flock
+
+import signal
+import sys
+import os
+
+
+class Prefetcher:
+    def __init__(self, logdir, accept_checksums=False):
+        self.logdir = logdir
+        self.accept_checksums = accept_checksums
+        self.pid = None
+        self.done = set()
+
+    def _fetch(self, pkgs):
+        for pkg in pkgs:
+            logp = self.logdir / f"{pkg.pkgname}.prefetch.log"
+            fd = os.open(logp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            # whatever is buffered belongs to the previous log
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(fd, 1)
+            os.dup2(fd, 2)
+            os.close(fd)
+            pkg.logger.use_colors = False
+            pkg.accept_checksums = self.accept_checksums
+            # hooks write their logs in here
+            pkg.statedir.mkdir(parents=True, exist_ok=True)
+            try:
+                with flock.lock(paths.sources() / "cbuild.lock", pkg):
+                    template.call_pkg_hooks(pkg, "do_fetch")
+            except Exception as e:
+                pkg.log_warn(f"prefetch failed: {e}")
+        # nothing is flushed on exit
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+    # whether the previous batch is still running
+    def busy(self):
+        if not self.pid:
+            return False
+        pid, status = os.waitpid(self.pid, os.WNOHANG)
+        if pid == 0:
+            return True
+        self.pid = None
+        return False
+
+    # fetch the given templates, unless done before; the list is
+    # expected to be the next few in the build order
+    def schedule(self, pkgs):
+        if self.busy():
+            return
+        # custom fetch functions need the build root
+        todo = [
+            p
+            for p in pkgs
+            if p.pkgname not in self.done and not hasattr(p, "do_fetch")
+        ]
+        if len(todo) == 0:
+            return
+        self.logdir.mkdir(parents=True, exist_ok=True)
+        for p in todo:
+            self.done.add(p.pkgname)
+        # so that the child does not write out our buffered output again
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            # do not turn these into exceptions, just go away
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                self._fetch(todo)
+            finally:
+                os._exit(0)
+        self.pid = pid
+
+    def stop(self):
+        if not self.pid:
+            return
+        try:
+            os.kill(self.pid, 15)
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+        self.pid = None
@@ -0,0 +1,94 @@
+# Templates to rebuild after changes to others
+#
+# A changed template affects everything that links against the shared
+# libraries its packages provide, which is known from the repositories.
+# When its packages are not in the repositories yet, everything that
+# builds against it directly is taken instead. The result is ordered by
+# the build dependencies, including those through templates that are not
+# rebuilt themselves.
+
+from cbuild.core import logger, errors
+from cbuild.apk import util as autil
+
+import graphlib
+
+
+# the origins with packages, the shared libraries provided by each origin
+# and the origins using each shared library, over the given indexes
+def _get_sonames(ndxs):
+    built = set()
+    provides = {}
+    consumers = {}
+    for ndx in ndxs:
+        for pkg in ndx.packages:
+            built.add(pkg.origin)
+            for prov, pv in pkg.provides:
+                if prov.startswith("so:"):
+                    provides.setdefault(pkg.origin, set()).add(prov)
+            for dep in pkg.depends:
+                dep = autil.split_dep(dep)[0]
+                if dep.startswith("so:"):
+                    consumers.setdefault(dep, set()).add(pkg.origin)
+    return built, provides, consumers
+
+
+# takes the changed templates, the metadata of every template by name and
+# the repository indexes, and returns the templates to rebuild in order
+def get(changed, infos, ndxs):
+    log = logger.get()
+
+    bynames = {}
+    deps = {}
+    rdeps = {}
+    for pn, info in infos.items():
+        bynames[info.pkgname] = pn
+        deps[pn] = info.get_build_deps()
+        for d in deps[pn]:
+            rdeps.setdefault(d, set()).add(pn)
+
+    built, provides, consumers = _get_sonames(ndxs)
+
+    rset = set()
+    for pn in changed:
+        info = infos.get(pn)
+        if not info:
+            log.warn(f"ignoring unknown template '{pn}'")
+            continue
+        rset.add(pn)
+        if info.pkgname not in built:
+            # nothing is known about what links to it, so take everything
+            # that builds against it directly
+            log.warn(f"'{pn}' is not in the repository, using its dependents")
+            rset |= rdeps.get(pn, set())
+            continue
+        for so in provides.get(info.pkgname, []):
+            for origin in consumers.get(so, []):
+                if origin != info.pkgname and origin in bynames:
+                    rset.add(bynames[origin])
+
+    # the nearest templates being rebuilt among the build dependencies
+    ancs = {}
+
+    def _get_ancs(pn):
+        if pn in ancs:
+            return ancs[pn]
+        ancs[pn] = set()
+        ret = set()
+        for d in deps.get(pn, []):
+            if d in rset:
+                ret.add(d)
+            else:
+                ret |= _get_ancs(d)
+        ancs[pn] = ret
+        return ret
+
+    tg = graphlib.TopologicalSorter()
+    for pn in sorted(rset):
+        tg.add(pn, *sorted(_get_ancs(pn) - {pn}))
+
+    try:
+        return list(tg.static_order())
+    except graphlib.CycleError as ce:
+        raise errors.CbuildException(
+            "cycle encountered: " + " <= ".join(ce.args[1])
+        )
@@ -260,7 +260,8 @@ def is_static(path):
 
 
 def scan(pkg, somap):
-    scandir = pkg.destdir
+    from cbuild.core import inventory
+
     elf_usrshare = []
     elf_textrels = []
     elf_xstack = []
@@ -273,21 +274,20 @@ def scan(pkg, somap):
         libcp = paths.bldroot() / rsroot / "usr/lib/libc.so"
         libc = _scan_one(libcp)
 
-    for fpath in scandir.rglob("*"):
-        st = fpath.lstat()
+    for ent in inventory.get(pkg).entries():
+        st = ent.stat
         # skip empty files, non-regular files
         if st.st_size == 0 or not stat.S_ISREG(st.st_mode):
             continue
         # try scan
-        scanned = _scan_one(fpath)
+        scanned = ent.elf()
         # not suitable
         if not scanned:
             continue
         # object file?
         if scanned[1] == "ET_REL":
             continue
-        # relativize path
-        fpath = fpath.relative_to(scandir)
+        fpath = ent.relpath
         # probably a container file
         if scanned[0] == 0:
             pkg.log_warn(f"ELF file with no machine type (container?): {fpath}")
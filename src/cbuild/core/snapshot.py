@@ -0,0 +1,203 @@
+# Snapshots of build roots with dependencies installed
+#
+# Installing the same large set of build dependencies over and over (e.g.
+# in bulk builds of related templates) is expensive. When enabled, the
+# build root is snapshotted after installing the dependencies, keyed by
+# the state of the root before the installation and the resolved set of
+# dependencies. A later build with the same key gets the snapshot copied
+# into its build root instead (as a reflink copy where the filesystem
+# supports it), provided nothing in it has been superseded by a newer
+# package in the local repositories since.
+
+from cbuild.core import paths, chroot
+from cbuild.apk import cli as apki, index as aindex
+from cbuild.util import digest, cachestore
+
+import shutil
+import fcntl
+import os
+
+# bump when the snapshot contents or key change
+_store = cachestore.Store("root_snapshots", 1)
+
+# FICLONE from linux/fs.h
+_FICLONE = 0x40049409
+
+# maximum number of snapshots to keep around, 0 means disabled
+_max = 0
+
+# never part of a snapshot; these are separate and keep their state
+_skip = ["builddir", "destdir"]
+
+
+def set_max(nsnap):
+    global _max
+    _max = nsnap
+
+
+def enabled():
+    return _max > 0
+
+
+def _clone_file(src, dst):
+    try:
+        with open(src, "rb") as sf, open(dst, "wb") as df:
+            fcntl.ioctl(df.fileno(), _FICLONE, sf.fileno())
+        shutil.copystat(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+# copy a tree, sharing the extents with the original where possible
+def clone_tree(src, dst):
+    shutil.copytree(src, dst, symlinks=True, copy_function=_clone_file)
+
+
+def _clone_entry(src, dst):
+    if src.is_symlink():
+        os.symlink(os.readlink(src), dst)
+    elif src.is_dir():
+        clone_tree(src, dst)
+    else:
+        _clone_file(src, dst)
+
+
+def _sysroot(root, prof):
+    return root / prof.sysroot.relative_to("/")
+
+
+def get_key(pkg, hdeps, tdeps, vdeps):
+    prof = pkg.profile()
+    root = paths.bldroot()
+    hv = _store.hasher(chroot.host_cpu(), prof.arch)
+
+    # the state the dependencies are installed on top of
+    digest.file(hv, root / "usr/lib/apk/db/installed", True)
+    digest.file(hv, root / "etc/apk/world", True)
+    if prof.cross:
+        digest.file(hv, _sysroot(root, prof) / "usr/lib/apk/db/installed", True)
+
+    for dl in [hdeps, tdeps, vdeps]:
+        hv.update(("\0".join(sorted(dl)) + "\1").encode())
+
+    # remote repositories cannot be checked package by package, so take
+    # the indexes apk has cached for them as a whole
+    for arch in sorted({chroot.host_cpu(), prof.arch}):
+        cdir = paths.cbuild_cache() / "apk" / arch
+        if not cdir.is_dir():
+            continue
+        for f in sorted(cdir.glob("APKINDEX.*")):
+            st = f.stat()
+            hv.update(f"{f.name}:{st.st_size}:{st.st_mtime_ns}\0".encode())
+
+    return hv.hexdigest()
+
+
+# whether any package in the snapshot has a newer version available locally
+def _is_stale(pkg, spath):
+    prof = pkg.profile()
+    roots = [(spath, chroot.host_cpu())]
+    if prof.cross:
+        roots.append((_sysroot(spath, prof), prof.arch))
+
+    for root, arch in roots:
+        ndx = aindex.load_installed(root)
+        if not ndx:
+            return True
+        ndxs = aindex.get_repos(
+            apki.collect_repos(pkg, False, arch, True, True, False), arch
+        )
+        if ndxs is None:
+            return True
+        for ipkg in ndx.packages:
+            for repo, rndx in ndxs:
+                for rpkg in rndx.names.get(ipkg.name, []):
+                    if apki.compare_version(rpkg.version, ipkg.version) > 0:
+                        return True
+
+    return False
+
+
+# clone the snapshot next to the build root contents, returning the names
+def _clone(pkg, spath, root):
+    if not spath.is_dir():
+        return None
+
+    if _is_stale(pkg, spath):
+        pkg.log("dependency snapshot is outdated, discarding...")
+        _store.remove(spath)
+        return None
+
+    pkg.log("restoring build root from dependency snapshot...")
+
+    # clone everything first, so a failure leaves the root intact
+    names = [n for n in os.listdir(spath) if n not in _skip]
+    try:
+        for n in names:
+            _clone_entry(spath / n, root / f".snap-{n}")
+    except OSError:
+        for n in names:
+            dst = root / f".snap-{n}"
+            if dst.is_dir() and not dst.is_symlink():
+                shutil.rmtree(dst, ignore_errors=True)
+            elif dst.exists() or dst.is_symlink():
+                dst.unlink()
+        pkg.log_warn("failed to restore dependency snapshot")
+        return None
+
+    _store.touch(spath)
+    return names
+
+
+# replace the build root contents with the snapshot, if there is one
+def restore(pkg, key):
+    sdir = _store.get_dir()
+    root = paths.bldroot()
+
+    if not (sdir / key).is_dir():
+        return False
+
+    with _store.lock(sdir, pkg):
+        names = _clone(pkg, sdir / key, root)
+    if names is None:
+        return False
+
+    # swap in the new contents
+    for n in os.listdir(root):
+        if n in _skip or n.startswith(".snap-"):
+            continue
+        old = root / n
+        if old.is_dir() and not old.is_symlink():
+            shutil.rmtree(old)
+        else:
+            old.unlink()
+    for n in names:
+        (root / f".snap-{n}").rename(root / n)
+
+    # the sandbox agent holds mounts on the old directories
+    chroot._stop_agent()
+
+    return True
+
+
+def store(pkg, key):
+    sdir = _store.get_dir()
+    spath = sdir / key
+    root = paths.bldroot()
+
+    if spath.is_dir():
+        return
+
+    pkg.log("saving dependency snapshot...")
+
+    def _fill(tpath):
+        tpath.mkdir()
+        for n in os.listdir(root):
+            if n not in _skip:
+                _clone_entry(root / n, tpath / n)
+
+    if not _store.add(spath, _fill):
+        return
+
+    with _store.lock(sdir, pkg):
+        _store.evict(sdir, _max)
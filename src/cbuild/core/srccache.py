@@ -0,0 +1,137 @@
+# A cache of extracted and patched source trees
+#
+# Extracting and patching large sources takes a while, and is repeated on
+# every rebuild even when neither the sources nor the patches changed (as
+# in revision bumps or rebuilds against updated dependencies). When this
+# is enabled, the source tree is saved after the patch step, keyed by all
+# that goes into it, and a later clean build with the same key gets the
+# tree copied back (as a reflink copy where the filesystem supports it),
+# skipping the extract, prepare and patch steps.
+
+from cbuild.core import paths, snapshot
+from cbuild.util import digest, cachestore
+
+import shutil
+import json
+import re
+import os
+
+# bump when the key or the cache layout change
+_store = cachestore.Store("wrksrc", 1)
+
+# a revision bump does not change the sources
+_pkgrel_re = re.compile(rb"^pkgrel = \d+$", re.MULTILINE)
+
+# steps covered by the cache, in order
+_steps = ["extract", "prepare", "patch"]
+
+
+def set_enabled(enabled):
+    _store.enabled = enabled
+
+
+def enabled():
+    return _store.enabled
+
+
+def _strip_pkgrel(relp, data):
+    if relp == "template.py":
+        return _pkgrel_re.sub(b"", data)
+    return data
+
+
+def get_key(pkg):
+    hv = _store.hasher(pkg.pkgname, pkg.pkgver, pkg.profile().arch)
+    hv.update(f"{pkg.wrksrc}\0".encode())
+    # the sources and their checksums as evaluated, with the template
+    # functions that extract, prepare and patch them
+    hv.update(
+        json.dumps(
+            [pkg.source, pkg.sha256, pkg.source_paths, pkg.patch_args],
+            default=str,
+        ).encode()
+    )
+    # the template with patches and files, minus the revision
+    digest.tree(hv, pkg.template_path, filt=_strip_pkgrel)
+    # and the parts of cbuild involved
+    cbp = paths.cbuild()
+    for relp in ["hooks/do_extract", "hooks/do_patch", "step", "util"]:
+        digest.tree(hv, cbp, relp)
+    if pkg.build_style:
+        digest.tree(hv, cbp, f"build_style/{pkg.build_style}.py")
+
+    return hv.hexdigest()
+
+
+def _get_dir(pkg):
+    return _store.get_dir(pkg.profile().arch, pkg.pkgname)
+
+
+def _stamps(pkg):
+    p = pkg.profile()
+    crossb = p.arch if p.cross else ""
+    return [pkg.statedir / f"{pkg.pkgname}_{crossb}_{s}_done" for s in _steps]
+
+
+# populate the source tree from the cache, marking the steps done
+def restore(pkg, key):
+    cdir = _get_dir(pkg)
+    cpath = cdir / key
+    wrksrc = pkg.builddir / pkg.wrksrc
+
+    if not (cpath / "wrksrc").is_dir():
+        return False
+
+    # only ever replace a fresh tree, anything else is unknown state
+    if any(s.exists() for s in _stamps(pkg)):
+        return False
+    if wrksrc.is_dir() and any(wrksrc.iterdir()):
+        return False
+
+    pkg.log("restoring source tree from cache...")
+
+    tpath = wrksrc.with_name(f".{wrksrc.name}.{os.getpid()}")
+    shutil.rmtree(tpath, ignore_errors=True)
+    # a build of another version may be dropping it meanwhile
+    with _store.lock(cdir, pkg):
+        try:
+            snapshot.clone_tree(cpath / "wrksrc", tpath)
+        except OSError:
+            shutil.rmtree(tpath, ignore_errors=True)
+            pkg.log_warn("failed to restore source tree from cache")
+            return False
+        _store.touch(cpath)
+
+    if wrksrc.is_dir():
+        wrksrc.rmdir()
+    tpath.rename(wrksrc)
+
+    for s in _stamps(pkg):
+        s.touch()
+
+    return True
+
+
+# save the source tree, provided all the steps were done
+def store(pkg, key):
+    cdir = _get_dir(pkg)
+    cpath = cdir / key
+    wrksrc = pkg.builddir / pkg.wrksrc
+
+    if cpath.is_dir():
+        return
+    if not all(s.is_file() for s in _stamps(pkg)) or not wrksrc.is_dir():
+        return
+
+    pkg.log("saving source tree to cache...")
+
+    def _fill(tpath):
+        tpath.mkdir()
+        snapshot.clone_tree(wrksrc, tpath / "wrksrc")
+
+    if not _store.add(cpath, _fill):
+        return
+
+    # source trees can be huge, so only keep the latest one per template
+    with _store.lock(cdir, pkg):
+        _store.evict(cdir, 1)
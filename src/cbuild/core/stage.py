@@ -1,25 +1,26 @@
 from cbuild.core import logger, paths, chroot, profile, template
 from cbuild.util import flock
-from cbuild.apk import cli
+from cbuild.apk import cli, index as aindex, util as autil
 
 import time
+import pathlib
 import subprocess
 
 
-# this one has the dummy root available
-def check_stage(arch, force=False, remote=False):
-    added = {}
-    dropped = {}
-    replaced = {}
-    revdeps = {}
+# queries on the repositories using apk, for when the indexes cannot be
+# read natively (e.g. remote ones with unsupported compression)
+class _ApkQuery:
+    def __init__(self, arch, rlist):
+        self.arch = arch
+        self.rlist = rlist
 
-    def _call_apk(*args):
+    def _call(self, *args):
         return subprocess.run(
             [
                 paths.apk(),
                 "--quiet",
                 "--arch",
-                arch,
+                self.arch,
                 "--allow-untrusted",
                 "--root",
                 paths.bldroot(),
@@ -28,6 +29,139 @@ def check_stage(arch, force=False, remote=False):
             capture_output=True,
         )
 
+    def _out(self, *args):
+        return self._call(*args).stdout.strip().decode().split()
+
+    def names(self, repo):
+        return self._out("--from", "none", "--repository", str(repo), "search")
+
+    def provides(self, repo, p):
+        return set(
+            self._out(
+                "--from",
+                "none",
+                "--repository",
+                str(repo),
+                "info",
+                "--provides",
+                p,
+            )
+        )
+
+    def rdepends(self, names):
+        return self._out(
+            *self.rlist,
+            "search",
+            "--from",
+            "none",
+            "--exact",
+            "--all",
+            "--rdepends",
+            *names,
+        )
+
+    def depends(self, p):
+        # go over each repo separately for robustness, break on first that
+        # actually does contain the package (will return at least a '\n')
+        for tryr in self.rlist:
+            if tryr == "--repository":
+                continue
+            ret = self._call(
+                "--repository", tryr, "info", "--from", "none", "--depends", p
+            )
+            if ret.returncode != 0 or len(ret.stdout) == 0:
+                # does not exist in this repo
+                continue
+            # get a list, which may be empty
+            return ret.stdout.strip().decode().split()
+        return []
+
+    def providers(self, name):
+        return self._out(
+            *self.rlist, "search", "--from", "none", "--all", "--exact", name
+        )
+
+
+# the same queries answered from the indexes loaded into memory
+class _IndexQuery:
+    def __init__(self, ndxs):
+        # list of (repo, index) in priority order
+        self.ndxs = ndxs
+        self.repos = dict(ndxs)
+        self._rdeps = None
+
+    def _best(self, ndx, name):
+        vers = ndx.versions(name)
+        if not vers:
+            return None
+        for pkg in ndx.names[name]:
+            if pkg.version == vers[-1]:
+                return pkg
+
+    def names(self, repo):
+        return sorted(self.repos[str(repo)].names)
+
+    def provides(self, repo, p):
+        pkg = self._best(self.repos[str(repo)], p)
+        if not pkg:
+            return set()
+        return set(f"{pn}={pv}" if pv else pn for pn, pv in pkg.provides)
+
+    def rdepends(self, names):
+        if self._rdeps is None:
+            self._rdeps = {}
+            for repo, ndx in self.ndxs:
+                for pkg in ndx.packages:
+                    for dep in pkg.depends:
+                        if dep.startswith("!"):
+                            continue
+                        dn = autil.split_dep(dep)[0]
+                        if dn not in self._rdeps:
+                            self._rdeps[dn] = set()
+                        self._rdeps[dn].add(pkg.name)
+        ret = set()
+        for pn in names:
+            ret.update(self._rdeps.get(pn, ()))
+        return sorted(ret)
+
+    def depends(self, p):
+        for repo, ndx in self.ndxs:
+            pkg = self._best(ndx, p)
+            if pkg:
+                return list(pkg.depends)
+        return []
+
+    # like apk search --exact, this matches package names only
+    def providers(self, name):
+        ret = []
+        for repo, ndx in self.ndxs:
+            for pkg in ndx.names.get(name, []):
+                ret.append(pkg.name)
+        return ret
+
+
+def _get_query(arch, rlist):
+    ndxs = []
+    for r in rlist:
+        if r == "--repository":
+            continue
+        if "://" in r:
+            ndx = aindex.load_remote(r, arch)
+        else:
+            ndx = aindex.load_repo(pathlib.Path(r), arch)
+        if not ndx:
+            return _ApkQuery(arch, rlist)
+        ndxs.append((r, ndx))
+    return _IndexQuery(ndxs)
+
+
+# this one has the dummy root available
+def check_stage(arch, force=False, remote=False):
+    added = {}
+    dropped = {}
+    replaced = {}
+    revdeps = {}
+
     # full repo list for revdep search
     rlist = []
 
@@ -89,38 +223,21 @@ def check_stage(arch, force=False, remote=False):
     for r in rr:
         rlist += ["--repository", str(r)]
 
+    # every index is read once, unless it cannot be
+    query = _get_query(arch, rlist)
+
     for d in rs:
         reld = str(d.relative_to(stagep))
         # only stage exists, so nothing is replacing anything
         ad = rrm.get(reld, None)
         if not ad:
             continue
-        # search for all staged packages
-        ret = _call_apk("--from", "none", "--repository", str(d), "search")
         # go over each staged package
-        for p in ret.stdout.strip().decode().split():
+        for p in query.names(d):
             # stage providers
-            pr = _call_apk(
-                "--from",
-                "none",
-                "--repository",
-                str(d),
-                "info",
-                "--provides",
-                p,
-            )
-            stpr = set(pr.stdout.strip().decode().split())
+            stpr = query.provides(d, p)
             # repo providers
-            pr = _call_apk(
-                "--from",
-                "none",
-                "--repository",
-                str(ad),
-                "info",
-                "--provides",
-                p,
-            )
-            rppr = set(pr.stdout.strip().decode().split())
+            rppr = query.provides(ad, p)
             # if they are the same, just skip
             if stpr == rppr:
                 continue
@@ -149,21 +266,7 @@ def check_stage(arch, force=False, remote=False):
 
     # for each dropped provider, get known revdeps and accumulate a set
     if len(dropped) > 0:
-        for pn in (
-            _call_apk(
-                *rlist,
-                "search",
-                "--from",
-                "none",
-                "--exact",
-                "--all",
-                "--rdepends",
-                *list(dropped.keys()),
-            )
-            .stdout.strip()
-            .decode()
-            .split()
-        ):
+        for pn in query.rdepends(list(dropped.keys())):
             revdeps[pn] = True
 
     # potentially missing deps
@@ -173,24 +276,8 @@ def check_stage(arch, force=False, remote=False):
     # ensure that there is no dependency on a provider that was dropped
     # without a replacement
     for d in revdeps:
-        # dependencies of the most significant (maybe staged) provider
-        deps = []
-        # go over each repo separately for robustness, break on first that
-        # actually does contain the package (will return at least a '\n')
-        for tryr in rlist:
-            if tryr == "--repository":
-                continue
-            ret = _call_apk(
-                "--repository", tryr, "info", "--from", "none", "--depends", d
-            )
-            if ret.returncode != 0 or len(ret.stdout) == 0:
-                # does not exist in this repo
-                continue
-            # get a list, which may be empty
-            deps = ret.stdout.strip().decode().split()
-            break
-        # verify each dep
-        for ad in deps:
+        # verify each dep of the most significant (maybe staged) provider
+        for ad in query.depends(d):
             av = None
             ao = None
             # check if versioned
@@ -226,13 +313,13 @@ def check_stage(arch, force=False, remote=False):
                 # do a constraint check for dropped
                 dv = dropped[ad]
                 if dv is not True:
-                    ret = _call_apk("version", "--test", av, dv).stdout.strip()
-                    if ret == b"<":
+                    ret = cli.compare_version(av, dv, False)
+                    if ret < 0:
                         # constraint ver is lower than provider ver
                         # skip constraints that ask for a smaller/equal version
                         if ao == "=" or ao.startswith("<"):
                             continue
-                    elif ret == b">":
+                    elif ret > 0:
                         # constraint ver is larger than provider ver
                         # skip constraints that ask for a larger/equal version
                         if ao == "=" or ao.startswith(">"):
@@ -245,12 +332,15 @@ def check_stage(arch, force=False, remote=False):
                 # the deleted constraint matched; now check if an added matches
                 nv = added.get(ad, None)
                 if nv is not None:
-                    ret = _call_apk("version", "--test", av, nv).stdout.strip()
-                    if ret == b"<":
+                    # unversioned provider, compares as equal
+                    ret = 0
+                    if nv is not True:
+                        ret = cli.compare_version(av, nv, False)
+                    if ret < 0:
                         # constraint ver is lower than provider ver
                         if ao.startswith(">"):
                             continue
-                    elif ret == b">":
+                    elif ret > 0:
                         # constraint ver is larger than provider ver
                         if ao.startswith("<"):
                             continue
@@ -269,12 +359,9 @@ def check_stage(arch, force=False, remote=False):
     # we are not dealing with something that still has another suitable
     # provider, as that should not stage us
     for d in list(checkdeps.keys()):
-        ret = _call_apk(
-            *rlist, "search", "--from", "none", "--all", "--exact", d
-        )
         # for each provider of sketchy dependency, if it's provided
         # using a name that was not deleted, it's probably okay
-        for pd in ret.stdout.strip().decode().split():
+        for pd in query.providers(d):
             if pd not in replaced:
                 del checkdeps[d]
                 break
@@ -18,7 +18,8 @@ import subprocess
 import builtins
 import stat
 
-from cbuild.core import logger, chroot, paths, profile, spdx, errors
+from cbuild.core import logger, chroot, paths, profile, spdx, errors, trace
+from cbuild.core import gitmeta
 from cbuild.util import compiler, flock
 from cbuild.apk import cli
 
@@ -163,7 +164,11 @@ def run_pkg_func(pkg, func, funcn=None, desc=None, on_subpkg=False):
     else:
         logf = pkg.statedir / f"{pkg.pkgname}_{crossb}_{funcn}.log"
     pkg.log(f"running {desc}...")
-    with redir_allout(pkg, logf):
+    with (
+        trace.span(funcn, "func", pkg=pkg.pkgname),
+        redir_allout(pkg, logf),
+        chroot.agent_scope(),
+    ):
         if on_subpkg:
             func()
         else:
@@ -191,6 +196,7 @@ class Package:
         self.pkgname = None
         self.pkgver = None
         self.alternative = None
+        self.inventory = None
 
     def log(self, msg, end="\n"):
         self.logger.out(self._get_pv() + ": " + msg, end)
@@ -695,41 +701,16 @@ class Template(Package):
         self.git_revision = None
         self.git_dirty = False
         self.current_sonames = {}
+        self.current_providers = {}
         self._license_install = False
 
     def get_build_deps(self):
         from cbuild.core import dependencies
 
-        def _resolve_bdep(opkg, depn):
-            for sr in opkg.source_repositories:
-                rp = paths.distdir() / sr
-                tp = rp / depn / "template.py"
-                if tp.is_file():
-                    pn = tp.resolve().parent.name
-                    return sr, pn
-            return None, None
-
-        bdeps = {}
-        visited = {}
         hds, tds, rds = dependencies.setup_depends(self, True)
-        for bd in hds + tds:
-            if bd in visited:
-                continue
-            visited[bd] = True
-            sr, pn = _resolve_bdep(self, bd)
-            # just ignore unresolved stuff here, it's ok for now
-            if sr:
-                bdeps[f"{sr}/{pn}"] = True
-        for orig, bd in rds:
-            if bd in visited:
-                continue
-            visited[bd] = True
-            sr, pn = _resolve_bdep(self, bd)
-            # we need to ignore subpackages depending on their neighbors
-            if sr and ((bd == orig) or (pn != self.pkgname)):
-                bdeps[f"{sr}/{pn}"] = True
-        # pre-sort it just in case
-        return sorted(bdeps.keys())
+        return resolve_build_deps(
+            self.pkgname, self.source_repositories, hds, tds, rds
+        )
 
     def dump(self):
         metadata = {}
@@ -784,50 +765,13 @@ class Template(Package):
 
         self.source_date_epoch = int(time.time())
 
-        if not shutil.which("git"):
-            # no git, not reproducible
-            return
-
-        if (
-            subprocess.run(
-                ["git", "rev-parse", "--show-toplevel"],
-                capture_output=True,
-                cwd=self.template_path,
-            ).returncode
-            != 0
-        ):
-            # not in a git repository
+        gmeta = gitmeta.get(self.template_path)
+        if not gmeta:
+            # no git or not in a git repository, not reproducible
             return
 
-        # find whether the template dir has local modifications
-        dirty = (
-            len(
-                subprocess.run(
-                    ["git", "status", "-s", "--", self.template_path],
-                    capture_output=True,
-                ).stdout.strip()
-            )
-            != 0
-        )
-
-        def _gitlog(fmt, tgt, pkg):
-            bargs = ["git", "log", "-n1", f"--format={fmt}"]
-            if pkg:
-                bargs += ["--", tgt]
-            else:
-                bargs.append(tgt)
-            return (
-                subprocess.run(bargs, capture_output=True)
-                .stdout.strip()
-                .decode("ascii")
-            )
-
-        # find the last revision modifying the template
-        grev = _gitlog("%H", self.template_path, True)
-
-        # 0 length means untracked in git
-        if len(grev) != 40 and len(grev) != 0:
-            self.error(f"invalid commit format for {self.template_path}")
+        # the last revision modifying the template, 0 length means untracked
+        grev, ts, dirty = gmeta
 
         self.git_revision = grev
         self.git_dirty = dirty
@@ -836,13 +780,7 @@ class Template(Package):
         if dirty or not grev:
             return
 
-        # get the date of the git revision
-        ts = _gitlog("%ct", grev, False)
-
-        try:
-            self.source_date_epoch = int(ts)
-        except ValueError:
-            self.error(f"invalid commit timestamp for {self.template_path}")
+        self.source_date_epoch = ts
 
     def build_lint(self):
         if self.broken:
@@ -1151,25 +1089,39 @@ class Template(Package):
         # otherwise we're good
 
     def is_built(self, quiet=False):
+        from cbuild.apk import index
+
         archn = self.profile().arch
         with flock.lock(flock.apklock(archn)):
-            pinfo = cli.call(
-                "search",
-                ["--from", "none", "-e", self.pkgname],
-                self.repository,
-                capture_output=True,
-                arch=archn,
-                allow_untrusted=True,
-                allow_network=False,
-                use_altrepo=False,
+            foundp = None
+            ndxs = index.get_repos(
+                cli.collect_repos(
+                    self.repository, False, archn, False, True, False
+                ),
+                archn,
             )
-            if pinfo.returncode == 0 and len(pinfo.stdout.strip()) > 0:
-                foundp = pinfo.stdout.strip().decode()
-                if foundp == f"{self.pkgname}-{self.pkgver}-r{self.pkgrel}":
-                    if self.origin_pkg == self and not quiet:
-                        # TODO: print the repo somehow
-                        self.log(f"found ({pinfo.stdout.strip().decode()})")
-                    return True
+            if ndxs is not None:
+                vers = index.search_versions(ndxs, [self.pkgname])
+                if self.pkgname in vers:
+                    foundp = f"{self.pkgname}-{vers[self.pkgname][-1]}"
+            else:
+                pinfo = cli.call(
+                    "search",
+                    ["--from", "none", "-e", self.pkgname],
+                    self.repository,
+                    capture_output=True,
+                    arch=archn,
+                    allow_untrusted=True,
+                    allow_network=False,
+                    use_altrepo=False,
+                )
+                if pinfo.returncode == 0 and len(pinfo.stdout.strip()) > 0:
+                    foundp = pinfo.stdout.strip().decode()
+            if foundp == f"{self.pkgname}-{self.pkgver}-r{self.pkgrel}":
+                if self.origin_pkg == self and not quiet:
+                    # TODO: print the repo somehow
+                    self.log(f"found ({foundp})")
+                return True
             return False
 
     def do(
@@ -1777,9 +1729,13 @@ class Subpackage(Package):
             # relative path to the file/dir in original destdir
             pdest = self.parent.destdir
             self.log(f"moving: {fullp} -> {self.destdir}")
-            _submove(
-                pathlib.Path(fullp).relative_to(pdest), self.destdir, pdest
-            )
+            relp = pathlib.Path(fullp).relative_to(pdest)
+            _submove(relp, self.destdir, pdest)
+            # keep the inventories in sync
+            if self.parent.inventory:
+                self.parent.inventory.invalidate(relp)
+            if self.inventory:
+                self.inventory.invalidate(relp, True)
 
     def make_link(self, path, tgt):
         dstp = self.destdir / path
@@ -2179,32 +2135,44 @@ def from_module(m, ret):
     return ret
 
 
-_tmpl_dict = {}
+def resolve_build_deps(pkgname, srepos, hds, tds, rds):
+    def _resolve_bdep(depn):
+        for sr in srepos:
+            rp = paths.distdir() / sr
+            tp = rp / depn / "template.py"
+            if tp.is_file():
+                pn = tp.resolve().parent.name
+                return sr, pn
+        return None, None
+
+    bdeps = {}
+    visited = {}
+    for bd in hds + tds:
+        if bd in visited:
+            continue
+        visited[bd] = True
+        sr, pn = _resolve_bdep(bd)
+        # just ignore unresolved stuff here, it's ok for now
+        if sr:
+            bdeps[f"{sr}/{pn}"] = True
+    for orig, bd in rds:
+        if bd in visited:
+            continue
+        visited[bd] = True
+        sr, pn = _resolve_bdep(bd)
+        # we need to ignore subpackages depending on their neighbors
+        if sr and ((bd == orig) or (pn != pkgname)):
+            bdeps[f"{sr}/{pn}"] = True
+    # pre-sort it just in case
+    return sorted(bdeps.keys())
 
 
-def read_mod(
-    pkgname,
-    pkgarch,
-    force_mode,
-    run_check,
-    jobs,
-    build_dbg,
-    use_ccache,
-    origin,
-    resolve=None,
-    ignore_missing=False,
-    target=None,
-    force_check=False,
-    autopkg=False,
-    stage=3,
-    bulk_mode=False,
-    allow_restricted=True,
-):
-    global _tmpl_dict
+_tmpl_dict = {}
 
-    if not isinstance(pkgname, str):
-        raise errors.CbuildException("missing package name")
 
+# the template directory name (category/name) for the given package name,
+# which is looked up in the source repositories of resolve if given
+def resolve_pkgname(pkgname, resolve=None, ignore_missing=False, autopkg=False):
     if resolve:
         resolved = False
         for r in resolve.source_repositories:
@@ -2228,7 +2196,7 @@ def read_mod(
                         break
         if not resolved:
             if ignore_missing:
-                return None, None
+                return None
             raise errors.CbuildException(f"missing template for '{pkgname}'")
     else:
         pnl = pkgname.split("/")
@@ -2241,9 +2209,39 @@ def read_mod(
         pkgname = "/".join(pnl)
         if not (paths.distdir() / pkgname / "template.py").is_file():
             if ignore_missing:
-                return None, None
+                return None
             raise errors.CbuildException(f"missing template for '{pkgname}'")
 
+    return pkgname
+
+
+def read_mod(
+    pkgname,
+    pkgarch,
+    force_mode,
+    run_check,
+    jobs,
+    build_dbg,
+    use_ccache,
+    origin,
+    resolve=None,
+    ignore_missing=False,
+    target=None,
+    force_check=False,
+    autopkg=False,
+    stage=3,
+    bulk_mode=False,
+    allow_restricted=True,
+):
+    global _tmpl_dict
+
+    if not isinstance(pkgname, str):
+        raise errors.CbuildException("missing package name")
+
+    pkgname = resolve_pkgname(pkgname, resolve, ignore_missing, autopkg)
+    if not pkgname:
+        return None, None
+
     tmplp = (paths.distdir() / pkgname).resolve()
     pkgname = str(tmplp.relative_to(paths.distdir()))
 
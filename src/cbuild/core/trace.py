@@ -0,0 +1,169 @@
+# Optional timing instrumentation of builds
+#
+# When enabled, build phases, hooks, template functions and sandboxed
+# commands are recorded as trace events (the Chrome trace event format,
+# which can be loaded in e.g. Perfetto or chrome://tracing). The trace
+# of every build is written into its statedir as well as preserved in
+# the cache path, from where bulk builds summarize them at the end.
+
+from cbuild.core import paths
+
+import contextlib
+import threading
+import resource
+import json
+import time
+import os
+
+_enabled = False
+_lock = threading.Lock()
+_events = []
+# open phases, as (pkg, name)
+_phases = []
+
+
+def set_enabled(enabled):
+    global _enabled
+    _enabled = enabled
+
+
+def enabled():
+    return _enabled
+
+
+def _now():
+    return time.time_ns() // 1000
+
+
+def _cpu():
+    ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + ru.ru_utime + ru.ru_stime
+
+
+def _add(ev):
+    ev["pid"] = os.getpid()
+    ev["tid"] = threading.get_native_id()
+    with _lock:
+        _events.append(ev)
+
+
+# a complete event for whatever runs within
+@contextlib.contextmanager
+def span(name, cat, **args):
+    if not _enabled:
+        yield
+        return
+    ts = _now()
+    cpu = _cpu()
+    try:
+        yield
+    finally:
+        args["cpu_ms"] = round((_cpu() - cpu) * 1000, 3)
+        _add(
+            {
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "ts": ts,
+                "dur": _now() - ts,
+                "args": args,
+            }
+        )
+
+
+# ends the current phase of the package and starts the given one, if any
+def phase(pkg, name):
+    if not _enabled:
+        return
+    if len(_phases) > 0 and _phases[-1][0] is pkg:
+        _add(
+            {"name": _phases.pop()[1], "cat": "phase", "ph": "E", "ts": _now()}
+        )
+    if name:
+        _phases.append((pkg, name))
+        _add({"name": name, "cat": "phase", "ph": "B", "ts": _now()})
+
+
+def mark():
+    with _lock:
+        return len(_events)
+
+
+def get_path(pkg):
+    arch = pkg.profile().arch
+    return (
+        paths.cbuild_cache()
+        / "traces"
+        / arch
+        / f"{pkg.pkgname}-{pkg.pkgver}-r{pkg.pkgrel}.json"
+    )
+
+
+# write out all the events recorded since the mark
+def save(pkg, since):
+    with _lock:
+        evs = _events[since:]
+    data = {
+        "traceEvents": evs,
+        "displayTimeUnit": "ms",
+        "otherData": {
+            "pkgname": pkg.pkgname,
+            "version": f"{pkg.pkgver}-r{pkg.pkgrel}",
+            "arch": pkg.profile().arch,
+        },
+    }
+    tpaths = [get_path(pkg)]
+    if pkg.statedir.is_dir():
+        tpaths.append(pkg.statedir / "trace.json")
+    for tp in tpaths:
+        tp.parent.mkdir(parents=True, exist_ok=True)
+        with open(tp, "w") as f:
+            json.dump(data, f)
+    # nested builds are still a part of whatever is outside of them
+    if since == 0:
+        with _lock:
+            _events.clear()
+
+
+# aggregate the traces of the given packages, returning a dictionary with
+# total milliseconds by phase, function (hooks and template functions),
+# sandboxed command and package
+def summarize(pkgs):
+    phases = {}
+    funcs = {}
+    cmds = {}
+    builds = {}
+
+    def _acc(dct, k, v):
+        dct[k] = dct.get(k, 0) + v
+
+    for pkg in pkgs:
+        try:
+            with open(get_path(pkg)) as f:
+                evs = json.load(f)["traceEvents"]
+        except (OSError, ValueError, KeyError):
+            continue
+        starts = []
+        for ev in evs:
+            match ev["ph"]:
+                case "B":
+                    starts.append(ev["ts"])
+                case "E" if len(starts) > 0:
+                    _acc(phases, ev["name"], (ev["ts"] - starts.pop()) / 1000)
+                case "X" if ev["cat"] == "func":
+                    _acc(funcs, ev["name"], ev["dur"] / 1000)
+                case "X" if ev["cat"] == "enter":
+                    _acc(cmds, ev["name"], ev["dur"] / 1000)
+                case "X" if ev["cat"] == "build":
+                    # the outermost build is the last one to finish
+                    builds[pkg.pkgname] = ev["dur"] / 1000
+
+    def _sorted(dct):
+        return dict(sorted(dct.items(), key=lambda v: v[1], reverse=True))
+
+    return {
+        "phases": _sorted(phases),
+        "functions": _sorted(funcs),
+        "commands": _sorted(cmds),
+        "builds": _sorted(builds),
+    }
@@ -7,14 +7,30 @@ import builtins
 import importlib
 import importlib.util
 import urllib.request as ureq
+import urllib.parse as uparse
+import http.client
+import threading
+import hashlib
 import fnmatch
+import json
 import time
 import gzip
 import io
 import re
 
+from concurrent.futures import ThreadPoolExecutor
+
 from cbuild.apk import cli as apkcli
 
+# concurrent checks in total and requests against a single host
+_max_jobs = 16
+_host_jobs = 4
+
+# update.py modules get their instance injected through builtins
+_modlock = threading.Lock()
+
+_fetcher = None
+
 
 # implements version sorting as in gnu sort(1) version sort
 def _get_verkey():
@@ -78,6 +94,197 @@ def _get_verkey():
 _ver_conv = _get_verkey()
 
 
+# fetches urls for all the checks in a run; connections are kept alive
+# and reused for each host, the number of parallel requests to a single
+# host is limited, and each url is only fetched once per run (or not at
+# all if it has not changed on the server since it was last cached)
+class Fetcher:
+    def __init__(self, cachedir=None, host_jobs=_host_jobs, timeout=10):
+        self.cachedir = cachedir
+        self.host_jobs = host_jobs
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self._conns = {}
+        self._cache = {}
+        self._pending = {}
+
+    def _get_conn(self, scheme, netloc):
+        with self._lock:
+            conns = self._conns.get((scheme, netloc))
+            if conns:
+                return conns.pop(), True
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+        return conn, False
+
+    def _put_conn(self, scheme, netloc, conn):
+        with self._lock:
+            self._conns.setdefault((scheme, netloc), []).append(conn)
+
+    def _request(self, scheme, netloc, path, headers):
+        while True:
+            conn, reused = self._get_conn(scheme, netloc)
+            try:
+                conn.request("GET", path, headers=headers)
+                resp = conn.getresponse()
+                body = resp.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                # the server may have dropped an idle connection
+                if reused:
+                    continue
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self._put_conn(scheme, netloc, conn)
+            return resp.status, resp.headers, body
+
+    def _cache_path(self, url):
+        if not self.cachedir:
+            return None
+        return self.cachedir / (hashlib.sha256(url.encode()).hexdigest())
+
+    def _cache_get(self, url):
+        cpath = self._cache_path(url)
+        if not cpath:
+            return None
+        try:
+            with gzip.open(cpath, "rt") as f:
+                ent = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if ent.get("url") != url:
+            return None
+        return ent
+
+    def _cache_put(self, url, hdrs, body):
+        cpath = self._cache_path(url)
+        if not cpath:
+            return
+        etag = hdrs.get("ETag")
+        lmod = hdrs.get("Last-Modified")
+        if not etag and not lmod:
+            return
+        self.cachedir.mkdir(parents=True, exist_ok=True)
+        tpath = cpath.with_name(f".{cpath.name}.{threading.get_ident()}")
+        with gzip.open(tpath, "wt") as f:
+            json.dump(
+                {"url": url, "etag": etag, "modified": lmod, "body": body}, f
+            )
+        tpath.rename(cpath)
+
+    def _fetch_url(self, url):
+        headers = {
+            "User-Agent": "cbuild-update-check/4.20.69",
+            "Accept-Encoding": "gzip",
+        }
+
+        ent = self._cache_get(url)
+        if ent:
+            if ent["etag"]:
+                headers["If-None-Match"] = ent["etag"]
+            if ent["modified"]:
+                headers["If-Modified-Since"] = ent["modified"]
+
+        u = url
+        for i in range(10):
+            pu = uparse.urlsplit(u)
+            # let urllib deal with proxies, without any caching
+            if pu.scheme not in ("http", "https") or ureq.getproxies().get(
+                pu.scheme
+            ):
+                f = ureq.urlopen(ureq.Request(u, None, headers), None, 10)
+                status, hdrs, body = 200, f.info(), f.read()
+                break
+            path = pu.path if pu.path else "/"
+            if pu.query:
+                path += "?" + pu.query
+            with self._lock:
+                sem = self._hosts.get(pu.netloc)
+                if not sem:
+                    sem = threading.BoundedSemaphore(self.host_jobs)
+                    self._hosts[pu.netloc] = sem
+            with sem:
+                status, hdrs, body = self._request(
+                    pu.scheme, pu.netloc, path, headers
+                )
+            if status in (301, 302, 303, 307, 308) and hdrs.get("Location"):
+                u = uparse.urljoin(u, hdrs["Location"])
+                continue
+            break
+        else:
+            return None
+
+        if status == 304 and ent:
+            return ent["body"]
+        if status < 200 or status >= 300:
+            return None
+
+        if hdrs.get("Content-Encoding") == "gzip":
+            body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+        ret = body.decode("utf-8", "ignore")
+
+        self._cache_put(url, hdrs, ret)
+
+        return ret
+
+    # the contents of the url, or None on failure
+    def fetch(self, url):
+        with self._lock:
+            if url in self._cache:
+                return self._cache[url]
+            ev = self._pending.get(url)
+            if not ev:
+                ev = threading.Event()
+                self._pending[url] = ev
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            ev.wait()
+            with self._lock:
+                if url in self._cache:
+                    return self._cache[url]
+            # the other attempt failed, try again
+            return self.fetch(url)
+
+        try:
+            ret = self._fetch_url(url)
+        except Exception:
+            ret = None
+
+        with self._lock:
+            # failures are not remembered so that they can be retried
+            if ret is not None:
+                self._cache[url] = ret
+            del self._pending[url]
+            ev.set()
+
+        return ret
+
+
+def get_fetcher():
+    global _fetcher
+
+    if not _fetcher:
+        from cbuild.core import paths
+
+        _fetcher = Fetcher(paths.cbuild_cache() / "update_check")
+
+    return _fetcher
+
+
+def set_fetcher(fetcher):
+    global _fetcher
+
+    _fetcher = fetcher
+
+
 class UpdateCheck:
     def __init__(self, tmpl, verbose):
         self.verbose = verbose
@@ -97,22 +304,8 @@ class UpdateCheck:
         if u in self._urlcache:
             return False
 
-        req = ureq.Request(
-            u,
-            None,
-            {
-                "User-Agent": "cbuild-update-check/4.20.69",
-                "Accept-Encoding": "gzip",
-            },
-        )
-        try:
-            f = ureq.urlopen(req, None, 10)
-            if f.info().get("Content-Encoding") == "gzip":
-                resp = gzip.GzipFile(fileobj=io.BytesIO(f.read())).read()
-            else:
-                resp = f.read()
-            ret = resp.decode("utf-8", "ignore")
-        except Exception:
+        ret = get_fetcher().fetch(u)
+        if ret is None:
             return None
 
         self._urlcache[u] = True
@@ -389,7 +582,7 @@ class UpdateCheck:
         return list(map(lambda v: v.replace("_", "."), reqs))
 
 
-def update_check(pkg, verbose=False, error=False):
+def update_check(pkg, verbose=False, error=False, out=print):
     uc = UpdateCheck(pkg, verbose)
 
     tpath = pkg.template_path
@@ -400,7 +593,7 @@ def update_check(pkg, verbose=False, error=False):
     checkvers = []
 
     if verbose:
-        print(f"Checking for updates: {pkg.pkgname}={pkg.pkgver}")
+        out(f"Checking for updates: {pkg.pkgname}={pkg.pkgver}")
 
     if (tpath / "update.py").exists():
         modspec = importlib.util.spec_from_file_location(
@@ -408,12 +601,13 @@ def update_check(pkg, verbose=False, error=False):
         )
         modh = importlib.util.module_from_spec(modspec)
 
-        setattr(builtins, "self", uc)
-        modspec.loader.exec_module(modh)
-        delattr(builtins, "self")
+        with _modlock:
+            setattr(builtins, "self", uc)
+            modspec.loader.exec_module(modh)
+            delattr(builtins, "self")
 
         if verbose:
-            print("Found update.py, using overrides...")
+            out("Found update.py, using overrides...")
 
         # hooks
 
@@ -461,7 +655,7 @@ def update_check(pkg, verbose=False, error=False):
     if uc.ignore and type(uc.ignore) is not list:
         if error:
             return None
-        print(f"CAUTION: malformed ignore list for {pkg.pkgname}")
+        out(f"CAUTION: malformed ignore list for {pkg.pkgname}")
         return checkvers
 
     # use hooks if defined
@@ -496,7 +690,7 @@ def update_check(pkg, verbose=False, error=False):
         time.sleep(d)
 
         if verbose:
-            print("No versions fetched, retrying...")
+            out("No versions fetched, retrying...")
 
     vers = list(set(vers))
     vers.sort(key=_ver_conv)
@@ -505,11 +699,11 @@ def update_check(pkg, verbose=False, error=False):
         if error:
             return None
 
-        print(f"CAUTION: no version found for '{pkg.pkgname}'")
+        out(f"CAUTION: no version found for '{pkg.pkgname}'")
 
     for v in vers:
         if verbose:
-            print(f"Checking found version: {v}")
+            out(f"Checking found version: {v}")
 
         ignored = False
 
@@ -517,7 +711,7 @@ def update_check(pkg, verbose=False, error=False):
             if fnmatch.fnmatchcase(v, iv):
                 ignored = True
                 if verbose:
-                    print(f"Ignoring version '{v}' (due to '{iv}')")
+                    out(f"Ignoring version '{v}' (due to '{iv}')")
                 break
 
         if ignored:
@@ -530,3 +724,14 @@ def update_check(pkg, verbose=False, error=False):
             checkvers.append((pkg.pkgver, v))
 
     return checkvers
+
+
+# check many templates at once, yielding (template, result, messages)
+# in the original order; the messages are what would otherwise be printed
+def update_check_all(pkgs, jobs=_max_jobs):
+    def _check(pkg):
+        msgs = []
+        return pkg, update_check(pkg, out=msgs.append), msgs
+
+    with ThreadPoolExecutor(max_workers=jobs) as ex:
+        yield from ex.map(_check, pkgs)
@@ -2,6 +2,7 @@ from cbuild.core import paths
 
 import os
 import math
+import json
 import hashlib
 import threading
 from time import time as timer
@@ -9,9 +10,77 @@ from urllib import request
 from http.client import responses
 from multiprocessing.pool import ThreadPool
 
+# digests of files we have already hashed, keyed by their identity; a file
+# that has not changed since then does not have to be read again
+_dcache = None
+_dcache_max = 16384
+
+
+def _dcache_path():
+    return paths.sources() / "by_sha256" / ".digests.json"
+
+
+def _dcache_key(st):
+    return f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+
+def _dcache_get():
+    global _dcache
+
+    if _dcache is None:
+        try:
+            with open(_dcache_path()) as f:
+                _dcache = json.load(f)
+        except (OSError, ValueError):
+            _dcache = {}
+
+    return _dcache
+
+
+def _dcache_put(dfile, cksum):
+    _dcache_get()[_dcache_key(dfile.stat())] = cksum
+
+
+def _dcache_save():
+    if not _dcache:
+        return
+    # merge with whatever other instances may have written meanwhile
+    try:
+        with open(_dcache_path()) as f:
+            dc = json.load(f)
+    except (OSError, ValueError):
+        dc = {}
+    dc.update(_dcache)
+    # drop the oldest entries
+    if len(dc) > _dcache_max:
+        dc = dict(list(dc.items())[-(_dcache_max // 2) :])
+    dpath = _dcache_path()
+    dpath.parent.mkdir(parents=True, exist_ok=True)
+    tpath = dpath.with_name(f"{dpath.name}.{os.getpid()}")
+    with open(tpath, "w") as f:
+        json.dump(dc, f)
+    os.replace(tpath, dpath)
+
 
 def get_cksum(dfile, pkg):
-    return hashlib.sha256(dfile.read_bytes()).hexdigest()
+    dkey = _dcache_key(dfile.stat())
+    cksum = _dcache_get().get(dkey)
+    if cksum:
+        return cksum
+
+    hv = hashlib.sha256()
+    buf = bytearray(1024 * 1024)
+    mv = memoryview(buf)
+    with open(dfile, "rb") as f:
+        while True:
+            nread = f.readinto(buf)
+            if nread == 0:
+                break
+            hv.update(mv[0:nread])
+
+    cksum = hv.hexdigest()
+    _dcache_get()[dkey] = cksum
+    return cksum
 
 
 def make_link(dfile, cksum):
@@ -76,6 +145,7 @@ def get_nameurl(pkg, d):
 fmtx = threading.Lock()
 fstatus = []
 flens = []
+fhashes = []
 
 
 def fetch_stream(url, dfile, idx, ntry, rqf, rbuf):
@@ -98,6 +168,7 @@ def fetch_stream(url, dfile, idx, ntry, rqf, rbuf):
                 # range ignored/not supported, do a normal retry
                 fmode = "wb"
                 fstatus[idx] = 0
+                fhashes[idx] = hashlib.sha256()
                 if ntry > 3:
                     # don't iterate forever
                     return (
@@ -111,6 +182,8 @@ def fetch_stream(url, dfile, idx, ntry, rqf, rbuf):
                 ntry = 0
     else:
         fmode = "wb"
+        with fmtx:
+            fhashes[idx] = hashlib.sha256()
         if rqf.status is not None:
             clen = rqf.getheader("content-length")
             if clen:
@@ -126,15 +199,20 @@ def fetch_stream(url, dfile, idx, ntry, rqf, rbuf):
         rbuf = bytearray(65536)
     dores = False
     pfile = dfile.with_name(dfile.name + ".part")
+    # hash as we go, so that verifying needs no extra pass over the file
+    hv = fhashes[idx]
+    rview = memoryview(rbuf)
     with open(pfile, fmode) as df:
         while True:
             nread = rqf.readinto(rbuf)
             if nread == 0:
                 break
             if nread < len(rbuf):
-                df.write(rbuf[0:nread])
+                df.write(rview[0:nread])
+                hv.update(rview[0:nread])
             else:
                 df.write(rbuf)
+                hv.update(rbuf)
             with fmtx:
                 fstatus[idx] += nread
         with fmtx:
@@ -151,6 +229,8 @@ def fetch_stream(url, dfile, idx, ntry, rqf, rbuf):
         return fetch_url(url, dfile, idx, ntry + 1, rbuf)
     # rename and return
     pfile.rename(dfile)
+    with fmtx:
+        _dcache_put(dfile, hv.hexdigest())
     return None, None, None
 
 
@@ -180,7 +260,7 @@ def fetch_url(url, dfile, idx, ntry, rbuf=None):
 
 
 def invoke(pkg):
-    global fmtx, fstatus, flens
+    global fmtx, fstatus, flens, fhashes
 
     srcdir = paths.sources() / f"{pkg.pkgname}-{pkg.pkgver}"
 
@@ -214,6 +294,7 @@ def invoke(pkg):
                 dfile.unlink()
 
     if len(pkg.source) == dfgood:
+        _dcache_save()
         return
 
     tofetch = []
@@ -221,6 +302,7 @@ def invoke(pkg):
     # reset (could be filled from previous bulk)
     fstatus = []
     flens = []
+    fhashes = []
 
     for dc in zip(pkg.source, pkg.sha256):
         d, ck = dc
@@ -234,6 +316,7 @@ def invoke(pkg):
             tofetch.append((url, dfile, idx))
             fstatus.append(0)
             flens.append(-1)
+            fhashes.append(hashlib.sha256())
             pkg.log(f"fetching source '{fname}'...")
 
     def do_fetch_url(mv):
@@ -307,6 +390,7 @@ def invoke(pkg):
             pkg.error(f"source '{dfile}' does not exist")
         if not verify_cksum(dfile, ck, pkg):
             errors += 1
+    _dcache_save()
     # error if something failed to verify
     if errors > 0:
         pkg.error(f"failed to verify {errors} sources")
@@ -310,6 +310,8 @@ set -e
             logger.get().out_plain(ret.stderr.decode())
             pkg.error("failed to generate package")
 
+        pkg.rparent._stage_files.append(binpath)
+
     finally:
         pkg.rparent._stage[repo] = True
 
@@ -1,6 +1,8 @@
 # this runs early so that proper permissions can get applied
 # otherwise we would not get validation by e.g. the suid scanner
 
+from cbuild.core import inventory
+
 import os
 
 
@@ -48,3 +50,5 @@ def invoke(pkg):
                     os.chmod(f, fmode)
         else:
             os.chmod(p, fmode)
+
+        inventory.get(pkg).invalidate(k, recursive)
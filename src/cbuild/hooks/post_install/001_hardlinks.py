@@ -4,7 +4,7 @@
 # make it an option and update the apk generator to preserve
 # the hardlinks so they do not get made into multiple files
 
-import os
+from cbuild.core import inventory
 
 
 def invoke(pkg):
@@ -16,19 +16,19 @@ def invoke(pkg):
     # mappings from inode to full path
     hards = {}
     harderr = False
-    for root, dirs, files in os.walk(pkg.destdir):
-        for f in files:
-            absp = os.path.join(root, f)
-            st = os.lstat(absp)
-            if st.st_nlink > 1:
-                if st.st_ino not in hards:
-                    # first occurence
-                    hards[st.st_ino] = absp
-                else:
-                    p1 = os.path.relpath(absp, pkg.destdir)
-                    p2 = os.path.relpath(hards[st.st_ino], pkg.destdir)
-                    pkg.log_red(f"hardlink detected ({p1}, previously {p2})")
-                    harderr = True
+    for ent in inventory.get(pkg).entries():
+        if ent.is_dir():
+            continue
+        st = ent.stat
+        if st.st_nlink > 1:
+            if st.st_ino not in hards:
+                # first occurence
+                hards[st.st_ino] = ent.relpath
+            else:
+                p1 = ent.relpath
+                p2 = hards[st.st_ino]
+                pkg.log_red(f"hardlink detected ({p1}, previously {p2})")
+                harderr = True
 
     if harderr:
         pkg.error("hardlinks were found, cannot proceed")
@@ -1,9 +1,16 @@
+from cbuild.core import inventory
+
 import bz2
 import gzip
 
 
 def invoke(pkg):
-    for f in (pkg.destdir / "usr/share/man").rglob("*.*"):
+    inv = inventory.get(pkg)
+
+    for ent in inv.under("usr/share/man"):
+        f = ent.path
+        if "." not in f.name:
+            continue
         # sanitize
         if not f.is_file():
             continue
@@ -13,6 +20,7 @@ def invoke(pkg):
         # rewrite symlinks
         if f.is_symlink():
             f.with_suffix("").symlink_to(f.readlink().with_suffix(""))
+            inv.invalidate(f.with_suffix(""))
             continue
         # uncompress
         gf = gzip.open(f, "rb") if f.suffix == ".gz" else bz2.open(f, "rb")
@@ -20,3 +28,5 @@ def invoke(pkg):
             uf.write(gf.read())
         gf.close()
         f.unlink()
+        inv.invalidate(f)
+        inv.invalidate(f.with_suffix(""))
@@ -1,3 +1,9 @@
+from cbuild.core import inventory
+
+
 def invoke(pkg):
-    (pkg.destdir / "usr/lib/charset.alias").unlink(missing_ok=True)
-    (pkg.destdir / "usr/share/info/dir").unlink(missing_ok=True)
+    inv = inventory.get(pkg)
+
+    for f in ["usr/lib/charset.alias", "usr/share/info/dir"]:
+        (pkg.destdir / f).unlink(missing_ok=True)
+        inv.invalidate(f)
@@ -1,6 +1,13 @@
+from cbuild.core import inventory
+
+
 def invoke(pkg):
     if pkg.options["keeplibtool"]:
         return
 
-    for v in pkg.destdir.rglob("*.la"):
-        v.unlink()
+    inv = inventory.get(pkg)
+
+    for ent in inv.entries():
+        if ent.name.endswith(".la"):
+            ent.path.unlink()
+            inv.invalidate(ent.relpath)
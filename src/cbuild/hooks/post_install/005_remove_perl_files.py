@@ -1,12 +1,18 @@
+from cbuild.core import inventory
+
+
 def invoke(pkg):
     if pkg.pkgname == "perl":
         return
 
-    for f in pkg.destdir.rglob("*"):
-        if not f.is_file():
+    inv = inventory.get(pkg)
+
+    for ent in inv.entries():
+        if ent.name != "perllocal.pod" and ent.name != ".packlist":
+            continue
+
+        if not ent.path.is_file():
             continue
 
-        if f.name == "perllocal.pod":
-            f.unlink()
-        elif f.name == ".packlist":
-            f.unlink()
+        ent.path.unlink()
+        inv.invalidate(ent.relpath)
@@ -1,5 +1,7 @@
 # if the package protects some paths, here we write the right files
 
+from cbuild.core import inventory
+
 import pathlib
 
 _valid_pfx = {
@@ -24,3 +26,5 @@ def invoke(pkg):
             if pathlib.Path(pp[1:]).is_absolute():
                 pkg.error(f"protected path '{pp}' is not relative")
             outf.write(f"{pp}\n")
+
+    inventory.get(pkg).invalidate(ppath / f"apk-{pkg.pkgname}.list")
@@ -1,3 +1,4 @@
+from cbuild.core import inventory
 from cbuild.util import strip
 
 import shutil
@@ -26,27 +27,30 @@ def invoke(pkg):
     dbgdir = pkg.destdir / "usr/lib/debug"
     elfs = pkg.rparent.current_elfs
     have_pie = pkg.rparent.has_hardening("pie")
+    batch = strip.Batch(pkg)
+    msgs = []
+    inv = inventory.get(pkg)
 
-    for v in pkg.destdir.rglob("*"):
+    for ent in inv.entries():
+        v = ent.path
         # already stripped debug symbols
         if v.is_relative_to(dbgdir):
             continue
 
         # must be a regular file
-        if not v.is_file() or v.is_symlink():
+        if not ent.is_file():
             continue
 
-        vr = v.relative_to(pkg.destdir)
+        vr = ent.relpath
 
         # must be either found in elfs, or be a static lib
         vt = elfs.get(str(vr), None)
         if not vt:
-            with open(v, "rb") as ef:
-                if ef.read(8) != b"!<arch>\n":
-                    continue
-                # empty archive
-                if ef.read(1) == b"":
-                    continue
+            if ent.head()[0:8] != b"!<arch>\n":
+                continue
+            # empty archive
+            if len(ent.head()) == 8:
+                continue
 
         found_nostrip = True
 
@@ -64,9 +68,10 @@ def invoke(pkg):
         # strip static library, only if not LTO or when forced
         if not vt:
             v.chmod(0o644)
+            inv.invalidate(vr)
             if not pkg.rparent.has_lto() or pkg.options["ltostrip"]:
-                sp = strip.strip(pkg, v)
-                print(f"   Stripped static library: {sp}")
+                sp = batch.strip(v)
+                msgs.append(f"   Stripped static library: {sp}")
             # in any case continue
             continue
 
@@ -75,8 +80,8 @@ def invoke(pkg):
         # strip static executable
         if static:
             _sanitize_exemode(pkg, v, str(vr))
-            sp = strip.strip(pkg, v)
-            print(f"   Stripped static executable: {sp}")
+            sp = batch.strip(v)
+            msgs.append(f"   Stripped static executable: {sp}")
             continue
 
         # pie or nopie?
@@ -108,16 +113,26 @@ def invoke(pkg):
             if not allow_nopie:
                 pkg.error(f"non-PIE executable found in PIE build: {vr}")
 
-            sp = strip.strip_attach(pkg, v)
-            print(f"   Stripped executable: {sp}")
+            sp = batch.strip_attach(v)
+            msgs.append(f"   Stripped executable: {sp}")
             continue
 
         # strip pie executable or shared library
-        sp = strip.strip_attach(pkg, v)
+        sp = batch.strip_attach(v)
         if interp:
-            print(f"   Stripped position-independent executable: {sp}")
+            msgs.append(f"   Stripped position-independent executable: {sp}")
         else:
-            print(f"   Stripped library: {sp}")
+            msgs.append(f"   Stripped library: {sp}")
+
+    # process everything at once and only then report it
+    batch.run(pkg.rparent.make_jobs)
+
+    for relp, attach in batch.files:
+        inv.invalidate(relp)
+    inv.invalidate("usr/lib/debug", True)
+
+    for msg in msgs:
+        print(msg)
 
     # prepare debug package
     if not pkg.rparent.options["debug"] or not pkg.rparent.build_dbg:
@@ -136,11 +151,14 @@ def invoke(pkg):
     except Exception:
         pkg.error("failed to create debug package")
 
+    inv.invalidate("usr/lib/debug")
+
     # try removing the libdir
     for f in (pkg.destdir / "usr/lib").iterdir():
         break
     else:
         (pkg.destdir / "usr/lib").rmdir()
+        inv.invalidate("usr/lib")
 
     # done!
     return
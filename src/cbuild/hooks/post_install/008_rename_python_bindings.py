@@ -1,3 +1,5 @@
+from cbuild.core import inventory
+
 import stat
 
 
@@ -12,3 +14,5 @@ def invoke(pkg):
         newname = oldname[: -len("".join(v.suffixes))]
         pkg.log_warn(f"renamed '{oldname}' to '{newname}.so'")
         v.rename(v.parent / (newname + ".so"))
+        inventory.get(pkg).invalidate(v)
+        inventory.get(pkg).invalidate(v.parent / (newname + ".so"))
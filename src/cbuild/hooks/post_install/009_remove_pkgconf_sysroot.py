@@ -1,6 +1,8 @@
 # this hook replaces all occurences of the cross sysroot in .pc files so that
 # cross builds do not differ from native ones (e.g. /usr/ARCH/usr -> /usr)
 
+from cbuild.core import inventory
+
 
 def invoke(pkg):
     sr = str(pkg.rparent.profile().sysroot / "usr")
@@ -17,3 +19,4 @@ def invoke(pkg):
 
         ofp.chmod(0o644)
         ofp.rename(f)
+        inventory.get(pkg).invalidate(f)
@@ -1,17 +1,20 @@
+from cbuild.core import inventory
+
 import os
 
 
 def invoke(pkg):
     badattrs = []
 
-    for v in pkg.destdir.rglob("*"):
+    for ent in inventory.get(pkg).entries():
+        v = ent.path
         xl = os.listxattr(v, follow_symlinks=False)
 
         # nothing to do
         if len(xl) == 0:
             continue
 
-        attrs = pkg.file_xattrs.get(str(v.relative_to(pkg.destdir)), {})
+        attrs = pkg.file_xattrs.get(str(ent.relpath), {})
 
         found_bad = False
         # go through attrs on the file and track undeclared ones
@@ -1,12 +1,14 @@
+from cbuild.core import inventory
+
 import stat
 
 
 def invoke(pkg):
     badbins = []
 
-    for v in pkg.destdir.rglob("*"):
-        st = v.lstat()
-        sm = st.st_mode
+    for ent in inventory.get(pkg).entries():
+        v = ent.path
+        sm = ent.stat.st_mode
 
         # must be a regular file
         if not stat.S_ISREG(sm):
@@ -16,7 +18,7 @@ def invoke(pkg):
         if not ((sm & stat.S_ISUID) or (sm & stat.S_ISGID)):
             continue
 
-        vr = v.relative_to(pkg.destdir)
+        vr = ent.relpath
         found_suid = True
 
         for f in pkg.file_modes:
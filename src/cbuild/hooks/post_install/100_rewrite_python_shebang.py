@@ -1,3 +1,5 @@
+from cbuild.core import inventory
+
 import os
 import re
 import tempfile
@@ -6,9 +8,12 @@ import tempfile
 def invoke(pkg):
     default_shebang = b"#!/usr/bin/python3"
 
-    for v in pkg.destdir.rglob("*"):
+    inv = inventory.get(pkg)
+
+    for ent in inv.entries():
+        v = ent.path
         # skip those early
-        if v.is_symlink() or not v.is_file():
+        if not ent.is_file() or ent.head()[0:2] != b"#!":
             continue
         # read files in binary so that we don't accidentally try decoding
         # stuff like executables and libraries as unicode, which would fail
@@ -52,5 +57,6 @@ def invoke(pkg):
                 os.link(nf.name, v)
                 # set mode to whatever it was
                 v.chmod(mode)
+            inv.invalidate(v)
             # we're done
             print(f"   Shebang converted to '{shebang.decode()}': {bfile}")
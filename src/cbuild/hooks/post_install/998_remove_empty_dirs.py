@@ -1,17 +1,22 @@
-def clean_empty(pkg, dpath):
+from cbuild.core import inventory
+
+import pathlib
+
+
+def clean_empty(pkg, dpath, children):
     empty = True
 
-    for f in dpath.iterdir():
-        if f.is_dir() and not f.is_symlink():
-            if not clean_empty(pkg, f):
+    for f in children.get(dpath, []):
+        if f.is_dir():
+            if not clean_empty(pkg, f.relpath, children):
                 empty = False
         else:
             empty = False
 
-    if empty and dpath != pkg.destdir:
-        pr = dpath.relative_to(pkg.destdir)
-        pkg.log_warn(f"removed empty directory: {pr}")
-        dpath.rmdir()
+    if empty and dpath != pathlib.Path():
+        pkg.log_warn(f"removed empty directory: {dpath}")
+        (pkg.destdir / dpath).rmdir()
+        inventory.get(pkg).invalidate(dpath)
         return True
 
     return False
@@ -21,4 +26,8 @@ def invoke(pkg):
     if pkg.options["keepempty"]:
         return
 
-    clean_empty(pkg, pkg.destdir)
+    children = {}
+    for ent in inventory.get(pkg).entries():
+        children.setdefault(ent.relpath.parent, []).append(ent)
+
+    clean_empty(pkg, pathlib.Path(), children)
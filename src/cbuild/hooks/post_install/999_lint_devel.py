@@ -1,8 +1,13 @@
+from cbuild.core import inventory
+
+
 def _lint_static(pkg):
     if pkg.pkgname.endswith("-static"):
         return True
 
-    for v in (pkg.destdir / "usr/lib").rglob("*.a"):
+    for v in inventory.get(pkg).under("usr/lib"):
+        if not v.name.endswith(".a"):
+            continue
         allow = not pkg.rparent.options["lto"] or pkg.options["ltostrip"]
         if not allow or pkg.options["splitstatic"]:
             pkg.log_red("static libraries should be in the -static package")
@@ -44,17 +49,21 @@ def invoke(pkg):
         "usr/share/glade/catalogs": True,
     }
 
-    for v in pkg.destdir.rglob("*"):
-        if v.is_symlink() or not v.is_dir():
+    ents = inventory.get(pkg).entries()
+
+    for v in ents:
+        if not v.is_dir():
             continue
-        v = str(v.relative_to(pkg.destdir))
+        v = str(v.relpath)
         if v in badpaths:
             pkg.log_warn(f"{v} should be in the -devel package")
 
-    for v in pkg.destdir.rglob("usr/lib/*.so"):
-        pkg.log_warn(".so symlinks should be in the -devel package")
-        break
+    for v in ents:
+        if v.relpath.match("usr/lib/*.so"):
+            pkg.log_warn(".so symlinks should be in the -devel package")
+            break
 
-    for v in pkg.destdir.rglob("usr/bin/*-config"):
-        pkg.log_warn("*-config tools should be in the -devel package")
-        break
+    for v in ents:
+        if v.relpath.match("usr/bin/*-config"):
+            pkg.log_warn("*-config tools should be in the -devel package")
+            break
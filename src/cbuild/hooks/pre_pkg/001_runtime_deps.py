@@ -1,12 +1,110 @@
-from cbuild.core import logger, chroot, paths
+from cbuild.core import logger, chroot, paths, inventory
 from cbuild.util import flock
-from cbuild.apk import cli
+from cbuild.apk import cli, index as aindex
 
 import re
 import os
 import pathlib
 
 
+def _query_so(pkg, dep, broot, aarch):
+    info = cli.call(
+        "info",
+        ["--from", "installed", "--description", "so:" + dep],
+        None,
+        root=broot,
+        capture_output=True,
+        arch=aarch,
+        allow_untrusted=True,
+    )
+    if info.returncode != 0:
+        # when bootstrapping, also check the repository
+        if pkg.stage == 0:
+            info = cli.call(
+                "info",
+                ["--from", "none", "--description", "so:" + dep],
+                "main",
+                capture_output=True,
+                allow_untrusted=True,
+            )
+
+    # either of the commands failed
+    if info.returncode != 0:
+        return None
+
+    # this needs a bit more parsing, first take only the name-ver
+    outl = info.stdout.split()
+    sdep = None
+    if len(outl) > 0:
+        outl = outl[0].strip().decode()
+        # find -rX
+        dash = outl.rfind("-")
+        if dash > 0:
+            # find the version separator
+            dash = outl.rfind("-", 0, dash)
+            if dash > 0:
+                # consider just the name
+                sdep = outl[0:dash]
+
+    if not sdep or len(sdep) == 0:
+        # this should never happen though
+        return None
+
+    return sdep
+
+
+def _find_provider(ndxs, name):
+    for ndx in ndxs:
+        provs = sorted(set(ipkg.name for ipkg, iver in ndx.whatprovides(name)))
+        if len(provs) > 0:
+            return provs[0]
+    return None
+
+
+# get a mapping of soname to providing package for all the given sonames;
+# the results are shared by the main package and all its subpackages, and
+# the installed database (plus the repository when bootstrapping) is only
+# read once, with apk being used as a fallback if that is not possible
+def _get_so_providers(pkg, deps):
+    cache = pkg.rparent.current_providers
+    todo = [dep for dep in deps if f"so:{dep}" not in cache]
+
+    if len(todo) > 0:
+        bp = pkg.rparent.profile()
+        if bp.cross:
+            broot = paths.bldroot() / bp.sysroot.relative_to("/")
+            aarch = bp.arch
+        else:
+            broot = None
+            aarch = None
+
+        ndxs = []
+        ndx = aindex.load_installed(broot if broot else paths.bldroot())
+        if ndx:
+            ndxs.append(ndx)
+            if pkg.stage == 0:
+                rndxs = aindex.get_repos(
+                    cli.collect_repos(
+                        "main", False, None, True, True, cli.get_network()
+                    )
+                )
+                if rndxs is None:
+                    ndxs = None
+                else:
+                    ndxs += [rndx for repo, rndx in rndxs]
+        else:
+            ndxs = None
+
+        for dep in todo:
+            if ndxs is not None:
+                sdep = _find_provider(ndxs, "so:" + dep)
+            else:
+                sdep = _query_so(pkg, dep, broot, aarch)
+            cache[f"so:{dep}"] = sdep
+
+    return {dep: cache[f"so:{dep}"] for dep in deps}
+
+
 def _scan_so(pkg):
     verify_deps = {}
     pkg.so_requires = []
@@ -36,6 +134,11 @@ def _scan_so(pkg):
     broken = False
     log = logger.get()
 
+    # resolve everything external at once
+    provs = _get_so_providers(
+        pkg, [dep for dep in verify_deps if dep not in curso]
+    )
+
     # FIXME: also emit dependencies for proper version constraints
     for dep in verify_deps:
         # current package or a subpackage
@@ -50,56 +153,8 @@ def _scan_so(pkg):
                 subpkg_deps[depn] = True
             continue
         # otherwise, check if it came from an installed dependency
-        bp = pkg.rparent.profile()
-        if bp.cross:
-            broot = paths.bldroot() / bp.sysroot.relative_to("/")
-            aarch = bp.arch
-        else:
-            broot = None
-            aarch = None
-
-        info = cli.call(
-            "info",
-            ["--from", "installed", "--description", "so:" + dep],
-            None,
-            root=broot,
-            capture_output=True,
-            arch=aarch,
-            allow_untrusted=True,
-        )
-        if info.returncode != 0:
-            # when bootstrapping, also check the repository
-            if pkg.stage == 0:
-                info = cli.call(
-                    "info",
-                    ["--from", "none", "--description", "so:" + dep],
-                    "main",
-                    capture_output=True,
-                    allow_untrusted=True,
-                )
-
-        # either of the commands failed
-        if info.returncode != 0:
-            log.out_red(f"   SONAME: {dep} <-> UNKNOWN PACKAGE!")
-            broken = True
-            continue
-
-        # this needs a bit more parsing, first take only the name-ver
-        outl = info.stdout.split()
-        sdep = None
-        if len(outl) > 0:
-            outl = outl[0].strip().decode()
-            # find -rX
-            dash = outl.rfind("-")
-            if dash > 0:
-                # find the version separator
-                dash = outl.rfind("-", 0, dash)
-                if dash > 0:
-                    # consider just the name
-                    sdep = outl[0:dash]
-
-        if not sdep or len(sdep) == 0:
-            # this should never happen though
+        sdep = provs[dep]
+        if not sdep:
             log.out_red(f"   SONAME: {dep} <-> UNKNOWN PACKAGE!")
             broken = True
             continue
@@ -276,10 +331,11 @@ def _scan_symlinks(pkg):
             return False
         return True
 
-    for f in pkg.destdir.rglob("*"):
+    for ent in inventory.get(pkg).entries():
         # skip non-symlinks
-        if not f.is_symlink():
+        if not ent.is_symlink():
             continue
+        f = ent.path
         # resolve
         sdest = f.readlink()
         # normalize to absolute path within destdir
@@ -1,5 +1,7 @@
 # sets the timestamps for reproducibility
 
+from cbuild.core import inventory
+
 from datetime import datetime
 import os
 
@@ -13,13 +15,11 @@ def invoke(pkg):
 
     pkg.log(f"setting mtimes to {dt}")
 
-    for root, dirs, files in os.walk(pkg.destdir):
-        for d in dirs:
-            absp = os.path.join(root, d)
-            # update timestamp
-            os.utime(absp, (ts, ts), follow_symlinks=False)
+    inv = inventory.get(pkg)
+
+    for ent in inv.entries():
+        # update timestamp
+        os.utime(ent.path, (ts, ts), follow_symlinks=False)
 
-        for f in files:
-            absp = os.path.join(root, f)
-            # update timestamp
-            os.utime(absp, (ts, ts), follow_symlinks=False)
+    # all the stat info is now out of date
+    inv.reset()
@@ -1,4 +1,4 @@
-from cbuild.core import template, scanelf
+from cbuild.core import template, scanelf, inventory
 
 import os
 import shutil
@@ -30,6 +30,11 @@ def invoke(pkg, step):
     # but before post_install hooks (done by the install step)
     pkg.current_elfs = {}
 
+    # the destdirs are scanned once and shared by all the hooks
+    for sp in pkg.subpkg_list:
+        sp.inventory = inventory.Inventory(sp.destdir)
+    pkg.inventory = inventory.Inventory(pkg.destdir)
+
     template.call_pkg_hooks(pkg, "init_install")
     template.run_pkg_func(pkg, "init_install")
 
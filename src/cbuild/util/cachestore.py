@@ -0,0 +1,78 @@
+# Entries of the caches in the cache path
+#
+# Every cache keeps its entries as directories named by a key, which is a
+# hash of everything that goes into the entry. Entries are put together
+# under a temporary name and renamed into place, and removed by renaming
+# them out of the way first, so that nobody ever sees a partial one. Using
+# entries and dropping them happen under a lock on their directory.
+
+from cbuild.core import paths
+from cbuild.util import flock
+
+import hashlib
+import shutil
+import time
+import os
+
+
+class Store:
+    # the format is bumped when the key or the layout of entries change
+    def __init__(self, name, fmt):
+        self.name = name
+        self.format = fmt
+        self.enabled = False
+
+    def get_dir(self, *sub):
+        return paths.cbuild_cache().joinpath(self.name, *sub)
+
+    # a hash for the key, starting with the format and the given fields
+    def hasher(self, *fields):
+        hv = hashlib.sha256()
+        hv.update(":".join(map(str, [self.format, *fields])).encode() + b"\0")
+        return hv
+
+    def lock(self, sdir, pkg=None):
+        sdir.mkdir(parents=True, exist_ok=True)
+        return flock.lock(sdir / ".lock", pkg)
+
+    # create the entry by having fill populate a temporary path, returning
+    # whether it was stored
+    def add(self, epath, fill):
+        tpath = epath.with_name(f".new-{epath.name}.{os.getpid()}")
+        shutil.rmtree(tpath, ignore_errors=True)
+        try:
+            epath.parent.mkdir(parents=True, exist_ok=True)
+            fill(tpath)
+            tpath.rename(epath)
+        except OSError:
+            # out of space, or a parallel build stored the same one
+            shutil.rmtree(tpath, ignore_errors=True)
+            return False
+        return True
+
+    def remove(self, epath):
+        tpath = epath.with_name(f".rm-{epath.name}.{os.getpid()}")
+        try:
+            epath.rename(tpath)
+        except OSError:
+            return
+        shutil.rmtree(tpath, ignore_errors=True)
+
+    # mark as recently used
+    def touch(self, epath):
+        os.utime(epath)
+
+    # drop the least recently used entries beyond the given number, along
+    # with temporaries left behind by interrupted runs
+    def evict(self, sdir, keep):
+        ents = []
+        for f in sdir.iterdir():
+            if f.name.startswith(".") or not f.is_dir():
+                continue
+            ents.append((f.stat().st_mtime, f))
+        ents.sort()
+        for mt, f in ents[0 : max(len(ents) - keep, 0)]:
+            self.remove(f)
+        for f in sdir.glob(".*-*"):
+            if f.stat().st_mtime < time.time() - 86400:
+                shutil.rmtree(f, ignore_errors=True)
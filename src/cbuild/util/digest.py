@@ -0,0 +1,34 @@
+# Hashing of files and trees, for the keys of the various caches
+
+import hashlib
+import os
+
+
+# the contents of a file, or a marker for a missing one if allowed
+def file(hv, path, missing_ok=False):
+    try:
+        with open(path, "rb") as f:
+            hv.update(hashlib.sha256(f.read()).digest())
+    except FileNotFoundError:
+        if not missing_ok:
+            raise
+        hv.update(b"-")
+
+
+# every file of the tree at root/relp with its path relative to root, and
+# symlinks as such; filt may change the contents of a file given its path
+def tree(hv, root, relp=".", filt=None):
+    path = os.path.join(root, relp)
+    if os.path.islink(path):
+        hv.update(f"{relp}\0L{os.readlink(path)}\0".encode())
+    elif os.path.isdir(path):
+        for f in sorted(os.listdir(path)):
+            if f != "__pycache__":
+                tree(hv, root, os.path.normpath(os.path.join(relp, f)), filt)
+    elif os.path.isfile(path):
+        with open(path, "rb") as f:
+            data = f.read()
+        if filt:
+            data = filt(relp, data)
+        hv.update(f"{relp}\0".encode())
+        hv.update(hashlib.sha256(data).digest())
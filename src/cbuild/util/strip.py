@@ -1,3 +1,7 @@
+import shlex
+import subprocess
+
+
 def strip(pkg, path):
     strip_path = "/usr/bin/" + pkg.rparent.get_tool("STRIP")
 
@@ -57,3 +61,111 @@ def strip_attach(pkg, path):
     rv = strip(pkg, path)
     attach_debug(pkg, path)
     return rv
+
+
+# marker for failed steps in the output of a batch
+_fail_pfx = "cbuild-strip-failed:"
+
+_fail_msgs = {
+    "dbg": "failed to create dbg file for",
+    "strip": "failed to strip",
+    "link": "failed to attach debug link to",
+}
+
+
+# collects files for strip and strip_attach and then processes all of them
+# within a single sandbox, split between a number of shell workers; each file
+# goes through the same commands in the same order as with the functions above
+class Batch:
+    def __init__(self, pkg):
+        self.pkg = pkg
+        self.files = []
+
+    def strip(self, path):
+        relp = path.relative_to(self.pkg.destdir)
+        self.files.append((relp, False))
+        return relp
+
+    def strip_attach(self, path):
+        relp = path.relative_to(self.pkg.destdir)
+        rp = self.pkg.rparent
+        self.files.append((relp, rp.options["debug"] and rp.build_dbg))
+        return relp
+
+    def _script(self, relp, attach):
+        pkg = self.pkg
+        strip_path = "/usr/bin/" + pkg.rparent.get_tool("STRIP")
+        objcopy = pkg.rparent.get_tool("OBJCOPY")
+        cfile = pkg.chroot_destdir / relp
+        steps = []
+
+        if attach:
+            dfile = pkg.destdir / "usr/lib/debug" / relp
+            dfile.parent.mkdir(parents=True, exist_ok=True)
+            dcfile = pkg.chroot_destdir / "usr/lib/debug" / relp
+            steps.append(("dbg", [objcopy, "--only-keep-debug", cfile, dcfile]))
+
+        steps.append(("strip", [strip_path, "--strip-debug", cfile]))
+
+        if attach:
+            steps.append(
+                ("link", [objcopy, f"--add-gnu-debuglink={dcfile}", cfile])
+            )
+
+        qrelp = shlex.quote(str(relp))
+        ret = []
+        for kind, cmd in steps:
+            kw = "if" if len(ret) == 0 else "elif"
+            cmd = " ".join(shlex.quote(str(v)) for v in cmd)
+            ret.append(f"{kw} ! {cmd}; then _fail {kind} {qrelp};")
+        ret.append("fi")
+
+        return " ".join(ret)
+
+    def run(self, jobs):
+        if len(self.files) == 0:
+            return
+
+        jobs = max(1, min(jobs, len(self.files)))
+        script = [f"_fail() {{ printf '%s\\n' \"{_fail_pfx}$1:$2\"; }}"]
+
+        for i in range(jobs):
+            if jobs > 1:
+                script.append("(")
+            for relp, attach in self.files[i::jobs]:
+                script.append(self._script(relp, attach))
+            if jobs > 1:
+                script.append(") &")
+
+        script.append("wait")
+
+        # too long for an argument, so pass it on stdin
+        ret = self.pkg.rparent.do(
+            "sh",
+            "-s",
+            input="\n".join(script).encode() + b"\n",
+            stdout=subprocess.PIPE,
+            check=False,
+        )
+
+        failed = {}
+        for ln in ret.stdout.decode().splitlines():
+            if not ln.startswith(_fail_pfx):
+                print(ln)
+                continue
+            kind, relp = ln[len(_fail_pfx) :].split(":", 1)
+            failed[relp] = kind
+
+        # report the first failure in the original order
+        for relp, attach in self.files:
+            kind = failed.get(str(relp))
+            if kind:
+                self.pkg.error(f"{_fail_msgs[kind]} {relp}")
+
+        if ret.returncode != 0:
+            self.pkg.error("failed to strip files")
+
+        # same as in split_debug
+        for relp, attach in self.files:
+            if attach:
+                (self.pkg.destdir / "usr/lib/debug" / relp).chmod(0o644)
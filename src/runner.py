@@ -42,6 +42,14 @@ opt_cchpath = "cbuild_cache"
 opt_stagepath = "pkgstage"
 opt_statusfd = None
 opt_bulkcont = False
+opt_bulkresume = False
+opt_bulkjobs = 1
+opt_sandboxagent = False
+opt_outcache = False
+opt_trace = False
+opt_rootsnaps = 0
+opt_bulkprefetch = 0
+opt_srccache = False
 opt_allowcat = "main contrib user"
 opt_restricted = False
 opt_updatecheck = False
@@ -96,7 +104,7 @@ def handle_options():
     global global_cfg
     global cmdline
 
-    global opt_apkcmd, opt_bwcmd, opt_dryrun, opt_bulkcont
+    global opt_apkcmd, opt_bwcmd, opt_dryrun, opt_bulkcont, opt_bulkresume
     global opt_cflags, opt_cxxflags, opt_fflags
     global opt_arch, opt_harch, opt_gen_dbg, opt_check, opt_ccache
     global opt_makejobs, opt_lthreads, opt_nocolor, opt_signkey
@@ -104,7 +112,9 @@ def handle_options():
     global opt_nonet, opt_dirty, opt_statusfd, opt_keeptemp, opt_forcecheck
     global opt_checkfail, opt_stage, opt_altrepo, opt_stagepath, opt_bldroot
     global opt_blddir, opt_pkgpath, opt_srcpath, opt_cchpath, opt_updatecheck
-    global opt_acceptsum, opt_comp
+    global opt_acceptsum, opt_comp, opt_bulkjobs, opt_sandboxagent
+    global opt_outcache, opt_trace, opt_rootsnaps, opt_bulkprefetch
+    global opt_srccache
 
     # respect NO_COLOR
     opt_nocolor = ("NO_COLOR" in os.environ) or not sys.stdout.isatty()
@@ -247,6 +257,11 @@ def handle_options():
         default=opt_dryrun,
         help="Do not perform changes to file system (only some commands)",
     )
+    parser.add_argument(
+        "--root-snapshots",
+        default=None,
+        help="Number of build roots with dependencies installed to keep.",
+    )
     parser.add_argument(
         "--status-fd",
         default=None,
@@ -259,6 +274,44 @@ def handle_options():
         default=opt_bulkcont,
         help="Try building the remaining packages in case of bulk failures.",
     )
+    parser.add_argument(
+        "--resume",
+        action="store_const",
+        const=True,
+        default=opt_bulkresume,
+        help="Resume the last bulk build from its journal.",
+    )
+    parser.add_argument(
+        "--bulk-jobs",
+        default=None,
+        help="Number of templates to build at the same time in bulk builds.",
+    )
+    parser.add_argument(
+        "--bulk-prefetch",
+        default=None,
+        help="Number of upcoming templates to fetch ahead in bulk builds.",
+    )
+    parser.add_argument(
+        "--output-cache",
+        action="store_const",
+        const=True,
+        default=opt_outcache,
+        help="Reuse packages from earlier builds with identical inputs.",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_const",
+        const=True,
+        default=opt_trace,
+        help="Record timing of build phases, hooks and commands.",
+    )
+    parser.add_argument(
+        "--wrksrc-cache",
+        action="store_const",
+        const=True,
+        default=opt_srccache,
+        help="Reuse extracted and patched sources from earlier builds.",
+    )
     parser.add_argument(
         "--update-check",
         action="store_const",
@@ -321,6 +374,16 @@ def handle_options():
             "allow_restricted", fallback=opt_restricted
         )
         opt_nonet = not bcfg.getboolean("remote", fallback=not opt_nonet)
+        opt_bulkjobs = bcfg.getint("bulk_jobs", fallback=opt_bulkjobs)
+        opt_bulkprefetch = bcfg.getint(
+            "bulk_prefetch", fallback=opt_bulkprefetch
+        )
+        opt_sandboxagent = bcfg.getboolean(
+            "sandbox_agent", fallback=opt_sandboxagent
+        )
+        opt_outcache = bcfg.getboolean("output_cache", fallback=opt_outcache)
+        opt_srccache = bcfg.getboolean("wrksrc_cache", fallback=opt_srccache)
+        opt_rootsnaps = bcfg.getint("root_snapshots", fallback=opt_rootsnaps)
 
     if "flags" not in global_cfg:
         global_cfg["flags"] = {}
@@ -416,6 +479,27 @@ def handle_options():
     if cmdline.bulk_continue:
         opt_bulkcont = True
 
+    if cmdline.resume:
+        opt_bulkresume = True
+
+    if cmdline.bulk_jobs:
+        opt_bulkjobs = int(cmdline.bulk_jobs)
+
+    if cmdline.bulk_prefetch:
+        opt_bulkprefetch = int(cmdline.bulk_prefetch)
+
+    if cmdline.output_cache:
+        opt_outcache = True
+
+    if cmdline.wrksrc_cache:
+        opt_srccache = True
+
+    if cmdline.trace:
+        opt_trace = True
+
+    if cmdline.root_snapshots:
+        opt_rootsnaps = int(cmdline.root_snapshots)
+
     if cmdline.update_check:
         opt_updatecheck = True
 
@@ -430,6 +514,9 @@ def handle_options():
     if opt_lthreads == 0:
         opt_lthreads = opt_makejobs
 
+    if opt_bulkjobs < 1:
+        opt_bulkjobs = 1
+
 
 def init_late():
     import os
@@ -884,10 +971,53 @@ def do_index(tgt):
         _index(repo)
 
 
+def _lint_one(pkgn):
+    from cbuild.core import chroot, template, errors
+
+    try:
+        tmpl = template.read_pkg(
+            pkgn,
+            opt_arch if opt_arch else chroot.host_cpu(),
+            True,
+            False,
+            (1, 1),
+            False,
+            False,
+            None,
+            target="lint",
+        )
+        # unbuildable templates are not of concern for tree-wide lint
+        if not tmpl.broken:
+            tmpl.build_lint()
+    except errors.PackageException as e:
+        return f"{e.pkg._get_pv()}: ERROR: {e}"
+    except errors.CbuildException as e:
+        return f"cbuild: {e}"
+    except Exception as e:
+        return f"{pkgn}: {type(e).__name__}: {e}"
+
+    return None
+
+
 def do_lint(tgt):
-    from cbuild.core import chroot, template
+    from cbuild.core import chroot, template, logger, metadata, errors
 
     pkgn = cmdline.command[1] if len(cmdline.command) >= 2 else None
+
+    if not pkgn:
+        tmpls = []
+        for cat in opt_allowcat.strip().split():
+            tmpls += _collect_tmpls(None, cat)
+        nfail = 0
+        # errors are reported per template, workers cannot log them
+        for pkgn, err in metadata.map_templates(_lint_one, tmpls, opt_makejobs):
+            if err:
+                logger.get().out_red(err)
+                nfail += 1
+        if nfail > 0:
+            raise errors.CbuildException(f"{nfail} template(s) failed to lint")
+        return
+
     # just read it and do nothing else
     # don't let the skip logic kick in
     template.read_pkg(
@@ -931,9 +1061,11 @@ def _collect_tmpls(pkgn, catn=None):
     return tmpls
 
 
-def _add_deps_graph(pn, tp, pvisit, rpkg, depg):
+def _add_deps_graph(pn, tp, pvisit, rpkg, depg, deps=None):
     bdl = tp.get_build_deps()
     depg.add(pn, *bdl)
+    if deps is not None:
+        deps[pn] = bdl
     # recursively eval and add deps
     succ = True
     for d in bdl:
@@ -943,7 +1075,7 @@ def _add_deps_graph(pn, tp, pvisit, rpkg, depg):
         pvisit.add(d)
         dtp = rpkg(d)
         if dtp:
-            if not _add_deps_graph(d, dtp, pvisit, rpkg, depg):
+            if not _add_deps_graph(d, dtp, pvisit, rpkg, depg, deps):
                 succ = False
         else:
             succ = False
@@ -953,7 +1085,7 @@ def _add_deps_graph(pn, tp, pvisit, rpkg, depg):
 def _graph_prepare():
     import graphlib
 
-    from cbuild.core import chroot, template, errors
+    from cbuild.core import chroot, metadata
 
     pkgn = cmdline.command[1] if len(cmdline.command) >= 2 else None
 
@@ -962,25 +1094,14 @@ def _graph_prepare():
     def _read_pkg(pkgn):
         if pkgn in rtmpls:
             return rtmpls[pkgn]
-        try:
-            tp = template.read_pkg(
-                pkgn,
-                chroot.host_cpu(),
-                True,
-                False,
-                (1, 1),
-                False,
-                False,
-                None,
-                target="lint",
-            )
+        tp = metadata.get(pkgn, chroot.host_cpu())
+        if tp:
             rtmpls[pkgn] = tp
-            return tp
-        except errors.PackageException:
-            return None
+        return tp
 
     tg = graphlib.TopologicalSorter()
     tmpls = _collect_tmpls(pkgn)
+    metadata.prefetch(tmpls, chroot.host_cpu(), opt_makejobs)
     pvisit = set()
     for tmpln in tmpls:
         # already added in another graph
@@ -991,11 +1112,13 @@ def _graph_prepare():
             continue
         _add_deps_graph(tmpln, tp, pvisit, _read_pkg, tg)
 
+    metadata.save()
+
     return tg
 
 
 def do_prune_sources(tgt):
-    from cbuild.core import chroot, logger, template, errors, paths
+    from cbuild.core import chroot, logger, metadata, paths
     import shutil
     import re
 
@@ -1004,26 +1127,17 @@ def do_prune_sources(tgt):
     exist = set()
 
     def _read_pkg(pkgn):
-        try:
-            tp = template.read_pkg(
-                pkgn,
-                chroot.host_cpu(),
-                True,
-                False,
-                (1, 1),
-                False,
-                False,
-                None,
-                target="lint",
-            )
+        tp = metadata.get_basic(pkgn, chroot.host_cpu())
+        if tp:
             exist.add(f"{tp.pkgname}-{tp.pkgver}")
-        except errors.PackageException:
-            return None
 
     logger.get().out("Reading templates...")
+    metadata.prefetch(tmpls, chroot.host_cpu(), opt_makejobs, True)
     for tmpln in tmpls:
         _read_pkg(tmpln)
 
+    metadata.save()
+
     logger.get().out("Collecting checksums...")
     shaset = set()
     for tmpln in tmpls:
@@ -1045,6 +1159,9 @@ def do_prune_sources(tgt):
     logger.get().out("Collecting inodes and pruning hardlinks...")
     inoset = set()
     for sf in (paths.sources() / "by_sha256").iterdir():
+        # digest cache of the fetch hook
+        if sf.name == ".digests.json":
+            continue
         cks = sf.name[0:64].lower()
         if (
             len(cks) != 64
@@ -1084,7 +1201,7 @@ def do_prune_sources(tgt):
 
 
 def do_relink_subpkgs(tgt):
-    from cbuild.core import chroot, paths, logger, errors, template
+    from cbuild.core import chroot, paths, logger, metadata
     import shutil
 
     ddir = paths.distdir()
@@ -1092,22 +1209,10 @@ def do_relink_subpkgs(tgt):
     cats = {}
 
     def _read_pkg(pkgn):
-        try:
-            tp = template.read_pkg(
-                pkgn,
-                chroot.host_cpu(),
-                True,
-                False,
-                (1, 1),
-                False,
-                False,
-                None,
-                target="lint",
-            )
+        tp = metadata.get_basic(pkgn, chroot.host_cpu())
+        if tp:
             links[f"{tp.repository}/{tp.pkgname}"] = tp.all_subpackages
-            return tp
-        except errors.PackageException:
-            return None
+        return tp
 
     tgt = None
     prune_bad = False
@@ -1123,11 +1228,14 @@ def do_relink_subpkgs(tgt):
         logger.get().out("Collecting templates...")
         tmpls = _collect_tmpls(None)
         logger.get().out("Reading templates...")
+        metadata.prefetch(tmpls, chroot.host_cpu(), opt_makejobs, True)
         for tmpln in tmpls:
             tp = _read_pkg(tmpln)
             if tp:
                 cats[tp.repository] = True
 
+    metadata.save()
+
     # erase all symlinks first if parsing all
     for d in cats:
         for el in (ddir / d).iterdir():
@@ -1181,7 +1289,7 @@ def do_cycle_check(tgt):
 
 
 def do_print_build_graph(tgt):
-    from cbuild.core import chroot, template, errors
+    from cbuild.core import chroot, metadata, errors
 
     if len(cmdline.command) < 2:
         raise errors.CbuildException("print-build-graph needs a package name")
@@ -1191,22 +1299,10 @@ def do_print_build_graph(tgt):
     def _read_pkg(pkgn):
         if pkgn in rtmpls:
             return rtmpls[pkgn]
-        try:
-            tp = template.read_pkg(
-                pkgn,
-                chroot.host_cpu(),
-                True,
-                False,
-                (1, 1),
-                False,
-                False,
-                None,
-                target="lint",
-            )
+        tp = metadata.get(pkgn, chroot.host_cpu())
+        if tp:
             rtmpls[pkgn] = tp
-            return tp
-        except errors.PackageException:
-            return None
+        return tp
 
     root = _read_pkg(cmdline.command[1])
 
@@ -1224,10 +1320,47 @@ def do_print_build_graph(tgt):
 
     _print_deps(root)
 
+    metadata.save()
+
+
+def do_print_rebuilds(tgt):
+    from cbuild.core import chroot, metadata, paths, errors, rebuilds
+    from cbuild.apk import index
+
+    if len(cmdline.command) < 2:
+        raise errors.CbuildException(
+            "print-rebuilds needs a template or expression"
+        )
+
+    tarch = opt_arch if opt_arch else chroot.host_cpu()
+    changed = _collect_blist(cmdline.command[1:])
+
+    # the reverse index needs every template
+    tmpls = _collect_tmpls(None)
+    metadata.prefetch(tmpls, tarch, opt_makejobs)
+    infos = {}
+    for pn in tmpls:
+        info = metadata.get(pn, tarch)
+        if info:
+            infos[pn] = info
+    metadata.save()
+
+    ndxs = []
+    for cat in opt_allowcat.strip().split():
+        for repop in [paths.stage_repository() / cat, paths.repository() / cat]:
+            if not (repop / tarch / "APKINDEX.tar.gz").is_file():
+                continue
+            ndx = index.load_repo(repop, tarch)
+            if ndx:
+                ndxs.append(ndx)
+
+    for pn in rebuilds.get(changed, infos, ndxs):
+        print(pn)
+
 
 def _get_unbuilt():
-    from cbuild.core import chroot, template, paths
-    from cbuild.apk import util
+    from cbuild.core import chroot, metadata, paths
+    from cbuild.apk import util, index
     import subprocess
 
     cats = opt_allowcat.strip().split()
@@ -1244,6 +1377,19 @@ def _get_unbuilt():
     def _collect_vers(repop):
         if not (repop / tarch / "APKINDEX.tar.gz").is_file():
             return
+        ndx = index.load_repo(repop, tarch)
+        if ndx:
+            # like below, versions of origins, but prefer the version
+            # of the main package in case a subpackage is out of date
+            rvers = {}
+            for pkg in ndx.packages:
+                if pkg.origin in rvers and pkg.name != pkg.origin:
+                    continue
+                rvers[pkg.origin] = pkg.version
+            for pn, pv in rvers.items():
+                if pn not in repovers:
+                    repovers[pn] = pv
+            return
         outp = subprocess.run(
             [
                 paths.apk(),
@@ -1280,41 +1426,25 @@ def _get_unbuilt():
         _collect_vers(paths.repository() / cat)
 
     vers = []
-    mods = {}
 
+    metadata.prefetch(tmpls, tarch, opt_makejobs, True)
+
+    # only the versions are needed to tell what is unbuilt
     for pn in tmpls:
-        modv, tmplv = template.read_mod(
-            pn,
-            tarch,
-            True,
-            False,
-            (1, 1),
-            False,
-            False,
-            None,
-        )
-        mods[pn] = (modv, tmplv)
+        info = metadata.get_basic(pn, tarch)
         # if something is wrong, mark it unbuilt, error on build later
-        if (
-            not hasattr(modv, "pkgname")
-            or not hasattr(modv, "pkgver")
-            or not hasattr(modv, "pkgrel")
-        ):
+        if not info:
             vers.append(pn)
-        # get the metadata we need
-        apn = getattr(modv, "pkgname")
-        apv = getattr(modv, "pkgver")
-        apr = getattr(modv, "pkgrel")
-        if apv is None or apr is None:
-            prv = ""
-        else:
-            prv = f"{apv}-r{apr}"
+            continue
+        prv = f"{info.pkgver}-r{info.pkgrel}"
         # skip templates that are exact match
-        if apn in repovers and repovers[apn] == prv:
+        if info.pkgname in repovers and repovers[info.pkgname] == prv:
             continue
         # otherwise build it
         vers.append(pn)
 
+    metadata.save()
+
     if not vers:
         return []
 
@@ -1322,17 +1452,23 @@ def _get_unbuilt():
     tvers = {}
     tmpls = {}
 
+    # everything else needs to be evaluated fully
+    metadata.prefetch(vers, tarch, opt_makejobs)
+
     def _get_tmpl(pn):
         try:
-            tmpl = template.from_module(*mods[pn])
-            tmpls[pn] = tmpl
-            tvers[pn] = f"{tmpl.pkgver}-r{tmpl.pkgrel}"
-            # sentinel
-            if tmpls[pn].broken:
-                tmpls[pn] = True
-                return True
+            tmpl = metadata.get(pn, tarch)
         except Exception:
+            tmpl = None
+        if not tmpl:
             tmpls[pn] = False
+            return False
+        tmpls[pn] = tmpl
+        tvers[pn] = f"{tmpl.pkgver}-r{tmpl.pkgrel}"
+        # sentinel
+        if tmpl.broken:
+            tmpls[pn] = True
+            return True
         return False
 
     def _check_tmpls(pn):
@@ -1366,6 +1502,8 @@ def _get_unbuilt():
             continue
         fvers.append(pn)
 
+    metadata.save()
+
     if not fvers:
         return []
 
@@ -1379,6 +1517,8 @@ def _get_unbuilt():
             continue
         fvers.append((pn, tvers[pn] if pn in tvers else None))
 
+    metadata.save()
+
     return fvers
 
 
@@ -1475,12 +1615,14 @@ def do_update_check(tgt):
         ),
     )
 
-    for tmpl in stmpls:
+    # the checks run concurrently, the results come in order
+    for tmpl, cv, msgs in update_check.update_check_all(stmpls):
         if tmpl.maintainer != maint:
             maint = tmpl.maintainer
             pmaint = False
-        # check each package, print maintainer when we find something
-        cv = update_check.update_check(tmpl, verbose)
+        for msg in msgs:
+            print(msg)
+        # print maintainer when we find something
         if cv and not pmaint:
             if first:
                 first = False
@@ -1586,15 +1728,255 @@ def do_pkg(tgt, pkgn=None, force=None, check=None, stage=None):
         do_unstage(tgt, bstage < 3)
 
 
-def _bulkpkg(pkgs, statusf, do_build, do_raw):
+def _bulk_child_args(pn, cfgp):
+    import sys
+
+    # every child gets its own temporary build root and keeps its
+    # packages staged, unstaging happens once the whole bulk is done
+    args = [
+        sys.executable,
+        f"{rtpath}/cbuild",
+        "-c",
+        str(cfgp),
+        "-b",
+        opt_bldroot,
+        "-r",
+        opt_pkgpath,
+        "-s",
+        opt_srcpath,
+        "--stage-path",
+        opt_stagepath,
+        "-j",
+        str(opt_makejobs),
+        "-t",
+        "-L",
+        "--stage",
+    ]
+    if opt_arch:
+        args += ["-a", opt_arch]
+    if opt_harch:
+        args += ["-A", opt_harch]
+    if opt_blddir:
+        args += ["-B", opt_blddir]
+    if opt_altrepo:
+        args += ["-R", opt_altrepo]
+    if opt_force:
+        args.append("-f")
+    if not opt_check:
+        args.append("-C")
+    if opt_forcecheck:
+        args.append("--force-check")
+    if opt_checkfail:
+        args.append("-X")
+    if not opt_gen_dbg:
+        args.append("-G")
+    if opt_nonet:
+        args.append("-N")
+    if opt_keeptemp:
+        args.append("-K")
+    if opt_unsigned:
+        args.append("--allow-unsigned")
+    if opt_updatecheck:
+        args.append("--update-check")
+    if opt_acceptsum:
+        args.append("--accept-checksums")
+    if opt_outcache:
+        args.append("--output-cache")
+    if opt_trace:
+        args.append("--trace")
+    if opt_srccache:
+        args.append("--wrksrc-cache")
+    if opt_rootsnaps:
+        args += ["--root-snapshots", str(opt_rootsnaps)]
+
+    return args + ["pkg", pn]
+
+
+def _bulkpkg_parallel(flist, depg, chains, statusf, do_raw):
+    import os
+    import queue
+    import threading
+    import subprocess
+
+    from cbuild.core import logger, paths
+
+    log = logger.get()
+    failed = False
+    pending = set(flist)
+    ready = []
+    running = {}
+    doneq = queue.Queue()
+
+    logdir = paths.cbuild_cache() / "bulk_logs"
+    logdir.mkdir(parents=True, exist_ok=True)
+
+    # the children get the configuration as it was read by us, as the
+    # settings that only come from it have to be the same for all
+    cfgp = logdir / f".config.{os.getpid()}.ini"
+    with open(cfgp, "w") as cf:
+        global_cfg.write(cf)
+
+    def _run(pn, proc, logf):
+        proc.wait()
+        logf.close()
+        doneq.put(pn)
+
+    def _spawn(pn):
+        logp = logdir / f"{pn.replace('/', '_')}.log"
+        logf = open(logp, "w")
+        log.out(f"cbuild: building '{pn}' (log: {logp})")
+        proc = subprocess.Popen(
+            _bulk_child_args(pn, cfgp),
+            stdin=subprocess.DEVNULL,
+            stdout=logf,
+            stderr=subprocess.STDOUT,
+        )
+        running[pn] = (proc, logp)
+        threading.Thread(target=_run, args=(pn, proc, logf)).start()
+
+    # raw mode does not order anything, so just add the plain nodes
+    if do_raw:
+        for pn in flist:
+            depg.add(pn)
+
+    depg.prepare()
+
+    try:
+        while depg.is_active():
+            # collect whatever can be built now; things that are in the
+            # graph but not being built (already built, or intermediate
+            # deps not part of the set) are immediately resolved
+            while True:
+                nready = depg.get_ready()
+                if len(nready) == 0:
+                    break
+                for pn in sorted(nready):
+                    if pn in pending:
+                        ready.append(pn)
+                    else:
+                        depg.done(pn)
+            # fill the free slots, longest chains first
+            ready.sort(key=lambda p: -chains.get(p, 0))
+            while len(ready) > 0 and len(running) < opt_bulkjobs:
+                if failed and not opt_bulkcont:
+                    break
+                pn = ready.pop(0)
+                pending.discard(pn)
+                _spawn(pn)
+            # nothing to wait for anymore
+            if len(running) == 0:
+                break
+            pn = doneq.get()
+            proc, logp = running.pop(pn)
+            if proc.returncode == 0:
+                log.out_green(f"cbuild: built '{pn}'")
+                statusf.write(f"{pn} ok\n")
+                depg.done(pn)
+            else:
+                log.out_red(f"cbuild: failed to build '{pn}' (log: {logp})")
+                statusf.write(f"{pn} failed\n")
+                failed = True
+                # with continue, dependents are still attempted, like
+                # they would be in a serial bulk build
+                if opt_bulkcont:
+                    depg.done(pn)
+    finally:
+        # interrupted, make sure the children do not linger around
+        for pn, (proc, logp) in running.items():
+            proc.terminate()
+        for pn, (proc, logp) in running.items():
+            proc.wait()
+        cfgp.unlink(missing_ok=True)
+
+    # whatever did not get to build at this point was skipped
+    for pn in flist:
+        if pn in pending:
+            statusf.write(f"{pn} skipped\n")
+            log.out_red(f"cbuild: skipping template '{pn}'")
+
+    return failed
+
+
+def _bulk_estimates(flist, arch):
+    from cbuild.core import history
+
+    hist = history.get_estimates(arch)
+    ests = {}
+    known = []
+    for pn in flist:
+        est = hist.get(pn.split("/")[-1])
+        if est is not None:
+            ests[pn] = est
+            known.append(est)
+    # assume an average build for anything never built before
+    if len(known) > 0:
+        avg = sum(known) / len(known)
+        for pn in flist:
+            if pn not in ests:
+                ests[pn] = avg
+    return ests
+
+
+def _fmt_duration(secs):
+    secs = int(secs)
+    if secs >= 3600:
+        return f"{secs // 3600}h{(secs % 3600) // 60:02}m"
+    return f"{secs // 60}m{secs % 60:02}s"
+
+
+def _bulk_print_estimate(flist, ests, chains, nexts):
+    from cbuild.core import logger, history
+
+    if len(flist) == 0 or len(ests) == 0:
+        return
+
+    log = logger.get()
+
+    crit = max(flist, key=lambda p: chains.get(p, 0))
+    cpath = [pn for pn in history.get_path(crit, nexts) if pn in ests]
+    total = max(sum(ests.values()) / opt_bulkjobs, chains[crit])
+
+    # the standard output may be consumed by other tools
+    log.estream.write(
+        f"=> cbuild: estimated build time: {_fmt_duration(total)}, "
+        f"critical path: {_fmt_duration(chains[crit])} "
+        f"({' -> '.join(cpath)})\n"
+    )
+
+
+def _bulk_trace_summary(pkgs):
+    import json
+
+    from cbuild.core import logger, paths, trace
+
+    log = logger.get()
+    summ = trace.summarize(pkgs)
+
+    sump = paths.cbuild_cache() / "traces" / "bulk-summary.json"
+    sump.parent.mkdir(parents=True, exist_ok=True)
+    with open(sump, "w") as f:
+        json.dump(summ, f, indent=2)
+
+    log.out(f"cbuild: timing summary (full: {sump})")
+    for k in summ:
+        log.out_plain(f"  {k}:")
+        for n, v in list(summ[k].items())[0:10]:
+            log.out_plain(f"    {v / 1000:10.2f}s  {n}")
+
+
+def _bulkpkg(
+    pkgs, statusf, do_build, do_raw, jnl=None, finished={}, graph=None
+):
     import pathlib
     import graphlib
     import traceback
 
-    from cbuild.core import logger, template, chroot, errors, build
+    from cbuild.core import logger, template, chroot, errors, build, paths
+    from cbuild.core import history
 
     # we will use this for correct dependency ordering
     depg = graphlib.TopologicalSorter()
+    deps = {}
     templates = {}
     failed = False
     log = logger.get()
@@ -1646,6 +2028,7 @@ def _bulkpkg(pkgs, statusf, do_build, do_raw):
     # the result is a set of unambiguous, basic template names
     rpkgs = set()
     badpkgs = set()
+    fpkgs = set()
     for pn in pkgs:
         # skip what's already handled
         if pn in rpkgs or pn in badpkgs:
@@ -1677,6 +2060,12 @@ def _bulkpkg(pkgs, statusf, do_build, do_raw):
             statusf.write(f"{pn} missing\n")
             log.out_red(f"cbuild: missing package '{pn}'")
             failed = True
+        # finished in the bulk being resumed, report as it was
+        if pn in finished:
+            if pn not in fpkgs:
+                statusf.write(f"{pn} {finished[pn]}\n")
+                fpkgs.add(pn)
+            continue
         # finally add to set
         rpkgs.add(pn)
 
@@ -1685,7 +2074,17 @@ def _bulkpkg(pkgs, statusf, do_build, do_raw):
     # ignore minor errors in templates like lint as those do not concern us
     # allow broken because that does not concern us yet either (handled later)
     # do not ignore missing tmpls because that is likely error in main tmpl
-    pvisit = set(rpkgs)
+    pvisit = set(rpkgs) | fpkgs
+
+    # the graph of the bulk being resumed, which does not need resolving;
+    # what was to be built then was not built yet, bar finished templates
+    gdeps, gflist = graph or ({}, [])
+    gflist = set(gflist)
+    for pn, dl in gdeps.items():
+        depg.add(pn, *dl)
+        deps[pn] = dl
+        pvisit.add(pn)
+        pvisit.update(dl)
 
     def handle_recdeps(pn, tp):
         # in raw mode we don't care about ordering, taking it as is
@@ -1708,6 +2107,7 @@ def _bulkpkg(pkgs, statusf, do_build, do_raw):
                 )
             ),
             depg,
+            deps,
         )
 
     rpkgs = sorted(list(rpkgs))
@@ -1759,7 +2159,7 @@ def _bulkpkg(pkgs, statusf, do_build, do_raw):
         # package, i.e., unparseable dep is like unparseable main, except
         # broken (but parseable) packages are special (and are considered
         # for the purposes of ordering)
-        if not handle_recdeps(pn, tp):
+        if pn not in gdeps and not handle_recdeps(pn, tp):
             if failed:
                 statusf.write(f"{pn} parse\n")
             else:
@@ -1770,31 +2170,61 @@ def _bulkpkg(pkgs, statusf, do_build, do_raw):
         templates[pn] = tp
 
     flist = []
+    chains = {}
     # generate the final bulk list
     if not failed or opt_bulkcont:
-        if do_raw:
-            ordl = pkgs
-        else:
-            ordl = depg.static_order()
         # if we're raw, we iterate the input list as is
-        for pn in ordl:
+        for pn in pkgs if do_raw else sorted(templates):
             # skip things that were not in the initial set
             if pn not in templates:
                 continue
             tp = templates[pn]
             # if already built, mark it specially
-            if not opt_force and tp.is_built(not do_build):
+            if not opt_force and pn not in gflist and tp.is_built(not do_build):
                 statusf.write(f"{pn} done\n")
                 continue
             flist.append(pn)
+        # start the longest chains of builds first, as far as known
+        ests = _bulk_estimates(flist, tarch)
+        chains, nexts = history.get_chains(ests, deps)
+        # the graph itself is consumed by the parallel scheduler
+        if not do_raw and (not do_build or opt_bulkjobs == 1):
+            fset = set(flist)
+            flist = [pn for pn in history.order(depg, chains) if pn in fset]
+        _bulk_print_estimate(flist, ests, chains, nexts)
+        if jnl:
+            jnl.graph({pn: list(deps[pn]) for pn in deps}, flist)
 
     if not failed or opt_bulkcont:
         if not do_build:
             if len(flist) > 0:
                 print(" ".join(flist))
+        elif opt_bulkjobs > 1:
+            if _bulkpkg_parallel(flist, depg, chains, statusf, do_raw):
+                failed = True
         else:
-            for pn in flist:
+            pf = None
+            if opt_bulkprefetch > 0 and not opt_nonet:
+                from cbuild.core import prefetch
+                import functools
+
+                pf = prefetch.Prefetcher(
+                    paths.cbuild_cache() / "bulk_logs", opt_acceptsum
+                )
+            for i, pn in enumerate(flist):
                 tp = templates[pn]
+                # fetch what comes next while this one builds, but only
+                # once it has its own sources, as both need the lock
+                prefetch_next = None
+                if pf:
+                    prefetch_next = functools.partial(
+                        pf.schedule,
+                        [
+                            templates[npn]
+                            for npn in flist[i + 1 : i + 1 + opt_bulkprefetch]
+                        ],
+                    )
+
                 # if we previously failed and want it this way, skip
                 if failed and not opt_bulkcont:
                     statusf.write(f"{pn} skipped\n")
@@ -1811,11 +2241,20 @@ def _bulkpkg(pkgs, statusf, do_build, do_raw):
                         check_fail=opt_checkfail,
                         update_check=opt_updatecheck,
                         accept_checksums=opt_acceptsum,
+                        after_fetch=prefetch_next,
                     )
                 ):
                     statusf.write(f"{pn} ok\n")
                 else:
                     statusf.write(f"{pn} failed\n")
+                # in case it never got to fetching (e.g. restored outputs)
+                if prefetch_next:
+                    prefetch_next()
+            if pf:
+                pf.stop()
+
+    if opt_trace and do_build and len(flist) > 0:
+        _bulk_trace_summary([templates[pn] for pn in flist])
 
     if failed:
         raise errors.CbuildException("at least one bulk package failed")
@@ -1844,8 +2283,7 @@ def _repo_check():
 
 
 def _collect_git(expr):
-    from cbuild.core import errors
-    import subprocess
+    from cbuild.core import errors, gitmeta
     import pathlib
 
     # check if we're in a repository, once
@@ -1862,7 +2300,7 @@ def _collect_git(expr):
     if ".." not in expr:
         expr = f"{expr}^1..{expr}"
     # make up arguments
-    cmd = ["git", "rev-list"]
+    cmd = []
     # add grep if requested
     if len(gexpr) > 0:
         nocase = gexpr.startswith("^")
@@ -1880,23 +2318,14 @@ def _collect_git(expr):
             cmd.append(gexpr)
     # add commit pattern
     cmd.append(expr)
-    # locate the commit list
-    subp = subprocess.run(cmd, capture_output=True)
-    if subp.returncode != 0:
-        raise errors.CbuildException(f"failed to resolve commits for '{oexpr}'")
-    # collect changed templates
+    # collect changed templates, in a single pass over the commits
     tmpls = set()
-    for commit in subp.stdout.strip().split():
-        subp = subprocess.run(
-            ["git", "diff-tree", "--no-commit-id", "--name-only", "-r", commit],
-            capture_output=True,
-        )
-        if subp.returncode != 0:
-            raise errors.CbuildException(
-                f"failed to resolve files for '{commit.decode()}'"
-            )
-        for fname in subp.stdout.strip().split(b"\n"):
-            fname = fname.decode()
+    try:
+        commits = list(gitmeta.log(*cmd, timestamps=False))
+    except errors.CbuildException:
+        raise errors.CbuildException(f"failed to resolve commits for '{oexpr}'")
+    for commit, ts, fnames in commits:
+        for fname in fnames:
             tn = fname.removesuffix("/template.py")
             if tn == fname or len(tn.split("/")) != 2:
                 continue
@@ -1973,9 +2402,18 @@ def _collect_blist(pkgs):
 
 def do_bulkpkg(tgt, do_build=True, do_raw=False):
     import os
-    from cbuild.core import errors
+    from cbuild.core import errors, chroot, journal
 
-    if do_raw:
+    tarch = opt_arch if opt_arch else chroot.host_cpu()
+    finished = {}
+    graph = None
+
+    if opt_bulkresume:
+        jdata = journal.load(tarch)
+        if not jdata:
+            raise errors.CbuildException("no bulk build to resume")
+        pkgs, finished, graph = jdata
+    elif do_raw:
         if len(cmdline.command) <= 1:
             raise errors.CbuildException("need at least one template")
         pkgs = cmdline.command[1:]
@@ -1995,8 +2433,16 @@ def do_bulkpkg(tgt, do_build=True, do_raw=False):
         # fallback so we always have an object
         sout = open(os.devnull, "w")
 
+    # status changes are journaled as they are written
+    jnl = None
+    if do_build:
+        jnl = journal.Journal(tarch, sout, opt_bulkresume)
+        if not opt_bulkresume:
+            jnl.start(pkgs)
+        sout = jnl
+
     try:
-        _bulkpkg(pkgs, sout, do_build, do_raw)
+        _bulkpkg(pkgs, sout, do_build, do_raw, jnl, finished, graph)
     except Exception:
         sout.close()
         raise
@@ -2121,7 +2567,7 @@ def fire():
     import subprocess
 
     from cbuild.core import chroot, logger, template, profile
-    from cbuild.core import paths, errors
+    from cbuild.core import paths, errors, outcache, trace, snapshot, srccache
     from cbuild.apk import cli
 
     logger.init(not opt_nocolor)
@@ -2132,6 +2578,12 @@ def fire():
     else:
         chroot.set_host(cli.get_arch())
 
+    chroot.set_agent(opt_sandboxagent)
+    outcache.set_enabled(opt_outcache)
+    trace.set_enabled(opt_trace)
+    snapshot.set_max(opt_rootsnaps)
+    srccache.set_enabled(opt_srccache)
+
     # check container and while at it perform arch checks
     chroot.chroot_check()
 
@@ -2217,6 +2669,8 @@ def fire():
                 do_prepare_upgrade(cmd)
             case "print-build-graph":
                 do_print_build_graph(cmd)
+            case "print-rebuilds":
+                do_print_rebuilds(cmd)
             case "print-unbuilt":
                 do_print_unbuilt(cmd, False)
             case "prune-pkgs":
@@ -2264,5 +2718,10 @@ def fire():
         traceback.print_exc(file=logger.get().estream)
         sys.exit(1)
     finally:
+        nupd, nskip = chroot.update_stats()
+        if nskip > 0:
+            logger.get().out(
+                f"cbuild: skipped {nskip} of {nupd + nskip} build root updates"
+            )
         if opt_mdirtemp and not opt_keeptemp:
             shutil.rmtree(paths.bldroot())
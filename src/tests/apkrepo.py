@@ -0,0 +1,93 @@
+# Writing of apk repository indexes for the tests
+#
+# Only the parts of the v3 (adb) format the reader uses are written, and
+# the dependency match flags are spelled out as defined by apk_version.h,
+# so that the reader is checked against them rather than against itself.
+
+from cbuild.apk import index, util
+
+import struct
+
+# dependency match flags
+_apk_match = {"=": 1, "<": 2, ">": 4, "~": 8, "!": 16}
+
+
+class AdbWriter:
+    def __init__(self):
+        # compat version, version, reserved and the root value
+        self.buf = bytearray(8)
+
+    def _put(self, data):
+        off = len(self.buf)
+        self.buf += data
+        return off
+
+    def blob(self, s):
+        data = s.encode()
+        return (index._ADB_TYPE_BLOB_8 << 28) | self._put(
+            bytes([len(data)]) + data
+        )
+
+    def int(self, v):
+        return (index._ADB_TYPE_INT << 28) | v
+
+    # fields are a mapping of field index to value
+    def obj(self, fields, vtype=index._ADB_TYPE_OBJECT):
+        num = max(fields, default=0) + 1
+        slots = [num] + [fields.get(i, 0) for i in range(1, num)]
+        return (vtype << 28) | self._put(struct.pack(f"<{num}I", *slots))
+
+    def array(self, vals):
+        return self.obj(
+            {i + 1: v for i, v in enumerate(vals)}, index._ADB_TYPE_ARRAY
+        )
+
+    def dep(self, dep):
+        match = 0
+        if dep.startswith("!"):
+            match |= _apk_match["!"]
+            dep = dep[1:]
+        name, op, ver = util.split_dep(dep)
+        fields = {index._ADBI_DEP_NAME: self.blob(name)}
+        if ver:
+            for c in op:
+                match |= _apk_match[c]
+            if op == "~":
+                match |= _apk_match["="]
+            fields[index._ADBI_DEP_VERSION] = self.blob(ver)
+        if match:
+            fields[index._ADBI_DEP_MATCH] = self.int(match)
+        return self.obj(fields)
+
+    # packages are tuples of name, version, provides and depends, and
+    # optionally install_if and origin
+    def finish(self, pkgs):
+        pvals = []
+        for name, ver, provides, depends, *rest in pkgs:
+            fields = {
+                index._ADBI_PI_NAME: self.blob(name),
+                index._ADBI_PI_VERSION: self.blob(ver),
+                index._ADBI_PI_DEPENDS: self.array(
+                    [self.dep(d) for d in depends]
+                ),
+                index._ADBI_PI_PROVIDES: self.array(
+                    [self.dep(p) for p in provides]
+                ),
+            }
+            if len(rest) > 0:
+                fields[index._ADBI_PI_INSTALL_IF] = self.array(
+                    [self.dep(d) for d in rest[0]]
+                )
+            if len(rest) > 1:
+                fields[index._ADBI_PI_ORIGIN] = self.blob(rest[1])
+            pvals.append(self.obj(fields))
+        root = self.obj({index._ADBI_NDX_PACKAGES: self.array(pvals)})
+        struct.pack_into("<I", self.buf, 4, root)
+        hdr = (index._ADB_BLOCK_ADB << 30) | (len(self.buf) + 4)
+        return b"ADB.indx" + struct.pack("<I", hdr) + bytes(self.buf)
+
+
+def write_index(path, pkgs):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(AdbWriter().finish(pkgs))
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+#
+# Generate the apk version conformance corpus
+#
+# Builds a deterministic set of versions (valid and invalid ones, sharing
+# prefixes so that comparisons reach every kind of component) and records
+# how apk itself validates and compares them, the same way cbuild used to
+# ask it. The result is written into data/apk_versions.txt, which is then
+# checked against the native implementation by test_apk_version.py.
+#
+# Usage: gen_apk_versions.py path/to/apk [output]
+
+import subprocess
+import pathlib
+import random
+import sys
+
+_pdir = pathlib.Path(__file__).parent
+
+# how many random versions to generate, and how many random pairs of them
+# to compare on top of the neighbouring ones
+_nvers = 1500
+_npairs = 3000
+
+_nums = ["0", "1", "2", "9", "10", "11", "99", "100", "01", "001", "010"]
+_letters = ["a", "b", "z"]
+_suffixes = ["alpha", "beta", "pre", "rc", "cvs", "svn", "git", "hg", "p"]
+_hashes = ["0", "1", "a", "deadbeef", "0123456789abcdef"]
+
+# handwritten ones, including the invalid forms apk rejects
+_fixed = [
+    "0",
+    "1",
+    "1.0",
+    "1.0.0",
+    "1.0a",
+    "1.0_rc1",
+    "1.0_rc",
+    "1.0_p1",
+    "1.0_alpha_beta",
+    "1.0_p1_rc2",
+    "1.0~abc",
+    "1.0~abc-r1",
+    "1.0-r0",
+    "1.0-r10",
+    "1.0_git20240101-r2",
+    "",
+    "a",
+    "a1",
+    "1.",
+    "1..0",
+    ".1",
+    "1.0A",
+    "1.0ab",
+    "1.0_foo",
+    "1.0_",
+    "1.0-r",
+    "1.0-1",
+    "1.0-r1-r2",
+    "1.0~",
+    "1.0~xyz",
+    "1.0~abc~def",
+    "1.0a.1",
+    "1.0_rc1.1",
+    "1.0-r1_p1",
+    "1_0",
+]
+
+
+def _gen_version(rnd):
+    ret = rnd.choice(_nums)
+    for i in range(rnd.randrange(4)):
+        ret += "." + rnd.choice(_nums)
+    if rnd.random() < 0.2:
+        ret += rnd.choice(_letters)
+    for i in range(rnd.choice([0, 0, 0, 1, 1, 2])):
+        ret += "_" + rnd.choice(_suffixes)
+        if rnd.random() < 0.6:
+            ret += rnd.choice(_nums)
+    if rnd.random() < 0.1:
+        ret += "~" + rnd.choice(_hashes)
+    if rnd.random() < 0.5:
+        ret += "-r" + rnd.choice(_nums)
+    # occasionally break it somewhere
+    if rnd.random() < 0.05:
+        pos = rnd.randrange(len(ret) + 1)
+        ret = ret[:pos] + rnd.choice(".-_~Ax") + ret[pos:]
+    return ret
+
+
+def _apk(apk, *args):
+    return subprocess.run(
+        [apk, "version", "--quiet", *args], capture_output=True
+    )
+
+
+# as cbuild used to check versions before doing it natively
+def _apk_check(apk, v):
+    # buggy apk behavior
+    if not v[0:1].isdigit():
+        return False
+    return _apk(apk, "--check", v).returncode == 0
+
+
+def _apk_test(apk, v1, v2):
+    v = _apk(apk, "--test", v1, v2).stdout.strip()
+    if v == b"=":
+        return "="
+    elif v == b"<":
+        return "<"
+    return ">"
+
+
+def generate(apk):
+    rnd = random.Random(0)
+
+    vers = list(_fixed)
+    seen = set(vers)
+    while len(vers) < len(_fixed) + _nvers:
+        v = _gen_version(rnd)
+        if v not in seen:
+            seen.add(v)
+            vers.append(v)
+
+    # neighbours in sorted order share long prefixes
+    svers = sorted(v for v in vers if len(v) > 0)
+    pairs = list(zip(svers, svers[1:]))
+    for i in range(_npairs):
+        pairs.append((rnd.choice(svers), rnd.choice(svers)))
+    # and everything handwritten against each other
+    for v1 in _fixed:
+        for v2 in _fixed:
+            if len(v1) > 0 and len(v2) > 0:
+                pairs.append((v1, v2))
+
+    ret = []
+    for v in vers:
+        ret.append(("c", v, "1" if _apk_check(apk, v) else "0"))
+    for v1, v2 in pairs:
+        ret.append(("t", v1, v2, _apk_test(apk, v1, v2)))
+    return ret
+
+
+# versions may be empty, so fields are separated by tabs
+def load(path):
+    ret = []
+    with open(path) as f:
+        for ln in f:
+            ln = ln.rstrip("\n")
+            if len(ln) == 0 or ln.startswith("#"):
+                continue
+            ret.append(tuple(ln.split("\t")))
+    return ret
+
+
+def write(path, ents, apk):
+    aver = _apk(apk, "--version").stdout.decode().strip()
+    with open(path, "w") as f:
+        f.write(f"# generated by {pathlib.Path(__file__).name} with {aver}\n")
+        for ent in ents:
+            f.write("\t".join(ent) + "\n")
+
+
+# the entries where cbuild disagrees with the recorded results
+def check(ents):
+    sys.path.insert(0, str(_pdir.parent))
+
+    from cbuild.apk import cli
+
+    ops = {-1: "<", 0: "=", 1: ">"}
+    ret = []
+    for ent in ents:
+        if ent[0] == "c":
+            got = "1" if cli.check_version(ent[1]) else "0"
+            if got != ent[2]:
+                ret.append((ent, got))
+        else:
+            got = ops[cli.compare_version(ent[1], ent[2], False)]
+            if got != ent[3]:
+                ret.append((ent, got))
+    return ret
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit(f"usage: {sys.argv[0]} apk [output]")
+
+    apk = sys.argv[1]
+    if len(sys.argv) > 2:
+        outp = pathlib.Path(sys.argv[2])
+    else:
+        outp = _pdir / "data/apk_versions.txt"
+
+    ents = generate(apk)
+    outp.parent.mkdir(parents=True, exist_ok=True)
+    write(outp, ents, apk)
+
+    bad = check(ents)
+    for ent, got in bad:
+        print(f"mismatch: {ent!r}, got {got!r}")
+    print(f"{len(ents)} entries, {len(bad)} mismatches")
+    sys.exit(1 if bad else 0)
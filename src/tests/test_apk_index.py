@@ -0,0 +1,355 @@
+# Checks of the native apk index reader and writer
+
+from cbuild.core import paths, logger
+from cbuild.apk import index, cli, sign as asign
+
+import apkrepo
+import pathlib
+import tarfile
+import pytest
+import zlib
+import io
+import sys
+import os
+
+# the operators of apk dependencies and their match masks, as assigned by
+# apk_version_result_mask in apk-tools
+_ops = {
+    "<": index._MATCH_LESS,
+    "<=": index._MATCH_LESS | index._MATCH_EQUAL,
+    "=": index._MATCH_EQUAL,
+    ">=": index._MATCH_GREATER | index._MATCH_EQUAL,
+    ">": index._MATCH_GREATER,
+    "~": index._MATCH_FUZZY | index._MATCH_EQUAL,
+}
+
+
+_v2_text = """C:Q1AAAA=
+P:libfoo
+V:1.0-r0
+A:x86_64
+o:foo
+p:so:libfoo.so.1=1.0 pc:foo=1.0
+D:so:libc.so
+
+P:foo
+V:1.0-r0
+D:libfoo=1.0-r0 !foo-legacy
+i:bar foo-base>=1.0
+
+P:foo
+V:1.1-r0
+D:libfoo>=1.0-r0
+
+P:broken
+"""
+
+
+def _write_v2(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = text.encode()
+    with tarfile.open(path, "w:gz") as tf:
+        ti = tarfile.TarInfo("DESCRIPTION")
+        tf.addfile(ti, io.BytesIO(b""))
+        ti = tarfile.TarInfo("APKINDEX")
+        ti.size = len(data)
+        tf.addfile(ti, io.BytesIO(data))
+
+
+def _check_foo(ndx):
+    assert sorted(ndx.names) == ["foo", "libfoo"]
+    assert ndx.versions("foo") == ["1.0-r0", "1.1-r0"]
+    assert ndx.versions("bar") == []
+
+    libfoo = ndx.names["libfoo"][0]
+    assert libfoo.origin == "foo"
+    assert libfoo.provides == [("so:libfoo.so.1", "1.0"), ("pc:foo", "1.0")]
+    assert libfoo.depends == ["so:libc.so"]
+
+    foo = [p for p in ndx.names["foo"] if p.version == "1.0-r0"][0]
+    assert foo.origin == "foo"
+    assert foo.depends == ["libfoo=1.0-r0", "!foo-legacy"]
+    assert foo.install_if == ["bar", "foo-base>=1.0"]
+
+    assert sorted(ndx.providers) == ["pc:foo", "so:libfoo.so.1"]
+    assert [(p.name, v) for p, v in ndx.whatprovides("pc:foo")] == [
+        ("libfoo", "1.0")
+    ]
+    assert sorted((p.name, v) for p, v in ndx.whatprovides("foo")) == [
+        ("foo", "1.0-r0"),
+        ("foo", "1.1-r0"),
+    ]
+    assert ndx.whatprovides("so:libc.so") == []
+
+
+def test_parse_v2(tmp_path):
+    _write_v2(tmp_path / "x86_64/APKINDEX.tar.gz", _v2_text)
+    _check_foo(index.load_repo(tmp_path, "x86_64"))
+
+
+def test_parse_adb(tmp_path):
+    apkrepo.write_index(
+        tmp_path / "x86_64/APKINDEX.tar.gz",
+        [
+            (
+                "libfoo",
+                "1.0-r0",
+                ["so:libfoo.so.1=1.0", "pc:foo=1.0"],
+                ["so:libc.so"],
+                [],
+                "foo",
+            ),
+            (
+                "foo",
+                "1.0-r0",
+                [],
+                ["libfoo=1.0-r0", "!foo-legacy"],
+                ["bar", "foo-base>=1.0"],
+            ),
+            ("foo", "1.1-r0", [], ["libfoo>=1.0-r0"]),
+        ],
+    )
+    _check_foo(index.load_repo(tmp_path, "x86_64"))
+
+
+def test_parse_installed(tmp_path):
+    dbp = tmp_path / "usr/lib/apk/db/installed"
+    dbp.parent.mkdir(parents=True)
+    # along with the file lists, which are not of interest
+    dbp.write_text(
+        "P:musl\nV:1.2.5-r0\np:so:libc.so=0\nF:usr/lib\nR:libc.so\n"
+        "a:0:0:755\nZ:Q1AAAA=\n\n"
+        "P:foo\nV:1.0-r0\nD:so:libc.so\n\n"
+    )
+    ndx = index.load_installed(tmp_path)
+    assert sorted(ndx.names) == ["foo", "musl"]
+    assert [(p.name, v) for p, v in ndx.whatprovides("so:libc.so")] == [
+        ("musl", "0")
+    ]
+    assert ndx.names["foo"][0].depends == ["so:libc.so"]
+    assert ndx.names["musl"][0].origin == "musl"
+
+
+def test_parse_bad(tmp_path):
+    ipath = tmp_path / "x86_64/APKINDEX.tar.gz"
+    ipath.parent.mkdir()
+    ipath.write_bytes(b"garbage")
+    assert index.load_repo(tmp_path, "x86_64") is None
+    assert index.load_repo(tmp_path / "missing", "x86_64") is None
+
+
+def test_reload(tmp_path):
+    ipath = tmp_path / "x86_64/APKINDEX.tar.gz"
+    apkrepo.write_index(ipath, [("foo", "1.0-r0", [], [])])
+    ndx = index.load_repo(tmp_path, "x86_64")
+    assert ndx.versions("foo") == ["1.0-r0"]
+    # loaded once for as long as it does not change
+    assert index.load_repo(tmp_path, "x86_64") is ndx
+
+    apkrepo.write_index(
+        ipath, [("foo", "1.1-r0", [], []), ("bar", "1", [], [])]
+    )
+    assert index.load_repo(tmp_path, "x86_64").versions("foo") == ["1.1-r0"]
+
+    # rewritten in place with the same size and time is only noticed when
+    # the index is invalidated, as build_index does
+    st = ipath.stat()
+    data = ipath.read_bytes().replace(b"1.1-r0", b"1.2-r0")
+    with open(ipath, "r+b") as f:
+        f.write(data)
+    os.utime(ipath, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert index.load_repo(tmp_path, "x86_64").versions("foo") == ["1.1-r0"]
+    index.invalidate(ipath)
+    assert index.load_repo(tmp_path, "x86_64").versions("foo") == ["1.2-r0"]
+
+
+@pytest.mark.parametrize("op", _ops.keys())
+@pytest.mark.parametrize("conflict", [False, True])
+def test_dep_str(op, conflict):
+    match = _ops[op]
+    pfx = ""
+    if conflict:
+        match |= index._MATCH_CONFLICT
+        pfx = "!"
+    assert index._dep_str("foo", "1.0-r0", match) == f"{pfx}foo{op}1.0-r0"
+
+
+def test_dep_str_unversioned():
+    assert index._dep_str("foo", None, 0) == "foo"
+    assert index._dep_str("foo", None, index._MATCH_CONFLICT) == "!foo"
+
+
+_old_pkgs = [
+    ("libfoo", "1.0-r0", ["so:libfoo.so.1=1.0"], ["musl"]),
+    ("foo", "1.0-r0", [], ["libfoo=1.0-r0"], ["bar"]),
+    ("zed", "2.0-r1", ["cmd:zed=2.0-r1"], []),
+]
+
+
+def _names(ndx):
+    return [(p.name, p.version) for p in ndx.packages]
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_merge(compressed):
+    old = apkrepo.AdbWriter().finish(_old_pkgs)
+    if compressed:
+        cobj = zlib.compressobj(wbits=-15)
+        old = b"ADBd" + cobj.compress(old) + cobj.flush()
+    new = apkrepo.AdbWriter().finish(
+        [
+            ("libfoo", "1.1-r0", ["so:libfoo.so.1=1.1"], ["musl"]),
+            ("bar", "1.0-r0", [], ["!foo<1.0"]),
+        ]
+    )
+    data = index.merge(old, new, {("libfoo", "1.0-r0")})
+    assert data[0:4] == (b"ADBd" if compressed else b"ADB.")
+
+    ndx = index.Index(index._parse_index(data))
+    assert _names(ndx) == [
+        ("bar", "1.0-r0"),
+        ("foo", "1.0-r0"),
+        ("libfoo", "1.1-r0"),
+        ("zed", "2.0-r1"),
+    ]
+    # the entries are kept as a whole
+    assert ndx.names["foo"][0].depends == ["libfoo=1.0-r0"]
+    assert ndx.names["foo"][0].install_if == ["bar"]
+    assert ndx.names["bar"][0].depends == ["!foo<1.0"]
+    assert ndx.names["libfoo"][0].provides == [("so:libfoo.so.1", "1.1")]
+    assert ndx.names["zed"][0].provides == [("cmd:zed", "2.0-r1")]
+
+    # only dropping, and the versions sort like apk sorts them
+    data = index.merge(old, None, {("zed", "2.0-r1")})
+    assert _names(index.Index(index._parse_index(data))) == [
+        ("foo", "1.0-r0"),
+        ("libfoo", "1.0-r0"),
+    ]
+
+
+def test_merge_v2():
+    assert index.merge(b"\x1f\x8b", None, set()) is None
+
+
+# stands in for apk: mkndx writes an index of the packages named by the
+# files it is given, everything is logged
+_fake_apk = """#!{python}
+import sys
+sys.path[0:0] = [{tests!r}, {src!r}]
+import apkrepo, pathlib
+with open({log!r}, "a") as f:
+    cmd = [a for a in sys.argv[1:] if a in ["mkndx", "adbsign"]]
+    pkgs = sorted(a for a in sys.argv[1:] if a.endswith(".apk"))
+    f.write(" ".join(cmd + pkgs) + "\\n")
+args = sys.argv[1:]
+if "mkndx" not in args:
+    sys.exit(0)
+out = pathlib.Path(args[args.index("--output") + 1])
+pkgs = []
+for a in args:
+    if a.endswith(".apk"):
+        pf = a[:-4]
+        rd = pf.rfind("-", 0, pf.rfind("-"))
+        pkgs.append((pf[:rd], pf[rd + 1 :], [], []))
+apkrepo.write_index(out, pkgs)
+"""
+
+
+def test_build_index(tmp_path):
+    paths.init(
+        tmp_path,
+        tmp_path,
+        tmp_path / "bldroot",
+        "",
+        tmp_path / "packages",
+        None,
+        tmp_path / "pkgstage",
+        tmp_path / "sources",
+        tmp_path / "cbuild_cache",
+    )
+    logger.init(False)
+    log = tmp_path / "apk.log"
+    apk = tmp_path / "apk"
+    apk.write_text(
+        _fake_apk.format(
+            python=sys.executable,
+            tests=str(pathlib.Path(__file__).parent),
+            src=str(pathlib.Path(__file__).parent.parent),
+            log=str(log),
+        )
+    )
+    apk.chmod(0o755)
+    paths.set_apk(apk)
+
+    repo = tmp_path / "repo/x86_64"
+    repo.mkdir(parents=True)
+    ipath = repo / "APKINDEX.tar.gz"
+
+    def _touch(fn, mt):
+        (repo / fn).write_bytes(fn.encode())
+        os.utime(repo / fn, ns=(mt, mt))
+
+    def _built():
+        ret = log.read_text().splitlines() if log.exists() else []
+        log.unlink(missing_ok=True)
+        return ret
+
+    # as seen by everything else in the same run
+    def _indexed():
+        return sorted(_names(index.load_repo(repo.parent, "x86_64")))
+
+    _touch("foo-1.0-r0.apk", 10**9)
+    _touch("bar-1.0-r0.apk", 10**9)
+    _touch("baz-1.0-r0.apk", 10**9)
+    assert cli.build_index(repo, 100, True)
+    assert _built() == ["mkndx bar-1.0-r0.apk baz-1.0-r0.apk foo-1.0-r0.apk"]
+    assert len(_indexed()) == 3
+
+    # nothing changed
+    assert cli.build_index(repo, 100, True)
+    assert _built() == []
+
+    # only the new package is read, the old version is left out
+    _touch("foo-1.1-r0.apk", 2 * 10**9)
+    assert cli.build_index(repo, 100, True)
+    assert _built() == ["mkndx foo-1.1-r0.apk"]
+    assert _indexed() == [
+        ("bar", "1.0-r0"),
+        ("baz", "1.0-r0"),
+        ("foo", "1.1-r0"),
+    ]
+
+    # removal needs no apk at all
+    (repo / "baz-1.0-r0.apk").unlink()
+    assert cli.build_index(repo, 100, True)
+    assert _built() == []
+    assert _indexed() == [("bar", "1.0-r0"), ("foo", "1.1-r0")]
+
+    # a different epoch rewrites the index, even with the same files
+    ino = ipath.stat().st_ino
+    assert cli.build_index(repo, 200, True)
+    assert _built() == []
+    assert ipath.stat().st_ino != ino
+    assert cli._read_manifest(repo, None)["epoch"] == 200
+    assert _indexed() == [("bar", "1.0-r0"), ("foo", "1.1-r0")]
+
+    # an index that does not match the manifest is rebuilt in full
+    apkrepo.write_index(ipath, [])
+    assert cli.build_index(repo, 200, True)
+    assert _built() == ["mkndx bar-1.0-r0.apk foo-1.1-r0.apk"]
+
+    # with a key, the updated index is signed again
+    asign.register_key(tmp_path / "key.rsa")
+    try:
+        assert cli.build_index(repo, 200)
+        assert _built() == ["mkndx bar-1.0-r0.apk foo-1.1-r0.apk"]
+        _touch("baz-1.0-r0.apk", 3 * 10**9)
+        assert cli.build_index(repo, 200)
+        assert _built() == ["mkndx baz-1.0-r0.apk", "adbsign"]
+    finally:
+        asign.register_key(None)
+    assert _indexed() == [
+        ("bar", "1.0-r0"),
+        ("baz", "1.0-r0"),
+        ("foo", "1.1-r0"),
+    ]
@@ -0,0 +1,110 @@
+# Conformance of the native version handling with apk itself
+
+from cbuild.apk import cli
+from gen_apk_versions import load, check
+
+import functools
+import pathlib
+import pytest
+
+_corpus = pathlib.Path(__file__).parent / "data/apk_versions.txt"
+
+_valid = [
+    "0",
+    "1",
+    "1.0",
+    "1.0.0",
+    "1.0a",
+    "1.0_rc",
+    "1.0_rc1",
+    "1.0_p1",
+    "1.0_alpha_beta",
+    "1.0_p1_rc2",
+    "1.0~abc",
+    "1.0~abc-r1",
+    "1.0-r0",
+    "1.0-r10",
+    "1.0_git20240101-r2",
+]
+
+_invalid = [
+    "",
+    "a",
+    "a1",
+    "1.",
+    "1..0",
+    ".1",
+    "1_0",
+    "1.0A",
+    "1.0ab",
+    "1.0a.1",
+    "1.0_",
+    "1.0_foo",
+    "1.0_rc1.1",
+    "1.0-r",
+    "1.0-1",
+    "1.0-r1-r2",
+    "1.0-r1_p1",
+    "1.0~",
+    "1.0~xyz",
+]
+
+# each one is older than the next
+_order = [
+    "1.0_alpha",
+    "1.0_alpha1",
+    "1.0_beta",
+    "1.0_pre",
+    "1.0_rc",
+    "1.0_rc1",
+    "1.0",
+    "1.0-r0",
+    "1.0-r1",
+    "1.0-r10",
+    "1.0_cvs",
+    "1.0_svn",
+    "1.0_git",
+    "1.0_hg",
+    "1.0_p",
+    "1.0_p1",
+    "1.0a",
+    "1.0b",
+    "1.0.1",
+    "1.01",
+    "1.1",
+    "1.2_alpha",
+    "1.10",
+    "2",
+]
+
+
+@pytest.mark.parametrize("ver", _valid)
+def test_valid(ver):
+    assert cli.check_version(ver)
+
+
+@pytest.mark.parametrize("ver", _invalid)
+def test_invalid(ver):
+    assert not cli.check_version(ver)
+
+
+@pytest.mark.parametrize("older,newer", list(zip(_order, _order[1:])))
+def test_order(older, newer):
+    assert cli.compare_version(older, newer, False) == -1
+    assert cli.compare_version(newer, older, False) == 1
+    assert cli.compare_version(older, older, False) == 0
+
+
+_key = functools.cmp_to_key(lambda a, b: cli.compare_version(a, b, False))
+
+
+def test_sort():
+    assert sorted(reversed(_order), key=_key) == _order
+
+
+def test_apk_versions():
+    if not _corpus.is_file():
+        pytest.skip("no corpus, generate it with gen_apk_versions.py")
+    ents = load(_corpus)
+    assert len(ents) > 0
+    assert check(ents) == []
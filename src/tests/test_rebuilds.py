@@ -0,0 +1,81 @@
+# Checks of the templates to rebuild after changes to others
+#
+# The shared library users are taken from hand-written indexes of a
+# regular and a stage repository, with the build dependencies of the
+# templates given directly.
+
+from cbuild.core import logger, rebuilds
+from cbuild.apk import index
+
+import apkrepo
+import pytest
+
+_arch = "x86_64"
+
+
+class _Info:
+    def __init__(self, pkgname, bdeps):
+        self.pkgname = pkgname
+        self.bdeps = bdeps
+
+    def get_build_deps(self):
+        return self.bdeps
+
+
+_infos = {
+    "main/libfoo": _Info("libfoo", []),
+    "main/bar": _Info("bar", ["main/libfoo"]),
+    # linked against libfoo, but only built after bar through the tool
+    "main/baz": _Info("baz", ["main/tool"]),
+    "main/tool": _Info("tool", ["main/bar"]),
+    # builds against libfoo without linking to it
+    "main/qux": _Info("qux", ["main/libfoo"]),
+    "main/staged": _Info("staged", []),
+    # not in any repository yet
+    "main/libnew": _Info("libnew", []),
+    "main/newuser": _Info("newuser", ["main/libnew"]),
+}
+
+
+@pytest.fixture
+def ndxs(tmp_path):
+    logger.init(False)
+    index._ndx_cache.clear()
+    apkrepo.write_index(
+        tmp_path / "packages" / _arch / "APKINDEX.tar.gz",
+        [
+            ("libfoo", "1.0-r0", ["so:libfoo.so.1=1"], [], [], "libfoo"),
+            ("libfoo-devel", "1.0-r0", [], ["libfoo=1.0-r0"], [], "libfoo"),
+            ("bar", "1.0-r0", [], ["so:libfoo.so.1"], [], "bar"),
+            ("baz-libs", "1.0-r0", [], ["so:libfoo.so.1>=1"], [], "baz"),
+            ("tool", "1.0-r0", [], [], [], "tool"),
+            ("qux", "1.0-r0", [], ["!so:libfoo.so.1"], [], "qux"),
+        ],
+    )
+    apkrepo.write_index(
+        tmp_path / "pkgstage" / _arch / "APKINDEX.tar.gz",
+        [("staged", "1.0-r0", [], ["so:libfoo.so.1"], [], "staged")],
+    )
+    return [
+        index.load_repo(tmp_path / "pkgstage", _arch),
+        index.load_repo(tmp_path / "packages", _arch),
+    ]
+
+
+def test_sonames(ndxs):
+    built, provides, consumers = rebuilds._get_sonames(ndxs)
+    assert built == {"libfoo", "bar", "baz", "tool", "qux", "staged"}
+    assert provides == {"libfoo": {"so:libfoo.so.1"}}
+    assert consumers == {"so:libfoo.so.1": {"bar", "baz", "staged"}}
+
+
+def test_order(ndxs):
+    ret = rebuilds.get(["main/libfoo"], _infos, ndxs)
+    assert ret[0] == "main/libfoo"
+    assert sorted(ret) == ["main/bar", "main/baz", "main/libfoo", "main/staged"]
+    assert ret.index("main/bar") < ret.index("main/baz")
+
+
+def test_unbuilt(ndxs):
+    ret = rebuilds.get(["main/libnew", "main/unknown"], _infos, ndxs)
+    assert ret == ["main/libnew", "main/newuser"]
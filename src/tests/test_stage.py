@@ -0,0 +1,163 @@
+# Checks of the unstage analysis against versioned dependencies
+#
+# Every scenario stages a new version of a provider that some package in
+# the regular repository depends on with a versioned constraint, and the
+# analysis has to tell whether the staged version still satisfies it.
+# The repositories are written as v3 indexes, read natively; when an apk
+# binary is given in the APK environment variable, the same repositories
+# are also built by apk itself and the scenarios are checked with both
+# the native and the apk query, which must agree. The regular repository
+# also has another provider of the same name, which does not keep it from
+# blocking, as only packages of the name itself are looked for.
+
+from cbuild.core import paths, logger, stage
+from cbuild.apk import index
+
+import apkrepo
+import subprocess
+import os
+import pytest
+
+_arch = "x86_64"
+
+# (constraint, provider version in repo, in stage, whether it blocks)
+_scenarios = [
+    (">=2.0", "2.0", "1.5", True),
+    (">=2.0", "2.0", "2.5", False),
+    (">2.0", "2.5", "2.0", True),
+    (">2.0", "2.5", "3.0", False),
+    ("<3.0", "2.0", "3.5", True),
+    ("<3.0", "2.0", "2.5", False),
+    ("<=2.0", "1.0", "2.1", True),
+    ("<=2.0", "1.0", "2.0", False),
+    ("=2.0", "2.0", "2.1", True),
+]
+
+
+def _write_native(rpath, pkgs):
+    apkrepo.write_index(rpath / _arch / "APKINDEX.tar.gz", pkgs)
+
+
+def _write_apk(rpath, pkgs, apk):
+    adir = rpath / _arch
+    adir.mkdir(parents=True)
+    for name, ver, prov, deps in pkgs:
+        subprocess.run(
+            [
+                apk,
+                "--allow-untrusted",
+                "mkpkg",
+                "--output",
+                adir / f"{name}-{ver}.apk",
+                "--info",
+                f"name:{name}",
+                "--info",
+                f"version:{ver}",
+                "--info",
+                f"arch:{_arch}",
+                "--info",
+                f"origin:{name}",
+                "--info",
+                f"provides:{' '.join(prov)}",
+                "--info",
+                f"depends:{' '.join(deps)}",
+            ],
+            check=True,
+        )
+    subprocess.run(
+        [
+            apk,
+            "--allow-untrusted",
+            "mkndx",
+            "--output",
+            "APKINDEX.tar.gz",
+            *sorted(f.name for f in adir.glob("*.apk")),
+        ],
+        cwd=adir,
+        check=True,
+    )
+
+
+def _setup(tmp_path, constraint, rver, sver, writef):
+    paths.init(
+        tmp_path,
+        tmp_path,
+        tmp_path / "bldroot",
+        "",
+        tmp_path / "packages",
+        None,
+        tmp_path / "pkgstage",
+        tmp_path / "sources",
+        tmp_path / "cbuild_cache",
+    )
+    (tmp_path / "bldroot").mkdir()
+    logger.init(False)
+    index._ndx_cache.clear()
+    writef(
+        tmp_path / "packages/main",
+        [
+            ("libfoo", "1-r0", [f"pc:foo={rver}"], []),
+            ("libfoo-compat", "1-r0", [f"pc:foo={rver}"], []),
+            ("bar", "1-r0", [], [f"pc:foo{constraint}"]),
+        ],
+    )
+    writef(
+        tmp_path / "pkgstage/main",
+        [("libfoo", "2-r0", [f"pc:foo={sver}"], [])],
+    )
+
+
+def _rlist(tmp_path):
+    rlist = []
+    for r in ["pkgstage/main", "packages/main"]:
+        rlist += ["--repository", str(tmp_path / r)]
+    return rlist
+
+
+def _check(monkeypatch, capfd, query, blocks):
+    with monkeypatch.context() as m:
+        m.setattr(stage, "_get_query", query)
+        ret = stage.check_stage(_arch)
+    out = capfd.readouterr().out
+    if blocks:
+        assert ret == []
+        assert out.splitlines() == [
+            "=> Cannot unstage repositories:",
+            " rebuild: bar (pc:foo)",
+        ]
+    else:
+        assert ret != []
+        assert "rebuild:" not in out
+
+
+@pytest.mark.parametrize("constraint,rver,sver,blocks", _scenarios)
+def test_native(tmp_path, monkeypatch, capfd, constraint, rver, sver, blocks):
+    _setup(tmp_path, constraint, rver, sver, _write_native)
+    query = stage._get_query(_arch, _rlist(tmp_path))
+    assert isinstance(query, stage._IndexQuery)
+    # package names only, as with apk
+    assert query.providers("libfoo") == ["libfoo", "libfoo"]
+    assert query.providers("pc:foo") == []
+    _check(monkeypatch, capfd, stage._get_query, blocks)
+
+
+@pytest.mark.parametrize("constraint,rver,sver,blocks", _scenarios)
+def test_apk(tmp_path, monkeypatch, capfd, constraint, rver, sver, blocks):
+    apk = os.environ.get("APK")
+    if not apk:
+        pytest.skip("no apk to compare against, set APK")
+    paths.set_apk(apk)
+    _setup(
+        tmp_path,
+        constraint,
+        rver,
+        sver,
+        lambda rp, pkgs: _write_apk(rp, pkgs, apk),
+    )
+    rlist = _rlist(tmp_path)
+    for name in ["libfoo", "libfoo-compat", "bar", "pc:foo"]:
+        assert set(stage._ApkQuery(_arch, rlist).providers(name)) == set(
+            stage._get_query(_arch, rlist).providers(name)
+        )
+    _check(monkeypatch, capfd, stage._ApkQuery, blocks)
+    _check(monkeypatch, capfd, stage._get_query, blocks)
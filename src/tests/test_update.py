@@ -0,0 +1,109 @@
+# Checks of when the build root update can be skipped
+#
+# The root has some packages installed from the regular repository, and
+# the repositories change the way they do during a bulk build.
+
+from cbuild.core import paths, logger, chroot, profile
+from cbuild.apk import cli, index
+
+import apkrepo
+import pytest
+
+_arch = "x86_64"
+
+
+class _Profile:
+    arch = _arch
+    cross = False
+    repos = ["main"]
+
+
+class _Template:
+    source_repositories = ["main"]
+
+    def __init__(self):
+        self.rparent = self
+
+    def profile(self):
+        return _Profile()
+
+
+@pytest.fixture
+def pkg(tmp_path, monkeypatch):
+    paths.init(
+        tmp_path,
+        tmp_path,
+        tmp_path / "bldroot",
+        "",
+        tmp_path / "packages",
+        None,
+        tmp_path / "pkgstage",
+        tmp_path / "sources",
+        tmp_path / "cbuild_cache",
+    )
+    logger.init(False)
+    index._ndx_cache.clear()
+    monkeypatch.setattr(chroot, "_host", _arch, raising=False)
+    monkeypatch.setattr(chroot, "_crepos", None)
+    monkeypatch.setattr(cli, "_use_net", False)
+    monkeypatch.setitem(profile._all_profiles, _arch, _Profile())
+
+    rdir = tmp_path / "etc/apk/repositories.d"
+    rdir.mkdir(parents=True)
+    (rdir / "00-repo.conf").write_text("/@section@\n")
+
+    idir = tmp_path / "bldroot/usr/lib/apk/db"
+    idir.mkdir(parents=True)
+    (idir / "installed").write_text(
+        "P:musl\nV:1.2-r0\n\nP:libfoo\nV:1.0-r0\np:so:libfoo.so.1=1.0\n\n"
+    )
+
+    _write(tmp_path / "packages", [("musl", "1.2-r0"), ("libfoo", "1.0-r0")])
+
+    tmpl = _Template()
+    chroot._update_done(tmpl)
+    assert chroot._update_current(tmpl)
+    return tmpl
+
+
+# always a new file, like apk writes it
+def _write(rpath, pkgs):
+    ipath = rpath / "main" / _arch / "APKINDEX.tar.gz"
+    tpath = ipath.with_name("new")
+    apkrepo.write_index(tpath, [(pn, pv, [], []) for pn, pv in pkgs])
+    tpath.rename(ipath)
+
+
+def test_stage_uninstalled(tmp_path, pkg):
+    # the first package in the stage, and then another one
+    _write(tmp_path / "pkgstage", [("bar", "1.0-r0")])
+    assert chroot._update_current(pkg)
+    _write(tmp_path / "pkgstage", [("bar", "1.0-r0"), ("baz", "2.0-r0")])
+    assert chroot._update_current(pkg)
+
+
+def test_stage_installed(tmp_path, pkg):
+    _write(tmp_path / "pkgstage", [("bar", "1.0-r0")])
+    assert chroot._update_current(pkg)
+    _write(tmp_path / "pkgstage", [("bar", "1.0-r0"), ("libfoo", "1.1-r0")])
+    assert not chroot._update_current(pkg)
+    # and it is current again once updated
+    chroot._update_done(pkg)
+    assert chroot._update_current(pkg)
+
+
+def test_unstage(tmp_path, pkg):
+    _write(tmp_path / "pkgstage", [("bar", "1.0-r0")])
+    chroot._update_done(pkg)
+    # the stage goes away and the regular repository has the same versions
+    (tmp_path / "pkgstage/main" / _arch / "APKINDEX.tar.gz").unlink()
+    _write(
+        tmp_path / "packages",
+        [("musl", "1.2-r0"), ("libfoo", "1.0-r0"), ("bar", "1.0-r0")],
+    )
+    assert chroot._update_current(pkg)
+
+
+def test_older(tmp_path, pkg):
+    _write(tmp_path / "pkgstage", [("musl", "1.1-r0")])
+    assert chroot._update_current(pkg)
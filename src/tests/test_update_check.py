@@ -0,0 +1,168 @@
+# Checks of the update check fetcher against a local http server
+
+from cbuild.core import update_check
+
+import http.server
+import threading
+import time
+import pytest
+
+_body_etag = "version 1.0"
+_body_mod = "version 2.0"
+_lmod = "Wed, 01 Jan 2025 00:00:00 GMT"
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # keep-alive
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.conns += 1
+
+    def _send(self, status, body=b"", hdrs={}):
+        # before responding, so that it is there once the client has it
+        with self.server.lock:
+            self.server.requests.append((self.path, status))
+        self.send_response(status)
+        for k, v in hdrs.items():
+            self.send_header(k, v)
+        if status != 304:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        srv = self.server
+        with srv.lock:
+            srv.active += 1
+            srv.peak = max(srv.peak, srv.active)
+        try:
+            time.sleep(srv.delay)
+        finally:
+            with srv.lock:
+                srv.active -= 1
+
+        if self.path == "/redirect":
+            self._send(302, hdrs={"Location": "/moved/page"})
+        elif self.path == "/loop":
+            self._send(302, hdrs={"Location": "/loop"})
+        elif self.path == "/missing":
+            self._send(404)
+        elif self.path == "/etag":
+            if self.headers.get("If-None-Match") == '"v1"':
+                self._send(304)
+            else:
+                self._send(200, _body_etag.encode(), {"ETag": '"v1"'})
+        elif self.path == "/modified":
+            if self.headers.get("If-Modified-Since") == _lmod:
+                self._send(304)
+            else:
+                self._send(200, _body_mod.encode(), {"Last-Modified": _lmod})
+        else:
+            self._send(200, f"page {self.path}".encode())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    for v in ["http_proxy", "HTTP_PROXY", "all_proxy", "ALL_PROXY"]:
+        monkeypatch.delenv(v, raising=False)
+    srv = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    srv.daemon_threads = True
+    srv.lock = threading.Lock()
+    srv.conns = 0
+    srv.requests = []
+    srv.active = 0
+    srv.peak = 0
+    srv.delay = 0
+    srv.url = f"http://127.0.0.1:{srv.server_address[1]}"
+    thr = threading.Thread(target=srv.serve_forever)
+    thr.start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+    thr.join()
+
+
+def _fetch_all(fetcher, urls):
+    ret = [None] * len(urls)
+
+    def _fetch(i):
+        ret[i] = fetcher.fetch(urls[i])
+
+    thrs = [
+        threading.Thread(target=_fetch, args=(i,)) for i in range(len(urls))
+    ]
+    for thr in thrs:
+        thr.start()
+    for thr in thrs:
+        thr.join()
+    return ret
+
+
+def test_keepalive(server):
+    fetcher = update_check.Fetcher()
+    for i in range(5):
+        assert fetcher.fetch(f"{server.url}/page{i}") == f"page /page{i}"
+    assert len(server.requests) == 5
+    assert server.conns == 1
+
+
+def test_dedup(server):
+    server.delay = 0.3
+    fetcher = update_check.Fetcher()
+    ret = _fetch_all(fetcher, [f"{server.url}/same"] * 8)
+    assert ret == ["page /same"] * 8
+    assert server.requests == [("/same", 200)]
+    # and later on it comes from memory
+    assert fetcher.fetch(f"{server.url}/same") == "page /same"
+    assert len(server.requests) == 1
+
+
+def test_host_limit(server):
+    server.delay = 0.2
+    fetcher = update_check.Fetcher(host_jobs=2)
+    urls = [f"{server.url}/page{i}" for i in range(8)]
+    ret = _fetch_all(fetcher, urls)
+    assert ret == [f"page /page{i}" for i in range(8)]
+    assert server.peak == 2
+    # no more connections than parallel requests
+    assert server.conns == 2
+
+
+@pytest.mark.parametrize(
+    "path,body", [("/etag", _body_etag), ("/modified", _body_mod)]
+)
+def test_revalidate(server, tmp_path, path, body):
+    url = f"{server.url}{path}"
+    assert update_check.Fetcher(tmp_path).fetch(url) == body
+    # a new run asks the server whether it changed
+    assert update_check.Fetcher(tmp_path).fetch(url) == body
+    assert server.requests == [(path, 200), (path, 304)]
+    # without the cache it is fetched again
+    assert update_check.Fetcher().fetch(url) == body
+    assert server.requests[-1] == (path, 200)
+
+
+def test_redirect(server):
+    fetcher = update_check.Fetcher()
+    assert fetcher.fetch(f"{server.url}/redirect") == "page /moved/page"
+    assert server.requests == [("/redirect", 302), ("/moved/page", 200)]
+    # over the same connection
+    assert server.conns == 1
+
+
+def test_failure(server):
+    fetcher = update_check.Fetcher()
+    assert fetcher.fetch(f"{server.url}/missing") is None
+    assert fetcher.fetch(f"{server.url}/loop") is None
+    assert server.requests[0] == ("/missing", 404)
+    assert server.requests[1:] == [("/loop", 302)] * 10
+    # failures are not remembered
+    assert fetcher.fetch(f"{server.url}/missing") is None
+    assert len(server.requests) == 12